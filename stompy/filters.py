@@ -10,11 +10,13 @@ import scipy.signal
 
 from scipy.signal import filtfilt, lfilter
 
-def lowpass(data,in_t=None,cutoff=None,order=4,dt=None,axis=-1,causal=False):
+def lowpass(data,in_t=None,cutoff=None,order=4,dt=None,axis=-1,causal=False,sos=False):
     """
     data: vector of data
     in_t: sample times
     cutoff: cutoff period in the same units as in_t
+    sos: use second-order sections, which are numerically more robust,
+      e.g. when filtering many columns of an array at once along axis.
 
     returns vector same as data, but with high frequencies removed
     """
@@ -26,6 +28,13 @@ def lowpass(data,in_t=None,cutoff=None,order=4,dt=None,axis=-1,causal=False):
 
     Wn = dt / cutoff 
 
+    if sos:
+        SOS = butter(order, Wn, output='sos')
+        if not causal:
+            return scipy.signal.sosfiltfilt(SOS,data,axis=axis)
+        else:
+            return scipy.signal.sosfilt(SOS,data,axis=axis)
+
     B,A = butter(order, Wn)
 
     if not causal:
@@ -236,6 +236,14 @@ class Triangulation(unstructured_grid.UnstructuredGrid):
         t: can specify a target point which may be used with a spatial index
         to speed up the query.
         """
+        if t is not None:
+            # jump-and-walk: start from whichever of a sample of cells is
+            # nearest t, so that the walk in locate() is short.
+            sample=self.start_cell_sample()
+            sample=sample[~self.cells['deleted'][sample]]
+            if len(sample):
+                centers=self.nodes['x'][self.cells['nodes'][sample,:3]].mean(axis=1)
+                return sample[np.argmin( ((centers-t)**2).sum(axis=1) )]
         c=0
         try:
             while self.cells['deleted'][c]: 
@@ -243,6 +251,23 @@ class Triangulation(unstructured_grid.UnstructuredGrid):
             return c
         except IndexError:
             return self.INF_CELL
+
+    _start_sample=None
+    _start_sample_ncells=0
+    def start_cell_sample(self):
+        """ strided sample of about sqrt(N) valid cells for choose_start_cell.
+        Cached, and only refreshed when the cell array has doubled or shrunk 
+        since, so that each call is O(sqrt(N)) rather than O(N).  Cells in the
+        sample may since have been deleted.
+        """
+        n_cells=len(self.cells)
+        if ( self._start_sample is None
+             or n_cells>2*self._start_sample_ncells
+             or n_cells<self._start_sample_ncells ):
+            valid=np.nonzero(~self.cells['deleted'])[0]
+            self._start_sample=valid[::max(1,int(np.sqrt(len(valid))))]
+            self._start_sample_ncells=n_cells
+        return self._start_sample
             
     IN_VERTEX=0
     IN_EDGE=2
@@ -460,7 +485,7 @@ class Triangulation(unstructured_grid.UnstructuredGrid):
             # j indexes the edge we just tested. 
             # p0 and p1 are the endpoints of the edge
             # 1. do we want a neighbor of n0 or n1?
-            if direc*cmp(p0[coord],p1[coord]) < 0: # want to go towards p1
+            if direc*np.sign(p0[coord]-p1[coord]) < 0: # want to go towards p1
                 n_adj=self.edges['nodes'][j,1]
             else:
                 n_adj=self.edges['nodes'][j,0]
@@ -846,30 +871,26 @@ class Triangulation(unstructured_grid.UnstructuredGrid):
             # so drop it from candidates here, but remember that we saw it
 
             # first, sweep through the candidates to test CCW
-            has_inf=False
-            c_cand1=hole_nodes[2:]
+            c_cand1=[c for c in hole_nodes[2:] if c!='inf']
+            has_inf=len(c_cand1) < len(hole_nodes)-2
             c_cand2=[]
-            for c in c_cand1:
-                if c=='inf':
-                    has_inf=True
-                elif robust_predicates.orientation( self.nodes['x'][a],
-                                                    self.nodes['x'][b],
-                                                    self.nodes['x'][c] ) > 0:
-                    c_cand2.append(c)
+            if c_cand1:
+                ccw=robust_predicates.orientation_array( self.nodes['x'][a],
+                                                         self.nodes['x'][b],
+                                                         self.nodes['x'][c_cand1] )
+                c_cand2=[c for c,o in zip(c_cand1,ccw) if o>0]
 
             self.log.debug("After CCW tests, %s are left"%c_cand2)
 
             while len(c_cand2)>1:
                 c=c_cand2[0]
-                for d in c_cand2[1:]:
-                    tst=robust_predicates.incircle( self.nodes['x'][a],
-                                                    self.nodes['x'][b],
-                                                    self.nodes['x'][c],
-                                                    self.nodes['x'][d] )
-                    if tst>0:
-                        self.log.debug("%d was inside %d-%d-%d"%(d,a,b,c))
-                        c_cand2.pop(0)
-                        break
+                tst=robust_predicates.incircle_array( self.nodes['x'][a],
+                                                      self.nodes['x'][b],
+                                                      self.nodes['x'][c],
+                                                      self.nodes['x'][c_cand2[1:]] )
+                if np.any(tst>0):
+                    self.log.debug("%d was inside %d-%d-%d"%(c_cand2[1+np.argmax(tst>0)],a,b,c))
+                    c_cand2.pop(0)
                 else:
                     # c passed all the tests
                     c_cand2=[c]
@@ -920,34 +941,35 @@ class Triangulation(unstructured_grid.UnstructuredGrid):
     # Make a check for the delaunay criterion:
     def check_global_delaunay(self):
         bad_checks=[] # [ (cell,node),...]
+        all_nodes=np.array(list(self.valid_node_iter()),np.int64)
         for c in self.valid_cell_iter():
             nodes=self.cells['nodes'][c]
             pnts=self.nodes['x'][nodes]
 
             # brute force - check them all.
-            for n in self.valid_node_iter():
+            checks=robust_predicates.incircle_array(pnts[0],pnts[1],pnts[2],
+                                                    self.nodes['x'][all_nodes])
+            for n in all_nodes[checks>0]:
                 if n in nodes:
                     continue
-                t=self.nodes['x'][n]
-                check=robust_predicates.incircle(pnts[0],pnts[1],pnts[2],t)
-                if check>0:
-                    # how do we check for constraints here?
-                    # maybe more edge-centric?
-                    # tests of a cell on one side of an edge against a node on the
-                    # other is reflexive.
-                    # 
-                    
-                    # could go through the edges of c, 
-                    msg="Node %d is inside the circumcircle of cell %d (%d,%d,%d)"%(n,c,
-                                                                                    nodes[0],nodes[1],nodes[2])
-                    self.log.error(msg)
-                    bad_checks.append( (c,n) )
+                # how do we check for constraints here?
+                # maybe more edge-centric?
+                # tests of a cell on one side of an edge against a node on the
+                # other is reflexive.
+                # 
+
+                # could go through the edges of c, 
+                msg="Node %d is inside the circumcircle of cell %d (%d,%d,%d)"%(n,c,
+                                                                                nodes[0],nodes[1],nodes[2])
+                self.log.error(msg)
+                bad_checks.append( (c,n) )
         return bad_checks
     
     def check_local_delaunay(self):
         """ Check both sides of each edge - can deal with constrained edges.
         """
         bad_checks=[] # [ (cell,node),...]
+        tests=[] # [ (cell,node),...] to check with one batched incircle
         for j in self.valid_edge_iter():
             if self.edges['constrained'][j]:
                 continue
@@ -960,20 +982,26 @@ class Triangulation(unstructured_grid.UnstructuredGrid):
             c_opp=max(c1,c2)
             
             nodes=self.cells['nodes'][c]
-            pnts=self.nodes['x'][nodes]
 
             # brute force - check them all.
             for n in self.cell_to_nodes(c_opp):
                 if n in nodes:
                     continue
-                t=self.nodes['x'][n]
-                check=robust_predicates.incircle(pnts[0],pnts[1],pnts[2],t)
-                if check>0:
-                    msg="Node %d is inside the circumcircle of cell %d (%d,%d,%d)"%(n,c,
-                                                                                    nodes[0],nodes[1],nodes[2])
-                    self.log.error(msg)
-                    bad_checks.append( (c,n) )
-                    raise Exception('fail')
+                tests.append( (c,n) )
+
+        if len(tests)==0:
+            return bad_checks
+        tests=np.array(tests)
+        pnts=self.nodes['x'][self.cells['nodes'][tests[:,0],:3]]
+        checks=robust_predicates.incircle_array(pnts[:,0],pnts[:,1],pnts[:,2],
+                                                self.nodes['x'][tests[:,1]])
+        for c,n in tests[checks>0]:
+            nodes=self.cells['nodes'][c]
+            msg="Node %d is inside the circumcircle of cell %d (%d,%d,%d)"%(n,c,
+                                                                            nodes[0],nodes[1],nodes[2])
+            self.log.error(msg)
+            bad_checks.append( (c,n) )
+            raise Exception('fail')
         return bad_checks
 
     def check_orientations(self):
@@ -981,12 +1009,10 @@ class Triangulation(unstructured_grid.UnstructuredGrid):
         Checks all cells for proper CCW orientation,
         return a list of cell indexes of failures.
         """
-        bad_cells=[]
-        for c in self.valid_cell_iter():
-            node_xy=self.nodes['x'][self.cells['nodes'][c]]
-            if robust_predicates.orientation(*node_xy) <= 0:
-                bad_cells.append(c)
-        return bad_cells
+        cells=np.array(list(self.valid_cell_iter()),np.int64)
+        node_xy=self.nodes['x'][self.cells['nodes'][cells,:3]].reshape([-1,3,2])
+        ccw=robust_predicates.orientation_array(node_xy[:,0],node_xy[:,1],node_xy[:,2])
+        return list(cells[ccw<=0])
     def check_convex_hull(self):
         # find an edge on the convex hull, walk the hull and check
         # all consecutive orientations
@@ -1814,49 +1840,73 @@ class Triangulation(unstructured_grid.UnstructuredGrid):
         raise Exception("No - it's really slow.  Don't do this.")
     
     def bulk_init(self,points): # ExactDelaunay
+        """ Replace the triangulation with the Delaunay triangulation of
+        points, built in one shot from scipy.  Nodes, edges and cells and
+        the links between them are all set from the simplices/neighbors
+        arrays, vectorized.
+        """
         if spatial is None:
             return self.bulk_init_slow(points)
         
         sdt = spatial.Delaunay(points)
-
+        simplices=sdt.simplices.copy()
+        # neighbors[c,i] is the cell opposite simplices[c,i], -1 on the hull
+        neighbors=sdt.neighbors.copy()
+
+        # qhull doesn't promise CCW - swapping two vertices also swaps
+        # their opposite cells.
+        pnts=np.asarray(points,np.float64)[simplices]
+        cw=robust_predicates.orientation_array(pnts[:,0],pnts[:,1],pnts[:,2])<0
+        simplices[cw,1:]=simplices[cw,2:0:-1]
+        neighbors[cw,1:]=neighbors[cw,2:0:-1]
+
+        Nc=len(simplices)
         self.nodes=np.zeros( len(points), self.node_dtype)
-        self.cells=np.zeros( sdt.vertices.shape[0], self.cell_dtype)
-
         self.nodes['x']=points
-        self.cells['nodes']=sdt.vertices
-
-        # looks like it's CGAL style:
-        # neighbor[1] shares nodes[0] and nodes[2]
-        # vertices are CCW
-
-        for c in range(self.Ncells()):
-            for i,(a,b) in enumerate(circular_pairs(self.cells['nodes'][c])):
-                # first time - that would be i=0, and the first two nodes.
-                # but for neighbors, it's indexed by the opposite node.  so the edge
-                # connected the nodes[0]--nodes[1] corresponds with neighbor 2.
-                c_nbr=sdt.neighbors[c,(i+2)%3]
-
-                # c_nbr==-1 on convex hull.
-                # only worry about cases where c is larger.
-                if c<c_nbr:
-                    continue
-
-                if c_nbr<0:
-                    c_nbr=self.INF_CELL
-
-                j=self.add_edge(nodes=[a,b],
-                                cells=[c,c_nbr])
-                # and record in the cell, too
-                self.cells['edges'][c,i]=j
-                if c_nbr!=self.INF_CELL:
-                    nbr_nodes=self.cells['nodes'][c_nbr]
-                    for i_nbr in [0,1,2]:
-                        if nbr_nodes[i_nbr]==b and nbr_nodes[(i_nbr+1)%3]==a:
-                            self.cells['edges'][c_nbr,i_nbr]=j
-                            break
-                    else:
-                        assert False
 
+        self.cells=np.zeros( Nc, self.cell_dtype)
+        self.cells['nodes']=simplices
+        self.cells['_center']=np.nan
+        self.cells['_area']=np.nan
+
+        # side i of cell c joins nodes i and i+1, opposite node i+2.
+        # each edge is created by the side for which c is larger than its
+        # neighbor, which includes hull sides.
+        c=np.repeat(np.arange(Nc),3)
+        side=np.tile(np.arange(3),Nc)
+        c_nbr=neighbors[c,(side+2)%3]
+        own=c>c_nbr
+        c_own,side_own,c_nbr=c[own],side[own],c_nbr[own]
+
+        Nj=len(c_own)
+        self.edges=np.zeros( Nj, self.edge_dtype)
+        self.edges['nodes'][:,0]=simplices[c_own,side_own]
+        self.edges['nodes'][:,1]=simplices[c_own,(side_own+1)%3]
+        self.edges['cells'][:,0]=c_own
+        self.edges['cells'][:,1]=np.where(c_nbr<0,self.INF_CELL,c_nbr)
+
+        j=np.arange(Nj)
+        self.cells['edges'][c_own,side_own]=j
+        # the same edge as seen from the neighbor: if the neighbor has
+        # c opposite its node k, the edge is its side k+1
+        inner=c_nbr>=0
+        k=np.argmax(neighbors[c_nbr[inner]]==c_own[inner,None],axis=1)
+        self.cells['edges'][c_nbr[inner],(k+1)%3]=j[inner]
+
+        self.refresh_metadata()
+
+    def add_constraints(self,node_pairs):
+        """ add_constraint for many pairs of nodes at once.  Pairs which
+        are already edges are marked constrained in one pass, and only the
+        remainder go through add_constraint.
+        """
+        node_pairs=np.asarray(node_pairs).reshape([-1,2])
+        j=self.node_pairs_to_edges(node_pairs)
+        present=j>=0
+        assert not np.any(self.edges['constrained'][j[present]])
+        self.edges['constrained'][j[present]]=True
+        for nA,nB in node_pairs[~present]:
+            self.add_constraint(nA,nB)
             
 # Issues:
 #   Calls like edge_to_cells do not scale well right now.  In particular,
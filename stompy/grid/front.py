@@ -16,7 +16,8 @@ from . import (unstructured_grid,
                exact_delaunay,
                shadow_cdt)
 
-from .. import utils
+from .. import utils, priority_queue
+from shapely import geometry, ops
 
 
 try:
@@ -135,6 +136,116 @@ def one_point_cost(pnt,edges,target_length=5.0):
     penalty += length_penalty
 
     return penalty
+
+def _group_max(values,owner,count):
+    """ per-group maximum of values, and the index into values of the first
+    element attaining it.  owner: group of each value, in [0,count)
+    Empty groups get nan.
+    """
+    vmax=np.full(count,-np.inf)
+    np.maximum.at(vmax,owner,values)
+    vmax[np.isinf(vmax) & (vmax<0)]=np.nan
+    hits=np.nonzero(values==vmax[owner])[0]
+    # first hit for each group
+    groups,first=np.unique(owner[hits],return_index=True)
+    idx=np.zeros(count,np.int64)
+    idx[groups]=hits[first]
+    return vmax,idx
+
+def batch_point_cost(pnts,edges,owner,target_lengths,gradient=False):
+    """
+    one_point_cost() for many points at once, optionally with its gradient.
+    
+    pnts: [K,2] candidate locations
+    edges: [M,2,2] segments, each completing a triangle with its point
+    owner: [M] index into pnts of the point for each segment
+    target_lengths: [K] or scalar
+    gradient: if True, also return the gradient of each cost with respect 
+      to its point, [K,2].  Where the cost involves a max or min, this is
+      the gradient of the active term.
+
+    Points with no segments get a nan cost.
+    """
+    pnts=np.asarray(pnts,np.float64)
+    owner=np.asarray(owner)
+    K=len(pnts)
+    target_lengths=np.broadcast_to(np.asarray(target_lengths,np.float64),(K,))
+    max_angle = 85.0*np.pi/180.
+    sixty = 60*np.pi/180.
+    
+    P=pnts[owner]
+    all_edges = np.zeros( (len(owner), 3 ,2), np.float64 )
+    all_edges[:,0,:] = edges[:,0] - P  # ab
+    all_edges[:,1,:] = edges[:,1] - edges[:,0] # bc
+    all_edges[:,2,:] = P - edges[:,1] # ca
+
+    i = np.arange(3)
+    im1 = (i-1)%3
+    abs_angles = np.arctan2( all_edges[:,:,1], all_edges[:,:,0] )
+    all_angles = (np.pi - (abs_angles[:,i] - abs_angles[:,im1]) % (2*np.pi)) % (2*np.pi)
+
+    # same terms as one_point_cost, reduced over each point's segments
+    owner3=np.repeat(owner,3)
+    dev=np.abs(all_angles - sixty).ravel()
+    worst_angle,worst_idx = _group_max(dev,owner3,K)
+    alpha = worst_angle /(max_angle - sixty)
+    angle_penalty = 10*alpha**5
+
+    scale_rad = 3.0*np.pi/180.
+    thresh = max_angle - 1.0*scale_rad
+    biggest,big_idx = _group_max(all_angles.ravel(),owner3,K)
+    big_angle_penalty = np.exp( (biggest - thresh) / scale_rad)
+
+    ab_lens = (all_edges[:,0,:]**2).sum(axis=1)
+    ca_lens = (all_edges[:,2,:]**2).sum(axis=1)
+    # minima via max of negatives
+    neg_min_ab,ab_idx = _group_max(-ab_lens,owner,K)
+    neg_min_ca,ca_idx = _group_max(-ca_lens,owner,K)
+    min_ab,min_ca=-neg_min_ab,-neg_min_ca
+    
+    min_len = np.minimum( min_ab,min_ca )
+    max_len = np.maximum( min_ab,min_ca )
+    L2=target_lengths**2
+    undershoot = L2 / min_len
+    overshoot  = max_len / L2
+
+    length_factor = 2
+    length_penalty = ( length_factor*(np.maximum(undershoot,1) - 1) +
+                       length_factor*(np.maximum(overshoot,1) - 1) )
+    
+    costs=angle_penalty + big_angle_penalty + length_penalty
+    empty=np.bincount(owner,minlength=K)==0
+    costs[empty]=np.nan
+    if not gradient:
+        return costs
+
+    # derivatives of the angles at P, B and C with respect to P.
+    # d arg(v)/dv = perp(v)/|v|^2
+    def dargs(v):
+        return np.c_[-v[:,1],v[:,0]] / (v**2).sum(axis=1)[:,None]
+    d_arg0=-dargs(all_edges[:,0,:]) # e0=B-P
+    d_arg2= dargs(all_edges[:,2,:]) # e2=P-C
+    dtheta=np.zeros( (len(owner),3,2), np.float64)
+    dtheta[:,0,:]= d_arg2 - d_arg0
+    dtheta[:,1,:]= d_arg0
+    dtheta[:,2,:]= -d_arg2
+    dtheta=dtheta.reshape([-1,2])
+
+    sign=np.sign(all_angles.ravel() - sixty)
+    grads=( (50*alpha**4/(max_angle - sixty))[:,None]
+            * sign[worst_idx,None] * dtheta[worst_idx] )
+    grads+= (big_angle_penalty/scale_rad)[:,None] * dtheta[big_idx]
+
+    d_min_ab=-2*all_edges[ab_idx,0,:]
+    d_min_ca= 2*all_edges[ca_idx,2,:]
+    ab_smaller=(min_ab<=min_ca)[:,None]
+    d_min_len=np.where(ab_smaller,d_min_ab,d_min_ca)
+    d_max_len=np.where(ab_smaller,d_min_ca,d_min_ab)
+    grads+= (length_factor*(undershoot>1)*(-L2/min_len**2))[:,None] * d_min_len
+    grads+= (length_factor*(overshoot>1)/L2)[:,None] * d_max_len
+    grads[empty]=0.0
+    
+    return costs,grads
     
 
 class Curve(object):
@@ -685,10 +796,13 @@ class JoinStrategy(Strategy):
                     if curve.is_forward(fa,fb,fc):
                         raise StrategyFailed("Cannot join across middle node")
             # probably okay, not sure if there are more checks to attempt
-            if grid.nodes['fixed'][na]==site.af.HINT:
+            if ( (grid.nodes['fixed'][na]==site.af.HINT) or
+                 (grid.nodes['fixed'][nc]==site.af.RIGID) ):
                 mover,anchor=na,nc
             else:
                 mover,anchor=nc,na
+            if grid.nodes['fixed'][mover]==site.af.RIGID:
+                raise StrategyFailed("Neither node can be moved")
         else:
             raise StrategyFailed("Neither node can be moved")
 
@@ -1207,19 +1321,59 @@ class AdvancingFront(object):
         # Subscribe to operations *before* they happen, so that the constrained
         # DT can signal that an invariant would be broken
         self.cdt=shadow_cdt.ShadowCDT(g)
+
+        # and track changes which invalidate the scores of front sites
+        self.invalidate_sites()
+        # modify_* may change topology, so dirty both the old and new neighborhoods
+        for func_name in ['add_node','add_edge','add_cell',
+                          'modify_node','modify_edge','modify_cell']:
+            g.subscribe_after(func_name,self.on_grid_edit)
+        for func_name in ['delete_node','delete_edge','delete_cell',
+                          'modify_node','modify_edge','modify_cell']:
+            g.subscribe_before(func_name,self.on_grid_edit)
                           
         return g
     
-    def initialize_boundaries(self):
+    def initialize_boundaries(self,rigid=None):
+        """
+        rigid: optional [N,2,2] segments.  Curve segments exactly matching
+          these (in either direction) are not subdivided, and their vertices
+          become RIGID nodes.  Used to keep the shared boundary between
+          subdomains identical, see pave_subdomains().
+        """
+        if rigid is not None:
+            rigid_keys=set()
+            for a,b in np.asarray(rigid).reshape([-1,2,2]):
+                rigid_keys.add( (tuple(a),tuple(b)) )
+                rigid_keys.add( (tuple(b),tuple(a)) )
+            
         for curve_i,curve in enumerate(self.curves):
             curve_points,srcs=curve.upsample(self.scale,return_sources=True)
+            srcs=srcs.ravel()
+            fixed=self.HINT*np.ones(len(curve_points),'i4')
+
+            if rigid is not None:
+                # rigid segments, and vertices at either end of one
+                seg_rigid=np.array([ (tuple(a),tuple(b)) in rigid_keys
+                                     for a,b in zip(curve.points[:-1],curve.points[1:]) ])
+                vtx_rigid=np.zeros(len(curve.points),np.bool_)
+                vtx_rigid[:-1] |= seg_rigid
+                vtx_rigid[1:]  |= seg_rigid
+                if curve.closed:
+                    vtx_rigid[0] |= vtx_rigid[-1]
+                    
+                seg=np.searchsorted(curve.distances,srcs,side='right') - 1
+                at_vertex=(srcs==curve.distances[seg])
+                fixed[at_vertex & vtx_rigid[seg]]=self.RIGID
+                keep=at_vertex | ~seg_rigid[seg]
+                curve_points,srcs,fixed=curve_points[keep],srcs[keep],fixed[keep]
 
             # add the nodes in:
             # used to initialize as SLIDE
             nodes=[self.grid.add_node(x=curve_points[j],
                                       oring=curve_i+1,
                                       ring_f=srcs[j],
-                                      fixed=self.HINT)
+                                      fixed=fixed[j])
                    for j in range(len(curve_points))]
 
             if curve.closed:
@@ -1234,16 +1388,110 @@ class AdvancingFront(object):
                                     cells=[self.grid.UNMESHED,
                                            self.grid.UNDEFINED] )
 
-    def enumerate_sites(self):
+    def site_for_halfedge(self,j,orient):
+        """ Return the front site anchored on the given unmeshed half-edge,
+        or None if that half-edge does not define a site.
+        """
         raise Exception("Implement in subclass")
 
+    def enumerate_sites(self):
+        """ Scan the whole grid for sites.  choose_site() uses the incrementally
+        updated site_queue instead.
+        """
+        sites=[]
+        valid=(self.grid.edges['cells'][:,:]==self.grid.UNMESHED) 
+        valid[self.grid.edges['deleted']]=False
+        J,Orient = np.nonzero(valid)
+
+        for j,orient in zip(J,Orient):
+            site=self.site_for_halfedge(j,orient)
+            if site is not None:
+                sites.append(site)
+        return sites
+
+    # The front is kept as a priority queue of half-edges, keyed by
+    # (j,orient) with the site metric as the priority.  Grid edits mark
+    # nodes and edges dirty, and only half-edges near those are re-scored
+    # before the next site is chosen.
+    site_queue=None
+
+    def invalidate_sites(self):
+        """ Discard the site queue, forcing a full scan on the next choose_site().
+        Call this after editing grid arrays directly, bypassing the grid's
+        methods (and thus its listeners).
+        """
+        self.site_queue=None
+        self.dirty_nodes=set()
+        self.dirty_edges=set()
+
+    def on_grid_edit(self,grid,func_name,*a,**k):
+        if self.site_queue is None:
+            return # will be rebuilt from scratch anyway
+
+        if func_name.startswith('add_'):
+            idx=k['return_value']
+        elif a:
+            idx=a[0]
+        else:
+            idx=k[ {'node':'n','edge':'j','cell':'c'}[func_name.split('_')[-1]] ]
+
+        if func_name.endswith('_node'):
+            self.dirty_nodes.add(idx)
+        elif func_name.endswith('_edge'):
+            self.dirty_edges.add(idx)
+            self.dirty_nodes.update(grid.edges['nodes'][idx])
+        elif func_name.endswith('_cell'):
+            self.dirty_nodes.update(grid.cell_to_nodes(idx))
+
+    def update_site_queue(self):
+        """ Bring the site queue up to date with the grid, and return it.
+        """
+        g=self.grid
+        if self.site_queue is None:
+            self.site_queue=priority_queue.priorityDictionary()
+            self.dirty_nodes=set()
+            self.dirty_edges=set()
+            valid=(g.edges['cells'][:,:]==g.UNMESHED) 
+            valid[g.edges['deleted']]=False
+            for j,orient in zip(*np.nonzero(valid)):
+                self.score_halfedge(int(j),int(orient))
+            return self.site_queue
+
+        # a site depends on the nodes of its half-edge and their neighbors,
+        # so any edge touching a dirty node or one of its neighbors gets re-scored.
+        edges=self.dirty_edges
+        for n in self.dirty_nodes:
+            # deleting the last node or edge truncates the array
+            if n>=g.Nnodes() or g.nodes['deleted'][n]:
+                continue
+            for nbr in [n] + list(g.node_to_nodes(n)):
+                edges.update(g.node_to_edges(nbr))
+        for j in edges:
+            for orient in [0,1]:
+                self.score_halfedge(int(j),orient)
+
+        self.dirty_nodes=set()
+        self.dirty_edges=set()
+        return self.site_queue
+
+    def score_halfedge(self,j,orient):
+        key=(j,orient)
+        site=None
+        if ( (j<self.grid.Nedges()) and
+             (not self.grid.edges['deleted'][j]) and
+             (self.grid.edges['cells'][j,orient]==self.grid.UNMESHED) ):
+            site=self.site_for_halfedge(j,orient)
+        if site is not None:
+            self.site_queue[key]=site.metric()
+        elif key in self.site_queue:
+            del self.site_queue[key]
+        
     def choose_site(self):
-        sites=self.enumerate_sites()
-        if len(sites):
-            scores=[ site.metric()
-                     for site in sites ]
-            best=np.argmin( scores ) 
-            return sites[best]
+        queue=self.update_site_queue()
+        if len(queue):
+            # ties go to the lowest (j,orient), same as a full scan
+            j,orient=queue.smallest()
+            return self.site_for_halfedge(j,orient)
         else:
             return None
         
@@ -1510,7 +1758,155 @@ class AdvancingFront(object):
         fn=self.cost_function(n)
         return fn and fn(self.grid.nodes['x'][n])
 
+    def batch_cost(self,nodes,x=None,gradient=False):
+        """ Vectorized cost_function: costs for nodes, evaluated with
+        nodes relocated to x if given, holding all other nodes fixed.
+        with gradient=True, returns costs,gradients
+        """
+        raise Exception("Implement in subclass")
+
+    # 'serial': relax_node one at a time, 'jacobi': relax_nodes_jacobi
+    relax_mode='serial'
+    # trial step sizes for relax_nodes_jacobi, as fractions of the
+    # local scale.  the first which lowers a node's cost is taken.
+    relax_step_fractions=[0.2,0.1,0.05,0.02,0.01,0.005]
+
+    def color_nodes(self,nodes):
+        """ Greedy coloring of nodes such that no two nodes sharing
+        a cell get the same color.  Nodes of one color do not affect
+        each others' costs, and can be moved simultaneously.
+        Returns a list of arrays of nodes, one per color.
+        """
+        nodes=np.asarray(nodes)
+        colors={}
+        for n in nodes:
+            used=set()
+            for c in self.grid.node_to_cells(n):
+                for nbr in self.grid.cell_to_nodes(c):
+                    if nbr in colors:
+                        used.add(colors[nbr])
+            color=0
+            while color in used:
+                color+=1
+            colors[n]=color
+        node_colors=np.array([colors[n] for n in nodes],np.int32)
+        return [nodes[node_colors==color]
+                for color in range(node_colors.max()+1 if len(nodes) else 0)]
+
+    def relax_nodes_jacobi(self,nodes=None,iterations=3,cost_thresh=None):
+        """
+        Relax many nodes at once.  Nodes are colored such that nodes of a
+        single color are independent, then all nodes of a color are moved
+        together with a backtracking step down the gradient of the cost,
+        using batch_cost.  FREE nodes move in the plane, SLIDE nodes move
+        along their curve, and anything else stays put.
+
+        nodes: nodes to relax, defaults to all FREE and SLIDE nodes
+        iterations: number of sweeps through the colors
+        cost_thresh: nodes with cost below this are not moved.
+
+        Returns the largest cost of the nodes after relaxation.
+        """
+        fixed=self.grid.nodes['fixed']
+        if nodes is None:
+            nodes=np.nonzero( (fixed==self.FREE) | (fixed==self.SLIDE) )[0]
+        nodes=np.asarray(nodes)
+        nodes=nodes[ (fixed[nodes]==self.FREE) | (fixed[nodes]==self.SLIDE) ]
+        nodes=nodes[ np.array([len(self.grid.node_to_cells(n))>0
+                               for n in nodes],np.bool_) ]
+        if len(nodes)==0:
+            return 0.0
+
+        colors=self.color_nodes(nodes)
+        for it in range(iterations):
+            moved=0
+            for color_nodes in colors:
+                moved+=self.relax_color_jacobi(color_nodes,cost_thresh)
+            self.log.debug("Jacobi sweep %d moved %d nodes"%(it,moved))
+            if moved==0:
+                break
+        return np.nanmax(self.batch_cost(nodes))
+
+    def relax_color_jacobi(self,nodes,cost_thresh=None):
+        """ One backtracking gradient step for a set of independent nodes.
+        Returns the number of nodes moved.
+        """
+        x0=self.grid.nodes['x'][nodes].copy()
+        costs,grads=self.batch_cost(nodes,gradient=True)
+        local_length=self.scale(x0)
+
+        # step direction for FREE nodes is down the gradient
+        slide=self.grid.nodes['fixed'][nodes]==self.SLIDE
+        mag=utils.mag(grads)
+        active=np.isfinite(costs) & (mag>0)
+        if cost_thresh is not None:
+            active&= costs>cost_thresh
+        direc=np.zeros_like(x0)
+        direc[active]=-grads[active]/mag[active,None]
+
+        # SLIDE nodes step along their curve, in the direction which
+        # the tangential component of the gradient favors.
+        f0=self.grid.nodes['ring_f'][nodes]
+        rings=self.grid.nodes['oring'][nodes]-1
+        f_sign=np.zeros(len(nodes))
+        slide_limits={}
+        for i in np.nonzero(slide & active)[0]:
+            curve=self.curves[rings[i]]
+            h=1e-3*local_length[i]
+            tangent=curve(f0[i]+h) - curve(f0[i]-h)
+            f_sign[i]=-np.sign(np.dot(grads[i],tangent))
+            slide_limits[i]=self.find_slide_limits(nodes[i],3*local_length[i])
+
+        def slide_x(sel,f):
+            return np.array([self.curves[rings[i]](fi)
+                             for i,fi in zip(sel,f)]).reshape([-1,2])
+
+        new_x=x0.copy()
+        new_f=f0.copy()
+        accepted=np.zeros(len(nodes),np.bool_)
+        pending=active.copy()
+        for frac in self.relax_step_fractions:
+            if not np.any(pending):
+                break
+            trial_x=x0.copy()
+            trial_f=f0.copy()
+            step=frac*local_length
+            sel=np.nonzero(pending & ~slide)[0]
+            trial_x[sel]=x0[sel] + step[sel,None]*direc[sel]
+            sel=np.nonzero(pending & slide)[0]
+            trial_f[sel]=f0[sel] + f_sign[sel]*step[sel]
+            trial_x[sel]=slide_x(sel,trial_f[sel])
+
+            trial_costs=self.batch_cost(nodes,x=trial_x)
+            better=pending & (trial_costs<costs)
+            for i in np.nonzero(better & slide)[0]:
+                curve=self.curves[rings[i]]
+                lo,hi=slide_limits[i]
+                if not curve.is_forward(lo,trial_f[i],hi):
+                    better[i]=False
+            new_x[better]=trial_x[better]
+            new_f[better]=trial_f[better]
+            accepted|=better
+            pending&=~better
+
+        moved=0
+        for i in np.nonzero(accepted)[0]:
+            n=nodes[i]
+            cp=self.grid.checkpoint()
+            try:
+                if slide[i]:
+                    self.slide_node(n,new_f[i]-f0[i])
+                else:
+                    self.grid.modify_node(n,x=new_x[i])
+                moved+=1
+            except self.cdt.IntersectingConstraints as exc:
+                self.grid.revert(cp)
+                self.log.info("Relaxation caused intersection, reverting")
+        return moved
+
     def optimize_nodes(self,nodes,max_levels=3,cost_thresh=2):
+        if self.relax_mode=='jacobi':
+            return self.relax_nodes_jacobi(nodes,iterations=max_levels)
         max_cost=0
 
         for level in range(max_levels):
@@ -1573,7 +1969,7 @@ class AdvancingFront(object):
         except self.cdt.IntersectingConstraints as exc:
             self.grid.revert(cp)
             self.log.info("Relaxation caused intersection, reverting")
-            return cost
+            return cost(self.grid.nodes['x'][n])
         
     def relax_slide_node(self,n):
         cost_free=self.cost_function(n)
@@ -1838,25 +2234,16 @@ class AdvancingTriangles(AdvancingFront):
     def set_edge_scale(self,scale):
         self.scale=scale
 
-    def enumerate_sites(self):
-        sites=[]
-        # FIX: This doesn't scale!
-        valid=(self.grid.edges['cells'][:,:]==self.grid.UNMESHED) 
-        J,Orient = np.nonzero(valid)
+    def site_for_halfedge(self,j,orient):
+        he=self.grid.halfedge(j,orient)
+        he_nxt=he.fwd()
+        a=he.node_rev()
+        b=he.node_fwd()
+        bb=he_nxt.node_rev()
+        c=he_nxt.node_fwd()
+        assert b==bb
 
-        for j,orient in zip(J,Orient):
-            if self.grid.edges['deleted'][j]:
-                continue
-            he=self.grid.halfedge(j,orient)
-            he_nxt=he.fwd()
-            a=he.node_rev()
-            b=he.node_fwd()
-            bb=he_nxt.node_rev()
-            c=he_nxt.node_fwd()
-            assert b==bb
-
-            sites.append( TriangleSite(self,nodes=[a,b,c]) )
-        return sites
+        return TriangleSite(self,nodes=[a,b,c])
 
     def cost_function(self,n):
         local_length = self.scale( self.grid.nodes['x'][n] )
@@ -1889,6 +2276,33 @@ class AdvancingTriangles(AdvancingFront):
 
         return cost
 
+    def batch_cost(self,nodes,x=None,gradient=False):
+        nodes=np.asarray(nodes)
+        node_x=self.grid.nodes['x'][nodes]
+        local_length=self.scale(node_x)
+        if x is None:
+            x=node_x
+
+        owner=[]
+        cells=[]
+        for i,n in enumerate(nodes):
+            my_cells=self.grid.node_to_cells(n)
+            owner.extend( [i]*len(my_cells) )
+            cells.extend( my_cells )
+        owner=np.array(owner,np.int64)
+        cell_nodes=self.grid.cells['nodes'][np.array(cells,np.int64),:3]
+
+        # rotate each cell to start with its node, leaving the
+        # opposite edge ccw with the node on its left.
+        k=np.argmax(cell_nodes==nodes[owner][:,None],axis=1)
+        rows=np.arange(len(owner))
+        edges=np.c_[ cell_nodes[rows,(k+1)%3],
+                     cell_nodes[rows,(k+2)%3] ]
+        edge_points=self.grid.nodes['x'][edges]
+
+        return batch_point_cost(x,edge_points,owner,local_length,
+                                gradient=gradient)
+
 
 #### 
 
@@ -1977,28 +2391,22 @@ class AdvancingQuads(AdvancingFront):
             # if it's -99.
             if self.grid.edges['cells'][j,1-side]==self.grid.UNKNOWN:
                 self.grid.edges['cells'][j,1-side]=self.grid.UNDEFINED
+        # edited the arrays directly
+        self.invalidate_sites()
             
     def orient_quad_edge(self,j,orient):
-        self.grid.edges['para'][j]=orient
+        self.grid.modify_edge(j,para=orient)
 
-    def enumerate_sites(self):
-        sites=[]
-        # FIX: This doesn't scale!
-        valid=(self.grid.edges['cells'][:,:]==self.grid.UNMESHED)& (self.grid.edges['para']!=0)[:,None]
-        J,Orient = np.nonzero(valid)
+    def site_for_halfedge(self,j,orient):
+        if self.grid.edges['para'][j]==0:
+            return None
+        he=self.grid.halfedge(j,orient)
+        a=he.rev().node_rev()
+        b=he.node_rev()
+        c=he.node_fwd()
+        d=he.fwd().node_fwd()
 
-        for j,orient in zip(J,Orient):
-            if self.grid.edges['deleted'][j]:
-                continue
-            he=self.grid.halfedge(j,orient)
-            he_nxt=he.fwd()
-            a=he.rev().node_rev()
-            b=he.node_rev()
-            c=he.node_fwd()
-            d=he.fwd().node_fwd()
-
-            sites.append( QuadSite(self,nodes=[a,b,c,d]) )
-        return sites
+        return QuadSite(self,nodes=[a,b,c,d])
 
     def cost_function(self,n):
         local_para = self.para_scale
@@ -2222,3 +2630,205 @@ class DTChooseStrategy(DTNode):
                         for n in nodes] )
         self.child_post[i]=cost
         return True
+
+
+## Domain decomposition
+
+def default_cuts(rings,count,scale=None,samples=10000):
+    """
+    Straight cut lines which divide the polygon given by rings (exterior
+    followed by islands) into count pieces, across the longer dimension of
+    its bounding box.
+    scale: field giving the target edge length.  If given, pieces get
+      roughly equal numbers of cells, i.e. equal integrals of 1/scale**2,
+      estimated from about samples points on a regular grid.  Otherwise
+      pieces get equal area.
+    Returns a list of [2,2] arrays.
+    """
+    poly=geometry.Polygon(rings[0],rings[1:])
+    xmin,ymin,xmax,ymax=poly.bounds
+    axis=0 if (xmax-xmin)>=(ymax-ymin) else 1
+    lo,hi=[ (xmin,xmax), (ymin,ymax) ][axis]
+    pad=0.01*max(xmax-xmin,ymax-ymin)
+
+    if scale is None:
+        total=poly.area
+        def weight_below(c):
+            if axis==0:
+                box=geometry.box(xmin-pad,ymin-pad,c,ymax+pad)
+            else:
+                box=geometry.box(xmin-pad,ymin-pad,xmax+pad,c)
+            return poly.intersection(box).area
+    else:
+        # cell density on a regular grid of sample points
+        from matplotlib.path import Path
+        h=np.sqrt(poly.area/float(samples))
+        X,Y=np.meshgrid(np.arange(xmin+0.5*h,xmax,h),
+                        np.arange(ymin+0.5*h,ymax,h))
+        X=np.c_[X.ravel(),Y.ravel()]
+        inside=Path(rings[0]).contains_points(X)
+        for island in rings[1:]:
+            inside&=~Path(island).contains_points(X)
+        X=X[inside]
+        weights=h**2/np.asarray(scale(X),np.float64)**2
+        order=np.argsort(X[:,axis])
+        coords=X[order,axis]
+        cumul=np.concatenate( [[0],np.cumsum(weights[order])] )
+        total=cumul[-1]
+        def weight_below(c):
+            return cumul[np.searchsorted(coords,c)]
+
+    cuts=[]
+    for k in range(1,count):
+        target=total*k/float(count)
+        a,b=lo,hi
+        for it in range(40): # bisection
+            c=0.5*(a+b)
+            if weight_below(c)<target:
+                a=c
+            else:
+                b=c
+        c=0.5*(a+b)
+        if axis==0:
+            cuts.append( np.array([[c,ymin-pad],[c,ymax+pad]]) )
+        else:
+            cuts.append( np.array([[xmin-pad,c],[xmax+pad,c]]) )
+    return cuts
+
+def split_domain(rings,scale,cuts):
+    """
+    Split the polygon given by rings (exterior followed by islands) along 
+    cuts, a list of polylines which cross the polygon, and should not cross
+    each other.  Cut lines are first sampled at the scale, so that subdomains
+    share those nodes.
+
+    Returns a list of subdomains, each a list of rings (exterior followed by
+    islands), and an [N,2,2] array of the segments shared between subdomains.
+    """
+    poly=geometry.Polygon(rings[0],rings[1:])
+    lines=[]
+    for cut in cuts:
+        cut=np.asarray(cut,np.float64)
+        points=Curve(cut,closed=False).upsample(scale)
+        lines.append( np.concatenate( [points,cut[-1:]] ) )
+
+    pieces=[poly]
+    for line in lines:
+        line=geometry.LineString(line)
+        pieces=[sub for piece in pieces
+                for sub in ops.split(piece,line).geoms]
+
+    subdomains=[]
+    for piece in pieces:
+        subdomains.append( [np.array(piece.exterior.coords)[:-1]] +
+                           [np.array(interior.coords)[:-1]
+                            for interior in piece.interiors] )
+
+    def seg_counts():
+        counts={}
+        for sub in subdomains:
+            for ring in sub:
+                for a,b in utils.circular_pairs(ring):
+                    key=tuple(sorted([tuple(a),tuple(b)]))
+                    counts[key]=counts.get(key,0)+1
+        return counts
+    def is_shared(counts,a,b):
+        return counts[tuple(sorted([tuple(a),tuple(b)]))]>1
+
+    # where a cut meets the boundary, the nearest cut sample may be
+    # arbitrarily close.  Drop those samples, based only on the shared
+    # segments, so that subdomains on either side drop the same vertices.
+    counts=seg_counts()
+    drop=set()
+    for sub in subdomains:
+        for ring in sub:
+            N=len(ring)
+            shared_next=np.array([ is_shared(counts,ring[i],ring[(i+1)%N])
+                                   for i in range(N)])
+            shared_prev=np.roll(shared_next,1)
+            interior=shared_next&shared_prev # vertex along a cut
+            cut_end=shared_next^shared_prev # where a cut meets the boundary
+            for i in np.nonzero(interior)[0]:
+                for nbr in [(i-1)%N,(i+1)%N]:
+                    if cut_end[nbr] and utils.dist(ring[i]-ring[nbr]) < 0.5*scale(ring[i]):
+                        drop.add(tuple(ring[i]))
+    if drop:
+        subdomains=[ [ np.array([xy for xy in ring if tuple(xy) not in drop])
+                       for ring in sub]
+                     for sub in subdomains]
+        counts=seg_counts()
+        
+    # segments which appear in more than one subdomain, i.e. along the cuts
+    shared=np.array( [seg for seg in counts if counts[seg]>1] ).reshape([-1,2,2])
+    return subdomains,shared
+
+def _pave_subdomain(args):
+    """ worker for pave_subdomains(), returns nodes and cells of the
+    subdomain grid.
+    """
+    af_class,rings,shared,scale=args
+    af=af_class()
+    af.set_edge_scale(scale)
+    af.add_curve(rings[0],interior=False)
+    for ring in rings[1:]:
+        af.add_curve(ring,interior=True)
+    af.initialize_boundaries(rigid=shared)
+    if not af.loop():
+        raise StrategyFailed("Failed to pave subdomain")
+
+    g=af.grid
+    cells=g.cells['nodes'][~g.cells['deleted']]
+    nodes=np.unique(cells[cells>=0])
+    node_map=np.zeros(g.Nnodes(),'i4')-1
+    node_map[nodes]=np.arange(len(nodes))
+    cells=np.where(cells>=0,node_map[cells.clip(0)],-1)
+    return g.nodes['x'][nodes],cells
+
+def pave_subdomains(rings,scale,cuts=None,count=None,processes=None,
+                    af_class=None):
+    """
+    Pave a polygon by splitting it into subdomains, paving those concurrently,
+    and merging the results.
+
+    rings: exterior ring followed by any islands, each [N,2]
+    scale: field giving the target edge length
+    cuts: list of polylines crossing the polygon along which to split it.
+      Defaults to count-1 straight cuts from default_cuts(), placed so that
+      subdomains have roughly equal numbers of cells under scale.
+    count: number of subdomains when cuts is not given, defaulting to the
+      number of processes.
+    processes: number of worker processes, defaulting to the number of CPUs.
+      1 paves the subdomains in order, in this process.
+    af_class: AdvancingFront subclass, defaults to AdvancingTriangles.
+
+    Nodes along the cuts are sampled once and held fixed, so the subdomain
+    grids share them exactly and are stitched with add_grid(merge_nodes='auto').
+    Returns an UnstructuredGrid.
+    """
+    import multiprocessing
+    af_class=af_class or AdvancingTriangles
+    if processes is None:
+        processes=multiprocessing.cpu_count()
+    if cuts is None:
+        cuts=default_cuts(rings,count or processes,scale=scale)
+
+    subdomains,shared=split_domain(rings,scale,cuts)
+    log.info("Paving %d subdomains"%len(subdomains))
+
+    tasks=[ (af_class,sub,shared,scale) for sub in subdomains]
+    if processes>1 and len(tasks)>1:
+        pool=multiprocessing.Pool(min(processes,len(tasks)))
+        try:
+            results=pool.map(_pave_subdomain,tasks)
+        finally:
+            pool.close()
+    else:
+        results=[_pave_subdomain(task) for task in tasks]
+
+    max_sides=max( [cells.shape[1] for nodes,cells in results] )
+    g=unstructured_grid.UnstructuredGrid(max_sides=max_sides)
+    for nodes,cells in results:
+        sub=unstructured_grid.UnstructuredGrid(points=nodes,cells=cells,max_sides=max_sides)
+        sub.make_edges_from_cells()
+        g.add_grid(sub,merge_nodes='auto')
+    return g
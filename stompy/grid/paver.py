@@ -4,6 +4,7 @@ import logging
 log=logging.getLogger('stompy.grid.paver')
 
 import sys, os
+import functools
 
 import pickle
 
@@ -40,6 +41,7 @@ from . import live_dt
 paving_base = live_dt.LiveDtGrid
 
 from .paver_opt_mixin import OptimizeGridMixin
+from .front import batch_point_cost
 
 def my_fmin(f,x0,args=(),xtol=1e-4,disp=0):
     # The original, basic fmin -
@@ -67,6 +69,7 @@ def CIter_expand(clist,d_prv,d,d_nxt):
     return clist.find_iter(d_prv,d,d_nxt)
 CIter_expand.__safe_for_unpickling__ = True
 
+@functools.total_ordering
 class CIter(object):
     def __init__(self,data,prv,nxt,clist):
         self.data = data
@@ -83,6 +86,12 @@ class CIter(object):
     def __str__(self):
         return "[%d-%d-%d]"%(self.prv.data,self.data,self.nxt.data)
 
+    def __lt__(self,other):
+        # CList's heap holds (metric,CIter) pairs, so ties fall through to
+        # comparing iters.  py2 ordered arbitrary objects by address, keep that.
+        # the other comparisons come from total_ordering, and __eq__ stays identity.
+        return id(self) < id(other)
+
     ### Pickle API
     # really we want the clist to exist, and then we just need to pick
     # the right CIter out of the clist.
@@ -1381,7 +1390,8 @@ class Paving(paving_base,OptimizeGridMixin):
     def boundary_slider(self,ri,alpha,beta=0.0):
         len_b = len(self.original_rings[ri])
 
-        i = int(np.floor(alpha)) % len_b
+        # alpha may come from the optimizer as a 1-element array
+        i = int(np.floor(alpha).item()) % len_b
         frac = (alpha - i) % 1.0
         
         ip1 = (i+1) % len_b
@@ -5153,24 +5163,78 @@ class Paving(paving_base,OptimizeGridMixin):
     def cost_for_point(self,i):
         edge_points,local_length = self.cost_args_for_node(i)
         return one_point_cost( self.points[i,:2], edge_points, local_length )
+
+    def costs_for_points(self,nodes=None,x=None,gradient=False):
+        """ vectorized cost_for_point, for all points by default.
+        points without cells get a nan cost, and the density is only
+        evaluated for points with cells.
+        x: [len(nodes),2] locations at which to evaluate the costs, with
+          all other points held fixed.  The local length is still taken
+          at the current location, as in relax_one.
+        gradient: if True, return costs,gradients
+        """
+        if nodes is None:
+            nodes = np.arange(self.Npoints())
+        nodes = np.asarray(nodes)
+
+        owner = []
+        cells = []
+        for i,n in enumerate(nodes):
+            try:
+                my_cells = list(self.pnt2cells(n))
+            except KeyError: # never part of a cell
+                my_cells = []
+            owner.extend( [i]*len(my_cells) )
+            cells.extend( my_cells )
+        owner = np.array(owner,np.int64)
+        edges = self.cells[np.array(cells,np.int64)].reshape([-1,3])
+
+        # rotate each cell to start with its point, as in cost_args_for_node
+        k = np.argmax(edges==nodes[owner][:,None],axis=1)
+        rows = np.arange(len(owner))
+        edges = np.c_[ edges[rows,(k+1)%3], edges[rows,(k+2)%3] ]
+        edge_points = self.points[edges][...,:2]
+
+        # deleted points and points without cells may not have a
+        # sensible location to evaluate density at.
+        has_cells = np.bincount(owner,minlength=len(nodes))>0
+        local_length = np.nan*np.ones(len(nodes))
+        if np.any(has_cells):
+            local_length[has_cells] = self.density( self.points[nodes[has_cells],:2] )
+
+        if x is None:
+            x = self.points[nodes,:2]
+        return batch_point_cost(x,edge_points,owner,local_length,gradient=gradient)
+
+    # 'serial': safe_relax_one for each node in turn, 'jacobi': relax_jacobi()
+    relax_mode = 'serial'
+    # trial step sizes for relax_jacobi, as fractions of the local length.
+    # the first which lowers a node's cost is taken.
+    relax_step_fractions = [0.2,0.1,0.05,0.02,0.01,0.005]
         
     def relax(self,plot_progress=False,threshold=None):
         # loop over all the points and try to optimize them with the minimization routines
 
         if threshold is None:
             threshold = self.cost_threshold
+
+        if self.relax_mode == 'jacobi':
+            self.relax_jacobi(threshold)
+            if plot_progress:
+                self.plot()
+            self.step += 1
+            return
             
         # r = random(self.Npoints())
         # ordering = argsort(r)
         # ordering = range(self.Npoints())[::-1]
-        costs = [self.cost_for_point(i) for i in range(self.Npoints())]
-        
-        ordering = argsort(costs)[::-1]
+        costs = self.costs_for_points()
+
+        # deleted and cell-less points have nan cost, and are skipped
+        valid = np.nonzero( np.isfinite(costs) & (costs >= threshold) )[0]
+        ordering = valid[np.argsort(costs[valid])[::-1]]
         
         for i in ordering:
-            if costs[i] < threshold:
-                continue
-            
             if len(self.pnt2edges(i)) == 0:
                 continue
             
@@ -5180,6 +5244,78 @@ class Paving(paving_base,OptimizeGridMixin):
             
         self.step += 1
 
+    def color_points(self,nodes):
+        """ Greedy coloring of nodes such that no two nodes sharing
+        a cell get the same color, so nodes of one color can be moved
+        simultaneously.  Returns a list of arrays of nodes, one per color.
+        """
+        nodes = np.asarray(nodes)
+        colors = {}
+        for n in nodes:
+            used = set()
+            for c in self.pnt2cells(n):
+                for nbr in self.cells[c]:
+                    if nbr in colors:
+                        used.add(colors[nbr])
+            color = 0
+            while color in used:
+                color += 1
+            colors[n] = color
+        node_colors = np.array([colors[n] for n in nodes],np.int32)
+        return [nodes[node_colors==color]
+                for color in range(node_colors.max()+1 if len(nodes) else 0)]
+
+    def relax_jacobi(self,threshold):
+        """ Jacobi version of relax: FREE nodes with a cost above threshold
+        are colored so that nodes of one color are independent, and all
+        nodes of a color take a backtracking step down the gradient of
+        their cost together.  SLIDE nodes are then relaxed one at a time
+        with safe_relax_one, as in relax.
+        """
+        costs = self.costs_for_points()
+        stat = self.node_data[:,self.STAT]
+        over = np.isfinite(costs) & (costs>=threshold)
+
+        free = np.nonzero(over & (stat==self.FREE))[0]
+        for color_nodes in self.color_points(free):
+            self.relax_color_jacobi(color_nodes)
+
+        for i in np.nonzero(over & (stat==self.SLIDE))[0]:
+            if len(self.pnt2edges(i)) == 0:
+                continue
+            self.safe_relax_one(i)
+
+    def relax_color_jacobi(self,nodes):
+        """ One backtracking gradient step for a set of independent FREE
+        nodes.  Returns the number of nodes moved.
+        """
+        x0 = self.points[nodes,:2].copy()
+        costs,grads = self.costs_for_points(nodes,gradient=True)
+        local_length = self.density(x0)
+
+        mag = np.sqrt( (grads**2).sum(axis=1) )
+        pending = np.isfinite(costs) & (mag>0)
+        direc = np.zeros_like(x0)
+        direc[pending] = -grads[pending]/mag[pending,None]
+
+        new_x = x0.copy()
+        for frac in self.relax_step_fractions:
+            if not np.any(pending):
+                break
+            trial_x = x0 + (frac*local_length)[:,None]*direc
+            trial_costs = self.costs_for_points(nodes,x=trial_x)
+            better = pending & (trial_costs<costs)
+            new_x[better] = trial_x[better]
+            pending &= ~better
+
+        moved = 0
+        for i in np.nonzero( np.any(new_x!=x0,axis=1) )[0]:
+            new_pnt = self.points[nodes[i]].copy()
+            new_pnt[:2] = new_x[i]
+            self.move_node(nodes[i],new_pnt)
+            moved += 1
+        return moved
+
     def splice_in_grid(self,gridB,join_tolerance=0.25):
         """
         gridB: TriGrid instance to be inserted into self
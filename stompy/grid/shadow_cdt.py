@@ -54,10 +54,11 @@ class ShadowCDT(exact_delaunay.Triangulation):
             self.nodemap_g_to_local[gn]=n
 
         # Edges:
-        for ji,j in enumerate(g.valid_edge_iter()):
-            if ji%5000==0:
-                log.info("Edges: %d/%d"%(ji,g.Nedges()))
-            self.before_add_edge(g,'add_edge',nodes=g.edges['nodes'][j])
+        j_valid=~g.edges['deleted']
+        g_to_local=np.zeros(g.Nnodes(),np.int32)
+        g_to_local[pidxs]=np.arange(len(pidxs))
+        log.info("Edges: %d"%j_valid.sum())
+        self.add_constraints(g_to_local[g.edges['nodes'][j_valid]])
 
     def before_add_node(self,g,func_name,**k):
         pass # no checks quite yet
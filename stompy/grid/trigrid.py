@@ -168,6 +168,206 @@ class NoSuchCellError(TriGridError):
 # of altering the points array
 points_dat_cache = {}
 
+# Text grid files are also cached in binary form, see cached_read(), keyed
+# by the path, size and modification time of the text file.  The cache files
+# go into a per-user cache directory, so that reading a grid never writes
+# into the data directory.  With binary_cache_dir=None they go alongside the
+# originals.  Set binary_cache=False to always parse the text.
+binary_cache = True
+binary_cache_dir = os.path.join( os.environ.get('XDG_CACHE_HOME',
+                                                os.path.join(os.path.expanduser('~'),'.cache')),
+                                 'stompy','grids')
+
+def read_text_table(fn,ncols=None,min_cols=None):
+    """ Read a whitespace-delimited text file into an array of byte strings,
+    [Nrows,ncols], parsing the whole file at once rather than line by line.
+    Lines with exactly ncols entries are kept, or if min_cols is given,
+    lines with at least min_cols entries, truncated to min_cols.
+    The caller converts with astype().
+    """
+    with open(fn,'rb') as fp:
+        text = fp.read()
+    tokens = np.array( text.split() )
+
+    # count the tokens on each line, without a python loop over lines
+    chars = np.frombuffer(text,np.uint8)
+    newline = (chars==ord('\n'))
+    blank = newline | (chars==ord(' ')) | (chars==ord('\t')) | (chars==ord('\r'))
+    starts = ~blank
+    starts[1:] &= blank[:-1] # first character of a token
+    line_of_char = np.cumsum(newline) - newline # newline belongs to its line
+    nlines = line_of_char[-1]+1 if len(chars) else 0
+    counts = np.bincount(line_of_char[starts],minlength=nlines)
+
+    if ncols is not None:
+        keep = (counts==ncols)
+        width = ncols
+    else:
+        keep = (counts>=min_cols)
+        width = min_cols
+
+    if np.all(counts==width):
+        # common case - every line is a row
+        return tokens.reshape([-1,width])
+
+    # index of the first token of each line
+    starts = np.cumsum(counts) - counts
+    cols = np.arange(width)
+    return tokens[ starts[keep,None] + cols[None,:] ]
+
+def cache_prefix(fn):
+    """ path prefix for binary cache files of the text file fn.
+    Alongside fn if binary_cache_dir is None, otherwise in binary_cache_dir
+    under a name unique to the absolute path of fn.
+    """
+    if binary_cache_dir is None:
+        return fn
+    import hashlib
+    abs_fn = os.path.abspath(fn)
+    digest = hashlib.sha1(abs_fn.encode('utf-8')).hexdigest()[:16]
+    return os.path.join(binary_cache_dir,
+                        "%s-%s"%(os.path.basename(abs_fn),digest))
+
+def cached_read(fn,parser,mmap=False):
+    """ Read a dict of arrays from the text file fn via parser(fn).  
+    If binary_cache is set, the arrays are saved as <prefix>.<name>.npy,
+    keyed by the path, size and mtime of fn, so later reads skip the parsing
+    until fn changes.
+    <prefix> is fn itself, or a name in binary_cache_dir if that is set,
+    see cache_prefix().  With mmap=True cached arrays are memory mapped
+    copy-on-write, so processes reading the same grid share memory, and
+    modifications stay in memory.
+    """
+    if not binary_cache:
+        return parser(fn)
+
+    st = os.stat(fn)
+    key = "%s %d %r"%(os.path.abspath(fn),st.st_size,st.st_mtime)
+    prefix = cache_prefix(fn)
+    key_fn = prefix + '.cache'
+    mmap_mode = 'c' if mmap else None
+
+    try:
+        with open(key_fn,'rt') as fp:
+            cache_key,names = fp.read().split("\n")[:2]
+        if cache_key == key:
+            return dict( [ (name,np.load(prefix+'.%s.npy'%name,mmap_mode=mmap_mode))
+                           for name in names.split() ] )
+    except (IOError,OSError,ValueError):
+        pass # missing or stale cache
+
+    arrays = parser(fn)
+
+    # write to temporary names and rename, since other processes may
+    # be reading the same grid.  the key is written last.
+    try:
+        if binary_cache_dir is not None and not os.path.exists(binary_cache_dir):
+            os.makedirs(binary_cache_dir)
+        for name in arrays:
+            tmp_fn = prefix+'.%s.npy.%d'%(name,os.getpid())
+            with open(tmp_fn,'wb') as fp:
+                np.save(fp,arrays[name])
+            os.rename(tmp_fn,prefix+'.%s.npy'%name)
+        tmp_fn = key_fn+'.%d'%os.getpid()
+        with open(tmp_fn,'wt') as fp:
+            fp.write(key + "\n" + " ".join(arrays.keys()) + "\n")
+        os.rename(tmp_fn,key_fn)
+    except (IOError,OSError):
+        pass # read-only location - just go without
+    return arrays
+
+def parse_suntans_points(fn):
+    tab = read_text_table(fn,min_cols=2)
+    return {'points':tab.astype(np.float64)}
+
+def parse_suntans_cells(fn):
+    # voronoi center, three point indices, three neighbors
+    tab = read_text_table(fn,ncols=8)
+    return {'vcenters':tab[:,:2].astype(np.float64),
+            'cells':tab[:,2:5].astype(np.int64)}
+
+def parse_suntans_edges(fn):
+    # point_i, point_i, marker, cell_i, cell_i
+    tab = read_text_table(fn,ncols=5)
+    return {'edges':tab.astype(np.int64)}
+
+
+def match_cells(ref_cells,cells):
+    """ Vectorized matching of cells by their nodes.  ref_cells and cells
+    are [N,3] arrays of node indices, in any order within a row.
+    Returns for each row of cells the index of the ref_cells row with the
+    same nodes, or -1 if there is none.  Rows of ref_cells with negative
+    nodes (deleted cells) are never matched.
+    """
+    ref_cells = np.sort(np.asarray(ref_cells),axis=1).astype(np.int64)
+    cells = np.sort(np.asarray(cells).reshape([-1,3]),axis=1).astype(np.int64)
+    valid = np.nonzero( ref_cells[:,0]>=0 )[0]
+    ref_cells = ref_cells[valid]
+
+    n = 1+max(ref_cells.max() if len(ref_cells) else 0,
+              cells.max() if len(cells) else 0)
+    if n < 2**21:
+        # pack the three node indices into one int64
+        def keys(c):
+            return (c[:,0]*n + c[:,1])*n + c[:,2]
+    else:
+        # compare the raw bytes of each row
+        def keys(c):
+            c = np.ascontiguousarray(c)
+            return c.view(np.dtype((np.void,c.dtype.itemsize*3)))[:,0]
+    ref_keys = keys(ref_cells)
+    order = np.argsort(ref_keys)
+    ref_keys = ref_keys[order]
+    query = keys(cells)
+
+    result = -np.ones(len(cells),np.int64)
+    if len(ref_keys):
+        pos = np.searchsorted(ref_keys,query).clip(0,len(ref_keys)-1)
+        found = (ref_keys[pos]==query)
+        result[found] = valid[order[pos[found]]]
+    return result
+
+
+class CellLocator(object):
+    """ Batch version of TriGrid.closest_cell(): for each query point take
+    the closest node, and of the cells using that node, the one with the
+    closest voronoi center.  Build once, and query many points at a time.
+    The grid should not be modified while the locator is in use.
+    """
+    def __init__(self,g):
+        from scipy.spatial import cKDTree
+        cells = g.cells[:,:3]
+        valid = np.nonzero( cells[:,0]>=0 )[0]
+        self.vcenters = g.vcenters()
+        self.kdtree = cKDTree(g.points[:,:2])
+
+        # padded table of the cells around each node, -1 for none
+        nodes = cells[valid].ravel()
+        node_cells = np.repeat(valid,3)
+        order = np.argsort(nodes,kind='mergesort')
+        nodes = nodes[order]
+        node_cells = node_cells[order]
+        counts = np.bincount(nodes,minlength=g.Npoints())
+        first = np.cumsum(counts) - counts
+        slot = np.arange(len(nodes)) - first[nodes]
+        self.node_cells = -np.ones( (g.Npoints(),max(1,counts.max() if len(counts) else 1)),
+                                    np.int64)
+        self.node_cells[nodes,slot] = node_cells
+
+    def __call__(self,xy):
+        """ xy: [...,2] array of points.  Returns an array of cell indices,
+        with -1 where the closest node is not part of any cell.
+        """
+        xy = np.asarray(xy,np.float64)
+        shape = xy.shape[:-1]
+        xy = xy.reshape([-1,2])
+        nodes = self.kdtree.query(xy)[1]
+        cands = self.node_cells[nodes]
+        dists = ( (xy[:,None,:] - self.vcenters[cands.clip(0)])**2 ).sum(axis=2)
+        dists[cands<0] = np.inf
+        best = cands[ np.arange(len(xy)), np.argmin(dists,axis=1) ]
+        return best.reshape(shape)
+
 
 class TriGrid(object):
     index = None
@@ -295,14 +495,8 @@ class TriGrid(object):
             if not self.readonly:
                 self.points = self.points.copy()
         else:
-            points_fp = open(points_fn)
-
-            pnts = []
-            for line in points_fp:
-                coords = list([float(s) for s in line.split()])
-                if len(coords) >= 2:
-                    pnts.append(coords[:2])
-            self.points = np.array(pnts)
+            self.points = cached_read(points_fn,parse_suntans_points,
+                                      mmap=self.readonly)['points']
             if use_cache:
                 if self.readonly:
                     points_dat_cache[points_fn] = self.points
@@ -311,19 +505,9 @@ class TriGrid(object):
 
         # read the cells:
         cell_fname = self.file_path("cells")
-            
-        cells_fp = open(cell_fname)
-        vcenters = []
-        cells = []
-        for line in cells_fp:
-            line = line.split()
-            if len(line)==8:
-                # first two are voronoi center coordinates
-                vcenters.append( list([float(s) for s in line[:2]]))
-                # then three point indices:
-                cells.append( list([int(s) for s in line[2:5]]) )
-        self._vcenters = np.array(vcenters)
-        self.cells = np.array(cells)
+        cell_data = cached_read(cell_fname,parse_suntans_cells,mmap=self.readonly)
+        self._vcenters = cell_data['vcenters']
+        self.cells = cell_data['cells']
 
         self.cell_mask = np.ones( len(self.cells) )
         
@@ -334,14 +518,8 @@ class TriGrid(object):
 
         # edges are stored just as in the data file:
         #  point_i, point_i, marker, cell_i, cell_i
-        edges_fp = open(edge_fname,"rt")
-
-        edges = []
-        for line in edges_fp:
-            line = line.split()
-            if len(line) == 5:
-                edges.append( list([int(s) for s in line]) )
-        self.edges = np.array(edges)
+        self.edges = cached_read(edge_fname,parse_suntans_edges,
+                                 mmap=self.readonly)['edges']
 
     def read_gmsh(self,gmsh_basename):
         """ 
@@ -1538,6 +1716,12 @@ class TriGrid(object):
                 return list(c)[0]
         except KeyError:
             raise NoSuchCellError()
+
+    def find_cells(self,nodes):
+        """ vectorized find_cell: nodes is [N,3], returns the cell for each
+        row, or -1 where there is no such cell.
+        """
+        return match_cells(self.cells,nodes)
             
     def cell_neighbors(self,cell_id,adjacent_only=0):
         """ return array of cell_ids for neighbors of this
@@ -1843,6 +2027,10 @@ class TriGrid(object):
             # print "Closest cell was %f [m] away"%dist
         return chosen
         
+    def cell_locator(self):
+        """ returns a CellLocator for batch queries equivalent to closest_cell() """
+        return CellLocator(self)
+
     def set_edge_markers(self,pnt1,pnt2,marker):
         """ Find the nodes closest to each of the two points,
         Search for the shortest path between them on the boundary.
@@ -23,6 +23,7 @@ import six
 import numpy as np
 from numpy.linalg import norm
 from collections import defaultdict
+from contextlib import contextmanager
 
 from shapely import wkt,geometry,wkb,ops
 import matplotlib.pyplot as plt
@@ -164,6 +165,180 @@ def rec_to_dict(r):
         d[name]=r[name]
     return d
 
+
+class NodeAdjacency(object):
+    """
+    One-to-many map from node index to element (edge or cell) indices,
+    stored in compressed sparse row (CSR) form: the elements of node n
+    are indices[offsets[n]:offsets[n+1]].
+
+    Incremental edits after the bulk build go to a small overlay of
+    python lists for just the nodes which were touched, so that
+    add_edge(), delete_cell(), etc. stay cheap.  compact() folds the
+    overlay back into the CSR arrays.
+    """
+    def __init__(self,offsets,indices):
+        self.offsets=offsets
+        self.indices=indices
+        self.modified={} # node => list of elements, supercedes CSR row
+
+    @classmethod
+    def from_pairs(cls,rows,values,Nrows):
+        """
+        rows: node index for each entry
+        values: element index for each entry
+        Nrows: number of nodes.
+        Within a node, elements retain the order they have in values.
+        """
+        rows=np.asarray(rows,np.int64)
+        values=np.asarray(values,np.int32)
+        order=np.argsort(rows,kind='mergesort')
+        counts=np.bincount(rows,minlength=Nrows)
+        offsets=np.zeros(Nrows+1,np.int64)
+        np.cumsum(counts,out=offsets[1:])
+        return cls(offsets,values[order])
+
+    def Nrows(self):
+        return len(self.offsets)-1
+
+    def static_row(self,n):
+        if n<self.Nrows():
+            return self.indices[self.offsets[n]:self.offsets[n+1]].tolist()
+        else:
+            return []
+
+    def __getitem__(self,n):
+        try:
+            return self.modified[n]
+        except KeyError:
+            return self.static_row(n)
+
+    def __delitem__(self,n):
+        self.modified[n]=[]
+
+    def _mutable_row(self,n):
+        if n not in self.modified:
+            self.modified[n]=self.static_row(n)
+        return self.modified[n]
+
+    def append(self,n,value):
+        self._mutable_row(n).append(value)
+
+    def remove(self,n,value):
+        self._mutable_row(n).remove(value)
+
+    def compact(self,Nrows=None):
+        """
+        Fold the overlay into the CSR arrays, and optionally extend the
+        table to Nrows nodes.
+        """
+        if Nrows is None:
+            Nrows=self.Nrows()
+        Nrows=max(Nrows,self.Nrows(),
+                  1+max(self.modified.keys()) if self.modified else 0)
+        counts=np.zeros(Nrows,np.int64)
+        counts[:self.Nrows()]=np.diff(self.offsets)
+        for n,row in six.iteritems(self.modified):
+            counts[n]=len(row)
+        offsets=np.zeros(Nrows+1,np.int64)
+        np.cumsum(counts,out=offsets[1:])
+        indices=np.zeros(offsets[-1],np.int32)
+
+        # unmodified rows are copied over en masse
+        keep=np.ones(self.Nrows(),np.bool_)
+        for n in self.modified:
+            if n<self.Nrows():
+                keep[n]=False
+        keep=np.nonzero(keep)[0]
+        _,src=self._expand_positions(self.offsets,keep)
+        _,dst=self._expand_positions(offsets,keep)
+        indices[dst]=self.indices[src]
+        for n,row in six.iteritems(self.modified):
+            indices[offsets[n]:offsets[n+1]]=row
+
+        self.offsets=offsets
+        self.indices=indices
+        self.modified={}
+
+    @staticmethod
+    def _expand_positions(offsets,rows):
+        """
+        for an array of rows, return (query index, position into indices)
+        for every entry of those rows.
+        """
+        rows=np.asarray(rows,np.int64)
+        starts=offsets[rows]
+        counts=offsets[rows+1]-starts
+        qi=np.repeat(np.arange(len(rows)),counts)
+        within=np.arange(counts.sum()) - np.repeat(np.cumsum(counts)-counts,counts)
+        return qi,np.repeat(starts,counts)+within
+
+    def expand(self,rows):
+        """
+        rows: array of node indices, all less than Nrows(), and the
+        table must be compact.
+        returns (query index, position into self.indices) for each element
+        of each requested row.
+        """
+        assert not self.modified
+        return self._expand_positions(self.offsets,rows)
+
+    def padded(self,rows,fill=-1):
+        """
+        return [len(rows),max count] array of elements for each of rows,
+        padded with fill.  Table must be compact.
+        """
+        rows=np.asarray(rows,np.int64)
+        qi,pos=self.expand(rows)
+        counts=np.bincount(qi,minlength=len(rows))
+        K=counts.max() if len(rows) else 0
+        result=np.zeros( (len(rows),K), np.int32)
+        result[...]=fill
+        col=np.arange(len(qi)) - np.repeat(np.cumsum(counts)-counts,counts)
+        result[qi,col]=self.indices[pos]
+        return result
+
+class BulkEdit(object):
+    """
+    Bookkeeping for UnstructuredGrid.bulk_edit().  Element arrays are grown
+    in place within preallocated, zeroed buffers, so that adding an element
+    is a slice rather than an allocation.
+    """
+    min_capacity=1000
+
+    def __init__(self,undo=True,listeners=True):
+        self.undo=undo
+        self.listeners=listeners
+        self.buffers=[] # arrays allocated here, which elements are sliced from
+        self.zeros={} # dtype => zeroed record
+
+    def reserve(self,A,count):
+        """
+        Return A, possibly reallocated so that at least count more elements
+        can be added without reallocating.
+        """
+        base=A.base
+        if not ( any(base is buff for buff in self.buffers)
+                 and len(base)>=len(A)+count ):
+            base=np.zeros(max(2*len(A),len(A)+count),A.dtype)
+            base[:len(A)]=A
+            self.buffers.append(base)
+        return base[:len(A)]
+
+    def extend(self,A):
+        """ return A extended by one zeroed element """
+        base=A.base
+        if not ( any(base is buff for buff in self.buffers)
+                 and len(base)>len(A) ):
+            base=self.reserve(A,max(len(A),self.min_capacity)).base
+        A=base[:len(A)+1]
+        if A.dtype not in self.zeros:
+            self.zeros[A.dtype]=np.zeros((),A.dtype)
+        # buffer may hold stale data from truncated elements
+        A[-1]=self.zeros[A.dtype]
+        return A
+
+
 # two parts - a baseclass which handles the real work
 # of registering listeners for a particular method,
 # and a decorator to streamline setting which methods
@@ -187,11 +362,25 @@ class Listenable(object):
     def unsubscribe_before(self,func_name,callback):
         if callback in self.__pre_listeners[func_name]:
             self.__pre_listeners[func_name].remove(callback)
+    def has_listeners(self,*func_names):
+        """ True if listeners are enabled and any are subscribed to one
+        of func_names.
+        """
+        if not self.listeners_enabled:
+            return False
+        return any( self.__post_listeners.get(f) or self.__pre_listeners.get(f)
+                    for f in func_names )
         
+    # set to False to temporarily silence all listeners
+    listeners_enabled=True
     def fire_after(self,func_name,*a,**k):
+        if not self.listeners_enabled:
+            return
         for func in self.__post_listeners[func_name]:
             func(self,func_name,*a,**k)
     def fire_before(self,func_name,*a,**k):
+        if not self.listeners_enabled:
+            return
         for func in self.__pre_listeners[func_name]:
             func(self,func_name,*a,**k)
 
@@ -386,6 +575,9 @@ class UnstructuredGrid(Listenable,undoer.OpHistory):
     @staticmethod
     def from_ugrid(nc,mesh_name=None,skip_edges=False):
         """ extract 2D grid from netcdf/ugrid
+        skip_edges: ignore any edges in the file, and build them from 
+          the cells.  Edges are always built from the cells when the file
+          does not include them.
         """
         if isinstance(nc,str):
             nc=qnc.QDataset(nc)
@@ -440,9 +632,13 @@ class UnstructuredGrid(Listenable,undoer.OpHistory):
             return idxs
 
         faces = process_as_index(mesh.face_node_connectivity)
-        edges = process_as_index(mesh.edge_node_connectivity) # [N,2]
-
-        ug = UnstructuredGrid(points=node_xy,cells=faces,edges=edges)
+        if skip_edges or getattr(mesh,'edge_node_connectivity',None) is None:
+            # edges are optional in ugrid - build from the faces
+            ug = UnstructuredGrid(points=node_xy,cells=faces)
+            ug.make_edges_from_cells()
+        else:
+            edges = process_as_index(mesh.edge_node_connectivity) # [N,2]
+            ug = UnstructuredGrid(points=node_xy,cells=faces,edges=edges)
         return ug
 
     def write_to_xarray(self,ds=None,mesh_name='mesh'):
@@ -597,9 +793,31 @@ class UnstructuredGrid(Listenable,undoer.OpHistory):
         """ from edges['nodes'] and cells['nodes'], set cells['edges']
         """
         self.cells['edges'] = -1
-        for c in range(self.Ncells()):
-            for i,(a,b) in enumerate(circular_pairs(self.cell_to_nodes(c))):
-                self.cells['edges'][c,i] = self.nodes_to_edge(a,b)
+        c,side,a,b=self.cell_side_pairs()
+        self.cells['edges'][c,side] = self.node_pairs_to_edges( np.c_[a,b] )
+
+    def cell_side_pairs(self,cells=None):
+        """
+        Vectorized enumeration of the sides of cells.
+        cells: array of cell indices, defaults to all cells.  Deleted cells
+          are included if explicitly requested.
+        returns arrays (c,side,a,b), one entry per side, such that side
+          of cell c goes from node a to node b, following the node order
+          of the cell.
+        """
+        if cells is None:
+            cells=np.arange(self.Ncells())
+        cells=np.asarray(cells,np.int64)
+        cell_nodes=self.cells['nodes'][cells]
+        nsides=(cell_nodes>=0).sum(axis=1)
+        sides=np.arange(cell_nodes.shape[1])
+        nxt=(sides[None,:]+1) % np.maximum(nsides,1)[:,None]
+        next_nodes=cell_nodes[np.arange(len(cells))[:,None],nxt]
+        real=sides[None,:]<nsides[:,None]
+        return ( np.broadcast_to(cells[:,None],real.shape)[real],
+                 np.broadcast_to(sides[None,:],real.shape)[real],
+                 cell_nodes[real],
+                 next_nodes[real] )
 
     def update_cell_nodes(self):
         """ from edges['nodes'] and cells['edges'], set cells['nodes']
@@ -767,6 +985,7 @@ class UnstructuredGrid(Listenable,undoer.OpHistory):
 
         self.edges['cells'] = cell_map[self.edges['cells']]
         self._cell_center_index=None
+        self._cell_kdtree=None
 
     def renumber_edges_ordering(self):
         Nactive = sum(~self.edges['deleted'])
@@ -786,6 +1005,8 @@ class UnstructuredGrid(Listenable,undoer.OpHistory):
         edge_map[-Nneg:] = np.arange(-Nneg,0)
 
         self.cells['edges'] = edge_map[self.cells['edges']]
+        self._edge_index=None
+        self._edge_kdtree=None
 
     def add_grid(self,ugB,merge_nodes=None):
         """
@@ -795,14 +1016,30 @@ class UnstructuredGrid(Listenable,undoer.OpHistory):
 
         merge_nodes: [ (self_node,ugB_node), ... ]
           Nodes which overlap and will be mapped instead of added.
+          'auto': merge nodes with exactly the same coordinates, see match_nodes().
+
+        When no undo history is being recorded, nothing listens for 
+        add_node/add_edge/add_cell, and those are not overridden, the 
+        elements of ugB are appended as whole arrays, see append_grid_arrays().
+        Otherwise they are added one at a time.
+        Returns node_map,edge_map,cell_map, giving the index in this grid 
+        of each element of ugB, or -1 for deleted elements.
         """
         node_map=np.zeros( ugB.Nnodes(), 'i4')-1
         edge_map=np.zeros( ugB.Nedges(), 'i4')-1
         cell_map=np.zeros( ugB.Ncells(), 'i4')-1
 
+        if isinstance(merge_nodes,six.string_types) and merge_nodes=='auto':
+            merge_nodes=self.match_nodes(ugB)
+            
         if merge_nodes is not None:
-            for my_node,B_node in merge_nodes:
-                node_map[B_node]=my_node
+            merge_nodes=np.asarray(merge_nodes,np.int64).reshape([-1,2])
+            node_map[merge_nodes[:,1]]=merge_nodes[:,0]
+        merged=node_map>=0
+
+        if self.can_append_arrays():
+            self.append_grid_arrays(ugB,node_map,edge_map,cell_map)
+            return node_map,edge_map,cell_map
 
         def bad_fields(Adata,Bdata): # field froms B which get dropped
             A_fields =Adata.dtype.names
@@ -812,70 +1049,203 @@ class UnstructuredGrid(Listenable,undoer.OpHistory):
                    if (f=='deleted') or (f not in A_fields)]
             return B_bad
 
-        B_bad=bad_fields(self.nodes,ugB.nodes)
-
-        for n in ugB.valid_node_iter():
-            if node_map[n]>=0:
-                continue # must be part of merge_nodes
-            kwargs=rec_to_dict(ugB.nodes[n])
-            for f in B_bad:
-                del kwargs[f]
-
-            node_map[n]=self.add_node(**kwargs)
-
-        B_bad=bad_fields(self.edges,ugB.edges)
-        # Easier to let add_cell fix this up
-        B_bad.append('cells')
-
-        for n in ugB.valid_edge_iter():
-            kwargs=rec_to_dict(ugB.edges[n])
-            for f in B_bad:
-                del kwargs[f]
+        with self.bulk_edit(nodes=ugB.Nnodes(),edges=ugB.Nedges(),cells=ugB.Ncells()):
+            B_bad=bad_fields(self.nodes,ugB.nodes)
+
+            for n in ugB.valid_node_iter():
+                if node_map[n]>=0:
+                    continue # must be part of merge_nodes
+                kwargs=rec_to_dict(ugB.nodes[n])
+                for f in B_bad:
+                    del kwargs[f]
+
+                node_map[n]=self.add_node(**kwargs)
+
+            B_bad=bad_fields(self.edges,ugB.edges)
+            # Easier to let add_cell fix this up
+            B_bad.append('cells')
+
+            for n in ugB.valid_edge_iter():
+                kwargs=rec_to_dict(ugB.edges[n])
+                for f in B_bad:
+                    del kwargs[f]
+
+                kwargs['nodes']=node_map[kwargs['nodes']]
+
+                # when both nodes were merged, have to also check
+                # for preexisting edges
+                if merged[ugB.edges['nodes'][n]].all():
+                    j=self.nodes_to_edge(kwargs['nodes'])
+                    if j is not None:
+                        edge_map[n]=j
+                        continue
+                edge_map[n]=self.add_edge(**kwargs)
+
+            B_bad=bad_fields(self.cells,ugB.cells)
+
+            for n in ugB.valid_cell_iter():
+                kwargs=rec_to_dict(ugB.cells[n])
+                for f in B_bad:
+                    del kwargs[f]
+
+                # avoid mutating ugB.
+                orig_nodes=kwargs['nodes']
+                kwargs['nodes'] = orig_nodes.copy()
+                kwargs['edges'] = kwargs['edges'].copy()
+
+                for i,node in enumerate(kwargs['nodes']):
+                    if node>=0:
+                        kwargs['nodes'][i]=node_map[node]
+
+                # less common, but still need to check for duplicated cells
+                # when all of the nodes were merged.
+                if merged[orig_nodes[orig_nodes>=0]].all():
+                    c=self.nodes_to_cell( kwargs['nodes'], fail_hard=False)
+                    if c is not None:
+                        cell_map[n]=c
+                        print("Skipping existing cell: %d: %s => %d: %s"%( n,str(orig_nodes),
+                                                                           c,str(kwargs['nodes'])))
+                        continue
+
+                for i,edge in enumerate(kwargs['edges']):
+                    if edge>=0:
+                        kwargs['edges'][i]=edge_map[edge]
+
+                cell_map[n]=self.add_cell(**kwargs)
 
-            kwargs['nodes']=node_map[kwargs['nodes']]
+        return node_map,edge_map,cell_map
 
-            # when merge_nodes is specified, have to also check
-            # for preexisting edges
-            if merge_nodes is not None:
-                j=self.nodes_to_edge(kwargs['nodes'])
-                if j is not None:
-                    edge_map[n]=j
+    def can_append_arrays(self):
+        """ True if elements can be appended as whole arrays, rather than
+        through add_node/add_edge/add_cell, i.e. no undo history is being
+        recorded, no listeners are subscribed to those methods, and a 
+        subclass has not overridden them.
+        """
+        if self.state=='recording':
+            return False
+        if self.has_listeners('add_node','add_edge','add_cell'):
+            return False
+        cls=type(self)
+        return ( (cls.add_node is UnstructuredGrid.add_node) and
+                 (cls.add_edge is UnstructuredGrid.add_edge) and
+                 (cls.add_cell is UnstructuredGrid.add_cell) )
+
+    def append_grid_arrays(self,ugB,node_map,edge_map,cell_map):
+        """
+        Array-level implementation of add_grid.  node_map has the 
+        merged nodes filled in, and -1 elsewhere.  node_map, edge_map 
+        and cell_map are filled in place.  Edges between two merged nodes
+        which already exist in this grid are reused, as are cells whose 
+        nodes were all merged.  Edge cells and cell edges are set from
+        the node connectivity.
+        """
+        merged=node_map>=0
+
+        def copy_fields(A,B,Bsel,count):
+            # new records for A, with fields in common copied from B[Bsel]
+            new=np.zeros(count,A.dtype)
+            for f in B.dtype.names:
+                if f=='deleted' or f not in A.dtype.names:
                     continue
-            edge_map[n]=self.add_edge(**kwargs)
-
-        B_bad=bad_fields(self.cells,ugB.cells)
-
-        for n in ugB.valid_cell_iter():
-            kwargs=rec_to_dict(ugB.cells[n])
-            for f in B_bad:
-                del kwargs[f]
-
-            # avoid mutating ugB.
-            orig_nodes=kwargs['nodes']
-            kwargs['nodes'] = orig_nodes.copy()
-            kwargs['edges'] = kwargs['edges'].copy()
-
-            for i,node in enumerate(kwargs['nodes']):
-                if node>=0:
-                    kwargs['nodes'][i]=node_map[node]
-
-            # less common, but still need to check for duplicated cells
-            # when merge_nodes is used.
-            if merge_nodes is not None:
-                c=self.nodes_to_cell( kwargs['nodes'], fail_hard=False)
+                if f in ['nodes','edges'] and new[f].ndim==2: # cells may differ in max_sides
+                    width=min(new[f].shape[1],B[f].shape[1])
+                    new[f][:,:]=self.UNDEFINED
+                    new[f][:,:width]=B[f][Bsel,:width]
+                else:
+                    new[f]=B[f][Bsel]
+            return new
+
+        # Nodes
+        ns=np.nonzero( (~ugB.nodes['deleted']) & (~merged) )[0]
+        N0=self.Nnodes()
+        node_map[ns]=N0+np.arange(len(ns))
+        new_nodes=copy_fields(self.nodes,ugB.nodes,ns,len(ns))
+        
+        # Edges - those between merged nodes may already exist
+        js=np.nonzero(~ugB.edges['deleted'])[0]
+        j_nodes=node_map[ugB.edges['nodes'][js]]
+        both=np.all(merged[ugB.edges['nodes'][js]],axis=1)
+        if np.any(both):
+            existing=self.node_pairs_to_edges(j_nodes[both])
+            edge_map[js[both]]=existing # UNDEFINED where missing
+        new_js=js[edge_map[js]<0]
+        j_nodes=node_map[ugB.edges['nodes'][new_js]]
+        J0=self.Nedges()
+        edge_map[new_js]=J0+np.arange(len(new_js))
+        new_edges=copy_fields(self.edges,ugB.edges,new_js,len(new_js))
+        new_edges['nodes']=j_nodes
+        new_edges['cells']=self.UNDEFINED
+
+        # Cells - those with all nodes merged may already exist
+        cs=np.nonzero(~ugB.cells['deleted'])[0]
+        c_nodes=ugB.cells['nodes'][cs]
+        valid=c_nodes>=0
+        c_nodes=np.where(valid,node_map[c_nodes.clip(0)],self.UNDEFINED)
+        all_merged=np.all( merged[ugB.cells['nodes'][cs].clip(0)] | ~valid, axis=1)
+        if np.any(all_merged):
+            for i in np.nonzero(all_merged)[0]:
+                ns_i=c_nodes[i][valid[i]]
+                c=self.nodes_to_cell(ns_i,fail_hard=False)
                 if c is not None:
-                    cell_map[n]=c
-                    print("Skipping existing cell: %d: %s => %d: %s"%( n,str(orig_nodes),
-                                                                       c,str(kwargs['nodes'])))
-                    continue
-
-            for i,edge in enumerate(kwargs['edges']):
-                if edge>=0:
-                    kwargs['edges'][i]=edge_map[edge]
-
-            cell_map[n]=self.add_cell(**kwargs)
+                    cell_map[cs[i]]=c
+                    print("Skipping existing cell: %d: %s => %d: %s"%( cs[i],str(ugB.cells['nodes'][cs[i]]),
+                                                                       c,str(ns_i)))
+        keep=cell_map[cs]<0
+        new_cs=cs[keep]
+        C0=self.Ncells()
+        cell_map[new_cs]=C0+np.arange(len(new_cs))
+        new_cells=copy_fields(self.cells,ugB.cells,new_cs,len(new_cs))
+        new_cells['nodes'][:,:]=self.UNDEFINED
+        width=min(c_nodes.shape[1],new_cells['nodes'].shape[1])
+        new_cells['nodes'][:,:width]=c_nodes[keep,:width]
+
+        self.nodes=np.concatenate([self.nodes,new_nodes])
+        self.edges=np.concatenate([self.edges,new_edges])
+        self.cells=np.concatenate([self.cells,new_cells])
+        self._node_to_edges=None
+        self._node_to_cells=None
+
+        # cell edges and edge cells, from the node connectivity.
+        # side k of a cell runs from node k to node k+1.
+        new_c=C0+np.arange(len(new_cs))
+        nodes=self.cells['nodes'][new_c]
+        nsides=np.sum(nodes>=0,axis=1)
+        self.cells['edges'][new_c]=self.UNDEFINED
+        if len(new_c):
+            ci,side=np.nonzero(nodes>=0)
+            na=nodes[ci,side]
+            nb=nodes[ci,(side+1)%nsides[ci]]
+            j=self.node_pairs_to_edges(np.c_[na,nb])
+            assert np.all(j>=0),"Cell edges missing from merged grid"
+            self.cells['edges'][new_c[ci],side]=j
+            left=(self.edges['nodes'][j,0]==na)
+            self.edges['cells'][j[left],0]=new_c[ci[left]]
+            self.edges['cells'][j[~left],1]=new_c[ci[~left]]
 
-        return node_map,edge_map,cell_map
+        if self._node_index is not None:
+            for n in range(N0,self.Nnodes()):
+                self._node_index.insert(n,self.nodes['x'][n,self.xxyy])
+        self._edge_index_insert(np.arange(J0,self.Nedges()))
+        self._cell_index_insert(new_c)
+
+    def match_nodes(self,ugB):
+        """
+        Find nodes of ugB with exactly the same coordinates as a node of this
+        grid, e.g. the shared boundary of two subdomains.
+        Returns an array of [ (self_node,ugB_node), ...], suitable for
+        add_grid(merge_nodes=...).
+        """
+        A=np.nonzero(~self.nodes['deleted'])[0]
+        B=np.nonzero(~ugB.nodes['deleted'])[0]
+        # complex values sort on x, then y
+        Ax=self.nodes['x'][A,0] + 1j*self.nodes['x'][A,1]
+        Bx=ugB.nodes['x'][B,0] + 1j*ugB.nodes['x'][B,1]
+        order=np.argsort(Ax,kind='mergesort')
+        idx=np.searchsorted(Ax[order],Bx).clip(0,max(0,len(A)-1))
+        if len(A)==0:
+            return np.zeros( (0,2), np.int64)
+        hits=Ax[order][idx]==Bx
+        return np.c_[ A[order][idx[hits]], B[hits] ]
         
     def find_cycles(self,max_cycle_len=4,starting_edges=None,check_area=True):
         """ traverse edges, returning a list of lists, each list giving the
@@ -973,7 +1343,7 @@ class UnstructuredGrid(Listenable,undoer.OpHistory):
         if recalc:
             self.edges['cells'][:,:]=self.UNMESHED
             self.log.info("Recalculating edge to cells" )
-            all_c=range(self.Ncells())
+            all_c=np.nonzero(~self.cells['deleted'])[0]
         else:
             if e is None:
                 e=slice(None)
@@ -983,43 +1353,30 @@ class UnstructuredGrid(Listenable,undoer.OpHistory):
                              e.stop or self.Nedges(),
                              e.step or 1)
             else:
-                try:
-                    L=len(e)
-                    if L==self.Nedges() and np.issubdtype(np.bool,e.dtype):
-                        js=np.nonzero(e)
-                    else:
-                        js=e
-                except TypeError:
-                    js=[e]
-
-            all_c=set()
-            for j in js:
-                ec=self.edges['cells'][j]
-                if (ec[0]!=self.UNKNOWN) and (ec[1]!=self.UNKNOWN):
-                    continue
-
-                for n in self.edges['nodes'][j]:
-                    # don't assume that cells['edges'] is set, either.
-                    for c in self.node_to_cells(n):
-                        all_c.add(c)
+                js=np.atleast_1d(e)
+                if js.dtype==np.bool_:
+                    js=np.nonzero(js)[0]
+
+            ec=self.edges['cells'][js]
+            js=js[ np.any(ec==self.UNKNOWN,axis=-1) ]
+            if len(js)==0:
+                return self.edges['cells'][e]
+            # don't assume that cells['edges'] is set, either.
+            all_c=self.nodes_to_incident_cells( np.unique(self.edges['nodes'][js]) )
+            all_c=np.unique(all_c[all_c>=0])
 
         # Do the actual work
         # don't assume that cells['edges'] is set, either.
-        for c in all_c:
-            nodes=self.cell_to_nodes(c)
-            for i in range(len(nodes)):
-                a=nodes[i]
-                b=nodes[(i+1)%len(nodes)]
-                j=self.nodes_to_edge(a,b)
-                if j is None:
-                    print( "Failed to find an edge" )
-                    continue
-                # will have to trial-and-error to get the right
-                # left/right sense here.
-                if self.edges['nodes'][j,0]==a:
-                    self.edges['cells'][j,0]=c
-                else:
-                    self.edges['cells'][j,1]=c
+        c,side,a,b=self.cell_side_pairs(all_c)
+        j=self.node_pairs_to_edges(np.c_[a,b])
+        missing=(j<0)
+        if np.any(missing):
+            print( "Failed to find %d edges"%missing.sum() )
+            c,a,j=c[~missing],a[~missing],j[~missing]
+        # left/right sense from the orientation of the edge
+        left=self.edges['nodes'][j,0]==a
+        self.edges['cells'][j[left],0]=c[left]
+        self.edges['cells'][j[~left],1]=c[~left]
 
         return self.edges['cells'][e]
 
@@ -1050,33 +1407,55 @@ class UnstructuredGrid(Listenable,undoer.OpHistory):
             self.cells['nodes'][c,len(nodes):]=self.UNDEFINED
 
     def make_edges_from_cells(self):
-        edge_map = {} # keys are tuples of node indices, mapping to index into new_edges
-        new_edges = [] # each entry is [n1,n2,c1,c2].  assume for now that c1 is on the left of the edge n1->n2
-
-        for c in range(self.Ncells()):
-            for i,(a,b) in enumerate(circular_pairs(self.cell_to_nodes(c))):
-                if a<b:
-                    k = (a,b)
-                else:
-                    k = (b,a)
-                if k not in edge_map:
-                    j = len(new_edges)
-                    edge_map[k] = j
-                    # we know everything but the opposite cell
-                    new_edges.append([a,b,c,-1])
-                else:
-                    # if it's already in there, then we must be the right-hand side cell
-                    j = edge_map[k]
-                    new_edges[j][3] = c
-                # not 100% sure that this will put the edges in with the expected order
-                # this should have edge i immediately CCW from node i.
-                self.cells['edges'][c,i] = j
-
-        new_edges = np.array(new_edges)
-        self.edges = np.zeros( len(new_edges),self.edge_dtype )
-        self.edges['nodes'] = new_edges[:,:2]
-        self.edges['cells'] = new_edges[:,2:4]
+        """
+        Create edges from cells['nodes'], replacing any existing edges,
+        and set edges['cells'] and cells['edges'].
+        Each edge takes its orientation from the first cell (in index order)
+        which references it, and that cell is on the left.  Edges are numbered
+        in order of first reference.
+
+        Vectorized: half-edges from all cells are keyed by (min node, max node),
+        sorted, and paired up.
+        """
+        valid=np.nonzero(~self.cells['deleted'])[0]
+        c,side,a,b=self.cell_side_pairs(valid)
+
+        keys=self.half_edge_keys(a,b)
+        # first: index into half-edges of first occurrence of each edge
+        # inverse: maps half-edges to unique keys
+        _,first,inverse=np.unique(keys,return_index=True,return_inverse=True)
+        # renumber edges by first occurrence
+        order=np.argsort(first,kind='mergesort')
+        rank=np.zeros(len(order),np.int32)
+        rank[order]=np.arange(len(order))
+        j=rank[inverse]
+        first=first[order]
+
+        self.edges = np.zeros( len(first),self.edge_dtype )
+        self.edges['nodes'][:,0] = a[first]
+        self.edges['nodes'][:,1] = b[first]
+        self.edges['cells'][:,0] = c[first]
+        self.edges['cells'][:,1] = self.UNDEFINED
+        # any later occurrence of an edge is the right-hand side cell
+        later=np.ones(len(c),np.bool_)
+        later[first]=False
+        self.edges['cells'][j[later],1] = c[later]
+
+        self.cells['edges'][valid,:] = self.UNDEFINED
+        # this should have edge i immediately CCW from node i.
+        self.cells['edges'][c,side] = j
         self._node_to_edges=None
+        self._edge_index=None
+        self._edge_kdtree=None
+
+    def half_edge_keys(self,a,b):
+        """
+        Integer key for the undirected edge between nodes a and b, the same 
+        for (a,b) and (b,a).  a and b may be arrays.
+        """
+        a=np.asarray(a,np.int64)
+        b=np.asarray(b,np.int64)
+        return np.minimum(a,b)*self.Nnodes() + np.maximum(a,b)
 
     def refresh_metadata(self):
         """ Call this when the cells, edges and nodes may be out of sync with indices
@@ -1089,6 +1468,11 @@ class UnstructuredGrid(Listenable,undoer.OpHistory):
         #self._calc_vcenters = False
         self._node_to_edges = None
         self._node_to_cells = None
+        self._node_index = None
+        self._edge_index = None
+        self._edge_kdtree = None
+        self._cell_center_index = None
+        self._cell_kdtree = None
 
     def Nnodes(self):
         """
@@ -1151,7 +1535,7 @@ class UnstructuredGrid(Listenable,undoer.OpHistory):
         
         for ci,c in enumerate(ids):
             if not self.cells['deleted'][c]:
-                centroids[ci]= np.array(self.cell_polygon(c).centroid)
+                centroids[ci]= np.array(self.cell_polygon(c).centroid.coords[0])
         return centroids
     
     def cells_center(self,refresh=False,mode='first3'):
@@ -1245,13 +1629,35 @@ class UnstructuredGrid(Listenable,undoer.OpHistory):
         return nbrs
 
     def build_node_to_cells(self):
-        n2c = defaultdict(list)
-        for c in range(self.Ncells()):
-            if self.cells['deleted'][c]:
-                continue
-            for cn in self.cell_to_nodes(c):
-                n2c[cn].append(c)
-        self._node_to_cells = n2c
+        valid=~self.cells['deleted']
+        cell_nodes=self.cells['nodes'][valid]
+        cs=np.nonzero(valid)[0]
+        cs=np.repeat(cs,cell_nodes.shape[1]).reshape(cell_nodes.shape)
+        real=cell_nodes>=0
+        self._node_to_cells = NodeAdjacency.from_pairs(cell_nodes[real],cs[real],
+                                                       self.Nnodes())
+
+    def node_cell_table(self):
+        """ 
+        Return the node=>cells mapping in CSR form, (offsets,cells), such
+        that the cells of node n are cells[offsets[n]:offsets[n+1]].
+        Pending incremental updates are folded in first.
+        """
+        if self._node_to_cells is None:
+            self.build_node_to_cells()
+        elif self._node_to_cells.modified or self._node_to_cells.Nrows()<self.Nnodes():
+            self._node_to_cells.compact(self.Nnodes())
+        return self._node_to_cells.offsets,self._node_to_cells.indices
+
+    def nodes_to_incident_cells(self,nodes):
+        """
+        Batch version of node_to_cells.
+        nodes: array of node indices
+        returns [len(nodes),max count] array of cell indices, padded with
+        UNDEFINED.
+        """
+        self.node_cell_table()
+        return self._node_to_cells.padded(nodes,fill=self.UNDEFINED)
         
     _node_to_edges = None
     def node_to_edges(self,n):
@@ -1268,12 +1674,56 @@ class UnstructuredGrid(Listenable,undoer.OpHistory):
         return np.unique(e_adj)
 
     def build_node_to_edges(self):
-        n2e = defaultdict(list)
-        for e in self.valid_edge_iter(): 
-            for i in [0,1]:
-                n2e[self.edges['nodes'][e,i]].append(e)
-        self._node_to_edges = n2e
-        
+        js=np.nonzero(~self.edges['deleted'])[0]
+        self._node_to_edges = NodeAdjacency.from_pairs(self.edges['nodes'][js].ravel(),
+                                                       np.repeat(js,2),
+                                                       self.Nnodes())
+
+    def node_edge_table(self):
+        """ 
+        Return the node=>edges mapping in CSR form, (offsets,edges).
+        See node_cell_table.
+        """
+        if self._node_to_edges is None:
+            self.build_node_to_edges()
+        elif self._node_to_edges.modified or self._node_to_edges.Nrows()<self.Nnodes():
+            self._node_to_edges.compact(self.Nnodes())
+        return self._node_to_edges.offsets,self._node_to_edges.indices
+
+    def nodes_to_incident_edges(self,nodes):
+        """
+        Batch version of node_to_edges.
+        nodes: array of node indices
+        returns [len(nodes),max count] array of edge indices, padded with
+        UNDEFINED.
+        """
+        self.node_edge_table()
+        return self._node_to_edges.padded(nodes,fill=self.UNDEFINED)
+
+    def node_pairs_to_edges(self,pairs):
+        """
+        Batch version of nodes_to_edge.
+        pairs: [N,2] array of node indices.  
+        returns array of N edge indices, with UNDEFINED where no edge
+        connects the pair.
+        """
+        pairs=np.asarray(pairs).reshape([-1,2])
+        result=np.zeros(len(pairs),np.int32)
+        result[:]=self.UNDEFINED
+
+        offsets,edges=self.node_edge_table()
+        Nn=self.Nnodes()
+        valid=np.all( (pairs>=0) & (pairs<Nn), axis=1) & (pairs[:,0]!=pairs[:,1])
+        sel=np.nonzero(valid)[0]
+
+        qi,pos=self._node_to_edges.expand(pairs[sel,0])
+        cand=edges[pos]
+        other=pairs[sel[qi],1]
+        hit=( (self.edges['nodes'][cand,0]==other) |
+              (self.edges['nodes'][cand,1]==other) )
+        result[sel[qi[hit]]]=cand[hit]
+        return result
+
     def nodes_to_edge(self,n1,n2=None):
         if n2 is None:
             n1,n2=n1
@@ -1408,6 +1858,69 @@ class UnstructuredGrid(Listenable,undoer.OpHistory):
     #  add_<elt>: just create that element, nothing sneaky.
     #     add methods take only keyword arguments, corresponding to fields in the dtype.
 
+    _bulk=None
+    @contextmanager
+    def bulk_edit(self,undo=True,listeners=True,nodes=0,edges=0,cells=0):
+        """
+        Context manager for adding many elements at once, e.g.
+          with g.bulk_edit(undo=False):
+              for xy in points: g.add_node(x=xy)
+        New elements go into preallocated buffers, spatial indices are
+        not updated per element but rebuilt once on exit, and 
+        node=>edge/cell tables are compacted once on exit.
+
+        undo: if False, operations are not recorded.  Any existing 
+          checkpoints are invalidated on exit.
+        listeners: if False, no listeners are notified of operations
+          within the block, and it is up to the caller to bring them
+          up to date.
+        nodes,edges,cells: expected number of each element to be added,
+          used to size the buffers.
+        """
+        if self._bulk is not None: # nested - outer block handles it.
+            yield self._bulk
+            return
+
+        bulk=BulkEdit(undo=undo,listeners=listeners)
+        self.nodes=bulk.reserve(self.nodes,nodes)
+        self.edges=bulk.reserve(self.edges,edges)
+        self.cells=bulk.reserve(self.cells,cells)
+
+        had_node_index=self._node_index is not None
+        had_edge_index=self._edge_index is not None
+        had_cell_center_index=self._cell_center_index is not None
+        self._node_index=None
+        self._edge_index=None
+        self._cell_center_index=None
+
+        old_state=self.state
+        old_listeners=self.listeners_enabled
+        if not undo:
+            self.state='inactive'
+        if not listeners:
+            self.listeners_enabled=False
+        self._bulk=bulk
+        try:
+            yield bulk
+        finally:
+            self._bulk=None
+            self.listeners_enabled=old_listeners
+            if not undo:
+                self.state=old_state
+                if old_state=='recording':
+                    # prior checkpoints are no longer valid
+                    self.commit()
+
+            for adj in [self._node_to_edges,self._node_to_cells]:
+                if adj is not None:
+                    adj.compact(self.Nnodes())
+            if had_node_index and self._node_index is None:
+                self.node_index()
+            if had_edge_index and self._edge_index is None:
+                self.edge_index()
+            if had_cell_center_index and self._cell_center_index is None:
+                self.cell_center_index()
+
     def add_or_find_node(self,x,tolerance=0.0,**kwargs):
         """ if a node already exists with a location within tolerance distance 
         of x, return its index, otherwise create a new node.
@@ -1432,8 +1945,11 @@ class UnstructuredGrid(Listenable,undoer.OpHistory):
                 self.nodes[i]['deleted']=False
 
         if i is None: # have to extend the array
-            n=np.zeros( (), dtype=self.node_dtype)
-            self.nodes=array_append(self.nodes,n)
+            if self._bulk is not None:
+                self.nodes=self._bulk.extend(self.nodes)
+            else:
+                n=np.zeros( (), dtype=self.node_dtype)
+                self.nodes=array_append(self.nodes,n)
             i=len(self.nodes)-1
 
         for k,v in six.iteritems(kwargs):
@@ -1473,8 +1989,11 @@ class UnstructuredGrid(Listenable,undoer.OpHistory):
                 raise GridException("Edge already exists")
                 
         if j is None:
-            e=np.zeros( (),dtype=self.edge_dtype)
-            self.edges=array_append(self.edges,e)
+            if self._bulk is not None:
+                self.edges=self._bulk.extend(self.edges)
+            else:
+                e=np.zeros( (),dtype=self.edge_dtype)
+                self.edges=array_append(self.edges,e)
             j=len(self.edges)-1
 
         # default values
@@ -1490,8 +2009,10 @@ class UnstructuredGrid(Listenable,undoer.OpHistory):
 
         if self._node_to_edges is not None:
             n1,n2=self.edges['nodes'][j]
-            self._node_to_edges[n1].append(j)
-            self._node_to_edges[n2].append(j)
+            self._node_to_edges.append(n1,j)
+            self._node_to_edges.append(n2,j)
+
+        self._edge_index_insert([j])
 
         self.push_op(self.unadd_edge,j)
         return j
@@ -1506,10 +2027,11 @@ class UnstructuredGrid(Listenable,undoer.OpHistory):
     def delete_edge(self,j):
         if np.any(self.edges['cells'][j]>=0):
             raise GridException("Edge %d has cell neighbors"%j)
+        self._edge_index_delete([j])
         self.edges['deleted'][j] = True
         if self._node_to_edges is not None:
             for n in self.edges['nodes'][j]:
-                self._node_to_edges[n].remove(j)
+                self._node_to_edges.remove(n,j)
 
         self.push_op(self.undelete_edge,j,self.edges[j].copy())
 
@@ -1794,12 +2316,7 @@ class UnstructuredGrid(Listenable,undoer.OpHistory):
         # better to go ahead and use the dynamic updates
         # must come before too many modifications, in case we end
         # up recalculating cell center or truncating self.cells
-        if self._cell_center_index is not None:
-            if self.cell_center_index_point=='circumcenter':
-                pnt=self.cells_center()[i]
-            else: # centroid
-                pnt=self.cells_centroid([i])[0]
-            self._cell_center_index.delete(i,pnt[self.xxyy])                
+        self._cell_index_delete([i])
 
         # remove links from edges:
         for j in self.cell_to_edges(i): # self.cells['edges'][i]:
@@ -1812,7 +2329,7 @@ class UnstructuredGrid(Listenable,undoer.OpHistory):
                     
         if self._node_to_cells is not None:
             for n in self.cell_to_nodes(i):
-                self._node_to_cells[n].remove(i)
+                self._node_to_cells.remove(n,i)
             
         self.push_op(self.undelete_cell,i,self.cells[i].copy())
 
@@ -1887,8 +2404,11 @@ class UnstructuredGrid(Listenable,undoer.OpHistory):
                 assert self.cells[i]['deleted']
 
         if i is None:
-            c=np.zeros( (),dtype=self.cell_dtype)
-            self.cells=array_append(self.cells,c)
+            if self._bulk is not None:
+                self.cells=self._bulk.extend(self.cells)
+            else:
+                c=np.zeros( (),dtype=self.cell_dtype)
+                self.cells=array_append(self.cells,c)
             i=len(self.cells)-1
         else:
             pass
@@ -1910,14 +2430,9 @@ class UnstructuredGrid(Listenable,undoer.OpHistory):
 
         if self._node_to_cells is not None:
             for n in self.cell_to_nodes(i):
-                self._node_to_cells[n].append(i)
+                self._node_to_cells.append(n,i)
 
-        if self._cell_center_index is not None:
-            if self.cell_center_index_point=='circumcenter':
-                cc=self.cells_center()[i]
-            else: # centroid
-                cc=self.cells_centroid([i])[0]
-            self._cell_center_index.insert(i,cc[self.xxyy])
+        self._cell_index_insert([i])
 
         # updated 2016-08-25 - not positive here.
         # This whole chunk needs testing.
@@ -1962,10 +2477,14 @@ class UnstructuredGrid(Listenable,undoer.OpHistory):
         """ convenience wrapper for add_cell which makes sure all 
         the edges exist first.
         """ 
+        edges=[]
         for a,b in circular_pairs(nodes):
             j=self.nodes_to_edge(a,b)
             if j is None:
-                self.add_edge(nodes=[a,b])
+                j=self.add_edge(nodes=[a,b],_check_existing=False)
+            edges.append(j)
+        if 'edges' not in kws:
+            kws['edges']=edges
         return self.add_cell(nodes=nodes,**kws)
         
 
@@ -1974,9 +2493,11 @@ class UnstructuredGrid(Listenable,undoer.OpHistory):
         """ largely incomplete.  This will need to 
         update any geometry and topology details
         """
-        if 'nodes' in kws and self._node_to_cells is not None:
-            for n in self.cell_to_nodes(c):
-                self._node_to_cells[n].remove(c)
+        if 'nodes' in kws:
+            self._cell_index_delete([c])
+            if self._node_to_cells is not None:
+                for n in self.cell_to_nodes(c):
+                    self._node_to_cells.remove(n,c)
 
         for k,v in six.iteritems(kws):
             if k in ('nodes','edges'):
@@ -1985,40 +2506,42 @@ class UnstructuredGrid(Listenable,undoer.OpHistory):
             else:                
                 self.cells[k][c]=v
 
-        if 'nodes' in kws and self._node_to_cells is not None:
-            for n in self.cell_to_nodes(c):
-                self._node_to_cells[n].append(c)
+        if 'nodes' in kws:
+            # geometry is stale
+            self.cells['_center'][c]=np.nan
+            self.cells['_area'][c]=np.nan
+            if self._node_to_cells is not None:
+                for n in self.cell_to_nodes(c):
+                    self._node_to_cells.append(n,c)
+            self._cell_index_insert([c])
 
     @listenable
     def modify_edge(self,j,**kws):
         # likewise, this will have to get smarter about patching up derived
         # geometry and topology
 
-        if 'nodes' in kws and self._node_to_edges is not None:
-            for n in self.edges['nodes'][j]:
-                self._node_to_edges[n].remove(j)
+        if 'nodes' in kws:
+            self._edge_index_delete([j])
+            if self._node_to_edges is not None:
+                for n in self.edges['nodes'][j]:
+                    self._node_to_edges.remove(n,j)
 
         for k,v in six.iteritems(kws):
             self.edges[k][j]=v
 
-        if 'nodes' in kws and self._node_to_edges is not None:
-            for n in self.edges['nodes'][j]:
-                self._node_to_edges[n].append(j)
+        if 'nodes' in kws:
+            if self._node_to_edges is not None:
+                for n in self.edges['nodes'][j]:
+                    self._node_to_edges.append(n,j)
+            self._edge_index_insert([j])
             
     @listenable
     def modify_node(self,n,**kws):
-        if self._cell_center_index:
-            my_cells=self.node_to_cells(n)
-
-            if self.cell_center_index_point=='circumcenter':
-                ccs=self.cells_center()[my_cells]
-            else:
-                ccs=self.cells_centroid(my_cells)
-                
-            for c,cc in zip(my_cells,ccs):
-                self._cell_center_index.delete(c,cc[self.xxyy])
-        else:
-            cc=None
+        if 'x' in kws:
+            my_cells=list(self.node_to_cells(n))
+            my_edges=list(self.node_to_edges(n))
+            self._cell_index_delete(my_cells)
+            self._edge_index_delete(my_edges)
 
         if 'x' in kws and self._node_index is not None:
             self._node_index.delete(n,self.nodes['x'][n][self.xxyy])
@@ -2036,13 +2559,9 @@ class UnstructuredGrid(Listenable,undoer.OpHistory):
         if 'x' in kws and self._node_index is not None:
             self._node_index.insert(n,self.nodes['x'][n][self.xxyy])
 
-        if self._cell_center_index:
-            if self.cell_center_index_point=='circumcenter':
-                ccs=self.cells_center(refresh=my_cells)[my_cells]
-            else: # centroid
-                ccs=self.cells_centroid(my_cells)
-            for c,cc in zip(my_cells,ccs):
-                self._cell_center_index.insert(c,cc[self.xxyy])
+        if 'x' in kws:
+            self._cell_index_insert(my_cells,refresh=True)
+            self._edge_index_insert(my_edges)
 
     def elide_node(self,n):
         """ 
@@ -2078,19 +2597,24 @@ class UnstructuredGrid(Listenable,undoer.OpHistory):
         """
         for ni in range(self.max_sides):
             if self.cells['nodes'][c,ni] == n_old:
+                self._cell_index_delete([c])
                 self.cells['nodes'][c,ni] = n_new
+                self.cells['_center'][c] = np.nan
+                self._cell_index_insert([c])
                 if self._node_to_cells is not None:
-                    self._node_to_cells[n_old].remove(c)
-                    self._node_to_cells[n_new].append(c)
+                    self._node_to_cells.remove(n_old,c)
+                    self._node_to_cells.append(n_new,c)
     def edge_replace_node(self,j,n_old,n_new):
         """ see cell_replace_node
         """
         for ni in [0,1]:
             if self.edges['nodes'][j,ni] == n_old:
+                self._edge_index_delete([j])
                 self.edges['nodes'][j,ni] = n_new
+                self._edge_index_insert([j])
                 if self._node_to_edges is not None:
-                    self._node_to_edges[n_old].remove(j)
-                    self._node_to_edges[n_new].append(j)
+                    self._node_to_edges.remove(n_old,j)
+                    self._node_to_edges.append(n_new,j)
 
     #-# higher level topology modifications
     def collapse_short_edges(self,l_thresh=1.0):
@@ -2122,9 +2646,12 @@ class UnstructuredGrid(Listenable,undoer.OpHistory):
                 c_n = list(self.cells['nodes'][c])
                 c_n.remove(n_del)
                 c_n.append(-1)
+                self._cell_index_delete([c])
                 self.cells['nodes'][c] = c_n
+                self.cells['_center'][c] = np.nan
+                self._cell_index_insert([c])
                 if self._node_to_cells is not None:
-                    self._node_to_cells[n_del].remove(c)
+                    self._node_to_cells.remove(n_del,c)
 
                 c_e = list(self.cells['edges'][c])
                 c_e.remove(j_del)
@@ -2896,20 +3423,122 @@ class UnstructuredGrid(Listenable,undoer.OpHistory):
     _cell_center_index=None
     cell_center_index_point='centroid' # 'centroid' or 'circumcenter'
     def cell_center_index(self):
-        """ TODO: this is not wired into the update,listen, etc.
-        framework.  Do not use yet for a grid which will be modified.
+        """ Spatial index of cell centers (see cell_center_index_point),
+        kept up to date by the add/delete/modify methods once built.
         """
         if self._cell_center_index is None:
-            if self.cell_center_index_point=='circumcenter':
-                cc=self.cells_center()
-            else:
-                cc=self.cells_centroid()
-            tuples = [(i,cc[i,self.xxyy],None) 
-                      for i in range(self.Ncells()) 
-                      if not self.cells['deleted'][i] ]
+            cells=np.nonzero(~self.cells['deleted'])[0]
+            cc=self.cell_center_index_points(cells)
+            tuples = [(c,xy[self.xxyy],None) 
+                      for c,xy in zip(cells,cc)]
             self._cell_center_index = gen_spatial_index.PointIndex(tuples,interleaved=False)
         return self._cell_center_index
 
+    def cell_center_index_points(self,cells,refresh=False):
+        """ [N,2] points used to represent cells in the cell center index.
+        refresh: recalculate circumcenters even if cached.
+        """
+        cells=np.asarray(cells,np.int64)
+        if self.cell_center_index_point=='circumcenter':
+            mask=np.zeros(self.Ncells(),np.bool_)
+            mask[cells]=True
+            if not refresh:
+                mask&=np.isnan(self.cells['_center'][:,0])
+            if np.any(mask):
+                self.cells_center(refresh=mask)
+            return self.cells['_center'][cells]
+        else: # centroid
+            return self.cells_centroid(cells)
+
+    def _cell_index_delete(self,cells):
+        # call before modifying a cell, so the index entry can be found
+        self._cell_kdtree=None
+        if self._cell_center_index is not None and len(cells):
+            for c,xy in zip(cells,self.cell_center_index_points(cells)):
+                self._cell_center_index.delete(c,xy[self.xxyy])
+
+    def _cell_index_insert(self,cells,refresh=False):
+        # call after modifying a cell
+        self._cell_kdtree=None
+        if self._cell_center_index is not None and len(cells):
+            for c,xy in zip(cells,self.cell_center_index_points(cells,refresh=refresh)):
+                self._cell_center_index.insert(c,xy[self.xxyy])
+
+    _edge_index=None
+    def edge_index(self):
+        """ Spatial index of edge centers, kept up to date by the 
+        add/delete/modify methods once built.
+        """
+        if self._edge_index is None:
+            js=np.nonzero(~self.edges['deleted'])[0]
+            ec=self.edges_center()[js]
+            tuples = [(j,xy[self.xxyy],None) 
+                      for j,xy in zip(js,ec)]
+            self._edge_index = gen_spatial_index.PointIndex(tuples,interleaved=False)
+        return self._edge_index
+
+    def _edge_index_points(self,js):
+        return self.nodes['x'][self.edges['nodes'][js]].mean(axis=1)
+
+    def _edge_index_delete(self,js):
+        # call before modifying an edge, so the index entry can be found
+        self._edge_kdtree=None
+        if self._edge_index is not None and len(js):
+            for j,xy in zip(js,self._edge_index_points(js)):
+                self._edge_index.delete(j,xy[self.xxyy])
+
+    def _edge_index_insert(self,js):
+        # call after modifying an edge
+        self._edge_kdtree=None
+        if self._edge_index is not None and len(js):
+            for j,xy in zip(js,self._edge_index_points(js)):
+                self._edge_index.insert(j,xy[self.xxyy])
+
+    _edge_kdtree=None
+    def edge_kdtree(self):
+        """
+        scipy cKDTree of the centers of valid edges, for batch queries.
+        Returns (tree,edges), where edges maps tree indices to edge indices.
+        See cell_kdtree.
+        """
+        if self._edge_kdtree is None:
+            from scipy.spatial import cKDTree
+            js=np.nonzero(~self.edges['deleted'])[0]
+            self._edge_kdtree=(cKDTree(self.edges_center()[js]),js)
+        return self._edge_kdtree
+
+    def select_edges_nearest_batch(self,xy,count=None):
+        """
+        Batch version of select_edges_nearest, comparing to edge centers.
+        xy: [N,2] points
+        count: None to return [N] nearest edges, otherwise [N,count] array
+          of the count nearest edges, ordered by increasing distance.
+        """
+        return self._select_nearest_batch(self.edge_kdtree(),xy,count)
+
+    def select_cells_nearest_batch(self,xy,count=None):
+        """
+        Batch version of select_cells_nearest(inside=False), comparing to
+        cell centroids.  See select_edges_nearest_batch, and points_to_cells
+        for finding the cell containing each point.
+        """
+        return self._select_nearest_batch(self.cell_kdtree(),xy,count)
+
+    def _select_nearest_batch(self,tree_and_ids,xy,count):
+        tree,ids=tree_and_ids
+        xy=np.asarray(xy,np.float64).reshape([-1,2])
+        k=count or 1
+        _,hits=tree.query(xy,k=k)
+        hits=hits.reshape([len(xy),k])
+        # when k exceeds the number of elements, scipy pads with len(ids)
+        result=np.zeros(hits.shape,np.int32)
+        result[...]=self.UNDEFINED
+        valid=hits<len(ids)
+        result[valid]=ids[hits[valid]]
+        if count is None:
+            return result[:,0]
+        return result
+
     def select_edges_nearest(self,xy,count=None,fast=True):
         xy=np.asarray(xy)
 
@@ -2918,12 +3547,10 @@ class UnstructuredGrid(Listenable,undoer.OpHistory):
             real_count=1
 
         if fast:
-            # TODO: maintain a proper edge index
-            # For now, brute force it.
-            ec=self.edges_center()
-            dists=mag(xy-ec)
-            dists[self.edges['deleted']]=np.inf
-            hits=np.argsort(dists)[:real_count]
+            hits = self.edge_index().nearest(xy[self.xxyy],real_count)
+            if isinstance( hits, types.GeneratorType): # usual for recent versions
+                hits=list(hits)
+            hits=np.array(hits[:real_count],np.int64)
         else:
             # actually query against the finite geometry of the edge
             # still not exact, but okay in most cases.  an exact solution
@@ -3101,6 +3728,9 @@ class UnstructuredGrid(Listenable,undoer.OpHistory):
         d['_node_to_cells']=None
         d['_node_index'] = None
         d['_cell_center_index'] = None
+        d['_edge_index'] = None
+        d['_edge_kdtree'] = None
+        d['_cell_kdtree'] = None
         d['log']=None
 
         return d
@@ -3517,21 +4147,22 @@ class UnstructuredGrid(Listenable,undoer.OpHistory):
         xs=np.linspace(p0[0],p1[0],nx)
         ys=np.linspace(p0[1],p1[1],ny)
 
-        # create the nodes
-        for xi,x in enumerate(xs):
-            for yi,y in enumerate(ys):
-                node_ids[xi,yi] = self.add_node(x=[x,y])
-
-        cell_ids=np.zeros( (nx-1,ny-1), int)-1
-
-        # create the cells
-        for xi in range(nx-1):
-            for yi in range(ny-1):
-                nodes=[ node_ids[xi,yi],
-                        node_ids[xi+1,yi],
-                        node_ids[xi+1,yi+1],
-                        node_ids[xi,yi+1] ]
-                cell_ids[xi,yi]=self.add_cell_and_edges(nodes=nodes) 
+        with self.bulk_edit(nodes=nx*ny,edges=2*nx*ny,cells=nx*ny):
+            # create the nodes
+            for xi,x in enumerate(xs):
+                for yi,y in enumerate(ys):
+                    node_ids[xi,yi] = self.add_node(x=[x,y])
+
+            cell_ids=np.zeros( (nx-1,ny-1), int)-1
+
+            # create the cells
+            for xi in range(nx-1):
+                for yi in range(ny-1):
+                    nodes=[ node_ids[xi,yi],
+                            node_ids[xi+1,yi],
+                            node_ids[xi+1,yi+1],
+                            node_ids[xi,yi+1] ]
+                    cell_ids[xi,yi]=self.add_cell_and_edges(nodes=nodes) 
         return {'cells':cell_ids,
                 'nodes':node_ids}
 
@@ -3557,6 +4188,157 @@ class UnstructuredGrid(Listenable,undoer.OpHistory):
         else:
             return hit
 
+    _cell_kdtree=None
+    def cell_kdtree(self):
+        """
+        scipy cKDTree of the centroids of valid cells, for batch queries.
+        Returns (tree,cells), where cells maps tree indices to cell indices.
+        Discarded when cells are changed via add/delete/modify methods,
+        but not when arrays are modified directly.
+        """
+        if self._cell_kdtree is None:
+            from scipy.spatial import cKDTree
+            cells=np.nonzero(~self.cells['deleted'])[0]
+            self._cell_kdtree=(cKDTree(self.cells_centroid(cells)),cells)
+        return self._cell_kdtree
+
+    def points_in_cells(self,xy,cells):
+        """
+        Vectorized point-in-polygon test.
+        xy: [N,2] points
+        cells: [N] cell indices, negative values allowed
+        returns [N] boolean array, True where xy[i] is inside cells[i].
+        Uses a crossing number test, so cells need not be convex.  Points on
+        the boundary are assigned consistently to one of the adjacent cells.
+        """
+        xy=np.asarray(xy,np.float64).reshape([-1,2])
+        cells=np.asarray(cells)
+        result=np.zeros(len(cells),np.bool_)
+        sel=np.nonzero(cells>=0)[0]
+        if len(sel)==0:
+            return result
+        c,side,a,b=self.cell_side_pairs(cells[sel])
+        nsides=(self.cells['nodes'][cells[sel]]>=0).sum(axis=1)
+        row=np.repeat(np.arange(len(sel)),nsides)
+        p=xy[sel[row]]
+        pa=self.nodes['x'][a]
+        pb=self.nodes['x'][b]
+        straddle=(pa[:,1]>p[:,1]) != (pb[:,1]>p[:,1])
+        dy=np.where(straddle,pb[:,1]-pa[:,1],1.0)
+        x_cross=pa[:,0] + (p[:,1]-pa[:,1])*(pb[:,0]-pa[:,0])/dy
+        crossings=straddle & (p[:,0]<x_cross)
+        result[sel]=np.bincount(row,crossings,minlength=len(sel)) % 2 == 1
+        return result
+
+    def points_to_cells(self,xy,prev=None,max_candidates=10,max_walk=10,
+                        chunk=100000):
+        """
+        Batch version of select_cells_nearest(...,inside=True).
+        xy: [N,2] array of points
+        prev: optional [N] array of cells previously containing each point,
+          e.g. from the previous time step of particle tracking.  Negative
+          entries are ignored. Points are first located by walking from prev 
+          across the edge which the point lies beyond, up to max_walk steps.
+        max_candidates: when walking fails or prev is not given, this many
+          of the nearest cells by centroid are tested.
+        chunk: points per block for the candidate search, to bound memory.
+
+        returns [N] array of cell indices, -1 for points not found in a cell.
+        """
+        xy=np.asarray(xy,np.float64).reshape([-1,2])
+        result=np.zeros(len(xy),np.int32)
+        result[:]=-1
+
+        if prev is not None:
+            result=self.walk_points_to_cells(xy,prev,max_walk=max_walk)
+        todo=np.nonzero(result<0)[0]
+        if len(todo)==0 or self.Ncells_valid()==0:
+            return result
+
+        # points outside the bounds of the grid can't be in a cell
+        xxyy=self.bounds()
+        in_bounds=( (xy[todo,0]>=xxyy[0]) & (xy[todo,0]<=xxyy[1]) &
+                    (xy[todo,1]>=xxyy[2]) & (xy[todo,1]<=xxyy[3]) )
+        todo=todo[in_bounds]
+
+        tree,tree_cells=self.cell_kdtree()
+        for start in range(0,len(todo),chunk):
+            blk=todo[start:start+chunk]
+            # usually the nearest centroid is the right cell, so check
+            # that before the more expensive query
+            k0=0
+            for k in [1,max_candidates]:
+                k=min(k,len(tree_cells))
+                _,cand=tree.query(xy[blk],k=k)
+                cand=tree_cells[cand.reshape([len(blk),k])]
+                for ki in range(k0,k):
+                    inside=self.points_in_cells(xy[blk],cand[:,ki])
+                    result[blk[inside]]=cand[inside,ki]
+                    blk=blk[~inside]
+                    cand=cand[~inside]
+                    if len(blk)==0:
+                        break
+                if len(blk)==0:
+                    break
+                k0=k
+        return result
+
+    def walk_points_to_cells(self,xy,cells,max_walk=10):
+        """
+        For each point, start at the given cell and step across the cell
+        edge with the point furthest beyond it, until the containing cell is
+        found.  Assumes CCW cells.
+        xy: [N,2] points
+        cells: [N] starting cells, negative to skip the point.
+        returns [N] array of cells, -1 where the walk left the grid or
+          did not finish in max_walk steps.
+        """
+        xy=np.asarray(xy,np.float64).reshape([-1,2])
+        cells=np.array(cells,np.int32)
+        result=np.zeros(len(xy),np.int32)
+        result[:]=-1
+
+        e2c=self.edge_to_cells() # make sure edges['cells'] are fresh
+        if np.any(self.cells['edges'][~self.cells['deleted']]==self.UNKNOWN):
+            self.update_cell_edges()
+
+        active=np.nonzero(cells>=0)[0]
+        active=active[~self.cells['deleted'][cells[active]]]
+        for step in range(max_walk+1):
+            if len(active)==0:
+                break
+            c=cells[active]
+            inside=self.points_in_cells(xy[active],c)
+            result[active[inside]]=c[inside]
+            if step==max_walk:
+                break
+            active=active[~inside]
+            c=c[~inside]
+
+            # distance of each point beyond each side of its cell,
+            # positive when outside that side
+            cell_nodes=self.cells['nodes'][c]
+            nsides=(cell_nodes>=0).sum(axis=1)
+            sides=np.arange(self.max_sides)
+            nxt=cell_nodes[np.arange(len(c))[:,None],
+                           (sides[None,:]+1)%nsides[:,None]]
+            pa=self.nodes['x'][cell_nodes]
+            pb=self.nodes['x'][nxt]
+            tang=pb-pa
+            p_rel=xy[active,None,:]-pa
+            beyond=(tang[...,1]*p_rel[...,0] - tang[...,0]*p_rel[...,1])
+            beyond/=np.maximum(mag(tang),1e-300)
+            beyond[sides[None,:]>=nsides[:,None]]=-np.inf
+            exit_side=np.argmax(beyond,axis=1)
+
+            j=self.cells['edges'][c,exit_side]
+            jc=e2c[j]
+            nbr=np.where(jc[:,0]==c,jc[:,1],jc[:,0])
+            valid=nbr>=0
+            active=active[valid]
+            cells[active]=nbr[valid]
+        return result
+
     def cell_path(self,i):
         """
         Return a matplotlib Path object representing the closed polygon of
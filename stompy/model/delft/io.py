@@ -6,6 +6,18 @@ import re
 import xarray as xr
 import six
 
+try:
+    # lazy variables lean on xarray internals, which have moved around
+    # between releases.  Without them, his_file_xarray() reads eagerly.
+    from xarray.backends.common import BackendArray
+    from xarray.core import indexing as xr_indexing
+    xr_indexing.LazilyIndexedArray
+    xr_indexing.explicit_indexing_adapter
+    xr_indexing.IndexingSupport.OUTER
+except (ImportError,AttributeError):
+    BackendArray = object
+    xr_indexing = None
+
 import logging
 
 log=logging.getLogger('delft.io')
@@ -13,60 +25,209 @@ log=logging.getLogger('delft.io')
 from . import waq_scenario as waq
 from ... import utils
 
+class HisFile(object):
+    """
+    Memory-mapped access to mixed ascii/binary history files as output by 
+    delwaq, applies to both monitoring output and balance output.
+    Only the header is read up front.  Frames are a memmap, and are
+    only read as they are accessed.  If the file is still being written
+    (i.e. a running simulation), refresh() picks up new frames.
+
+    sim_descs - descriptive text from inp file.
+    time0 - text line giving time origin and units
+    regions - names of regions with numeric index (1-based as read from file)
+    fields - names of fields, separate into substance and process
+    frames - actual data, and timestamps
+    """
+    def __init__(self,fn):
+        self.fn=fn
+
+        with open(fn,'rb') as fp:
+            self.sim_descs=np.fromfile(fp,'S40',4)
+            self.time0=self.sim_descs[3]
+
+            self.n_fields,self.n_regions=np.fromfile(fp,'i4',2)
+
+            fdtype=np.dtype( [ ('sub','S10'),
+                               ('proc','S10') ] )
+
+            self.fields=np.fromfile( fp, fdtype, self.n_fields)
+
+            self.regions=np.fromfile(fp,
+                                     [('num','i4'),('name','S20')],
+                                     self.n_regions)
+            self.data_start=fp.tell()
+
+        # assume that data is 'f4'
+        # following other Delft output, probably each frame is prepended by
+        # 'i4' time index
+        self.frame_dtype=np.dtype( [('tsec','i4'),
+                                    ('data','f4',(self.n_regions,self.n_fields))] )
+        self.n_frames=0
+        self.refresh()
+
+    def refresh(self):
+        """ (re)map the file, returning the number of frames which have been
+        added since the last call.  A trailing partial frame is ignored.
+        """
+        n_old=self.n_frames
+        nbytes=os.stat(self.fn).st_size
+        self.n_frames=(nbytes-self.data_start) // self.frame_dtype.itemsize
+        if self.n_frames>0:
+            self.frames=np.memmap(self.fn,self.frame_dtype,mode='r',
+                                  shape=(self.n_frames,),
+                                  offset=self.data_start)
+        else:
+            self.frames=np.zeros(0,self.frame_dtype)
+        return self.n_frames-n_old
+
+    def region_names(self):
+        return [decstrip(s) for s in self.regions['name']]
+
+    def field_names(self):
+        """ fields as 'sub' or 'sub,proc' """
+        sub_proc=[]
+        for s,p in self.fields:
+            if decstrip(p):
+                sub_proc.append("%s,%s"%(decstrip(s),decstrip(p)))
+            else:
+                sub_proc.append(decstrip(s))
+        return sub_proc
+
+    def dataset(self,region_exclude=None,region_include=None,start=0):
+        """
+        Return the history output as an xarray dataset.  The data variable
+        'bal' (time,region,field) is lazy, such that selecting a subset of 
+        times, regions or fields only reads that subset from the file.
+
+        region_exclude: regular expression for region names to omit from the result
+        region_include: regular expression for region names to include.  
+        start: index of the first frame to include.  When tailing a running
+          simulation, after refresh() the new frames are dataset(start=len(ds.time)).
+
+        Defaults to returning all regions.
+        """
+        ds=xr.Dataset()
+
+        ds['descs']=( ('n_desc',), [decstrip(s) for s in self.sim_descs])
+
+        frames=self.frames[start:]
+        time0,time_unit = parse_time0(self.time0)
+        times=time0 + time_unit*frames['tsec']
+        ds['time']=( ('time',), times)
+        ds['tsec']=( ('time',), np.array(frames['tsec']))
+
+        region_names=self.region_names()
+        subs=[decstrip(s) for s in np.unique(self.fields['sub'])]
+        procs=[decstrip(s) for s in np.unique(self.fields['proc'])]
+
+        if region_include:
+            region_mask=np.array( [bool(re.match(region_include,region))
+                                   for region in region_names] )
+        else:
+            region_mask=np.ones(len(region_names),np.bool_)
+
+        if region_exclude:
+            skip=[bool(re.match(region_exclude,region))
+                  for region in region_names]
+            region_mask &= ~np.array(skip)
+
+        region_idxs=np.nonzero(region_mask)[0]
+        ds['region']=( ('region',), [region_names[i] for i in region_idxs] )
+        ds['sub']  =( ('sub',), subs)
+        ds['proc'] =( ('proc',), procs)
+        ds['field']=( ('field',), self.field_names())
+
+        arr=HisFrameArray(self,start,len(self.frames),region_idxs)
+        if xr_indexing is not None:
+            data=xr_indexing.LazilyIndexedArray(arr)
+        else:
+            data=arr[:,:,:] # older xarray - read eagerly
+        ds['bal']=xr.Variable( ('time','region','field'), data)
+        return ds
+
+class HisFrameArray(BackendArray):
+    """ Read-only (time,region,field) view on the frames of a HisFile,
+    for a fixed range of frames and subset of regions.  Indexing reads 
+    only the requested values from the memmap.
+    """
+    def __init__(self,his,start,stop,region_idxs):
+        self.his=his
+        self.frame_idxs=np.arange(start,stop)
+        self.region_idxs=region_idxs
+        self.shape=(len(self.frame_idxs),len(region_idxs),his.n_fields)
+        self.dtype=np.dtype('f4')
+
+    def __getitem__(self,key):
+        if xr_indexing is None or not hasattr(key,'tuple'):
+            # plain tuple of integers, slices and integer arrays
+            if not isinstance(key,tuple):
+                key=(key,)
+            return self._getitem(key)
+        return xr_indexing.explicit_indexing_adapter(key,self.shape,
+                                                     xr_indexing.IndexingSupport.OUTER,
+                                                     self._getitem)
+
+    def _getitem(self,key):
+        """ outer indexing with one integer, slice or integer array per axis """
+        key=tuple(key) + (slice(None),)*(3-len(key))
+        # translate to indices into the file, keeping track of which
+        # axes are dropped by integer keys
+        idxs=[]
+        keep=[]
+        for k,axis_idxs in zip(key,[self.frame_idxs,self.region_idxs,
+                                    np.arange(self.his.n_fields)]):
+            keep.append( isinstance(k,slice) or np.ndim(k)!=0 )
+            idxs.append( np.atleast_1d(axis_idxs[k]) )
+        # a contiguous range of frames can stay a slice of the memmap, and only
+        # the selected regions and fields of each frame are read.
+        data=self.his.frames['data']
+        t_idxs=idxs[0]
+        if len(t_idxs) and np.all(np.diff(t_idxs)==1):
+            data=data[t_idxs[0]:t_idxs[-1]+1]
+            idxs[0]=np.arange(len(t_idxs))
+        result=np.asarray(data[np.ix_(*idxs)])
+        return result.reshape( [len(i) for i,k in zip(idxs,keep) if k] )
+
+def decstrip(s):
+    try:
+        s=s.decode() # in case binary
+    except AttributeError:
+        pass
+    return s.strip()
+
 def parse_his_file(fn):
     """
     you probably want mon_his_file_dataframe() or bal_his_file_dataframe()
     --
     parse mixed ascii/binary history files as output by delwaq.
     applies to both monitoring output and balance output.
+    See HisFile for lazy, memory-mapped access.
         
     returns tuple:
       sim_descs - descriptive text from inp file.
       time0 - text line giving time origin and units
       regions - names of regions with numeric index (1-based as read from file)
       fields - names of fields, separate into substance and process
-      frames - actual data, and timestamps
+      frames - actual data, and timestamps, memory-mapped
     """
-    fp=open(fn,'rb') 
-
-    sim_descs=np.fromfile(fp,'S40',4)
-    time0=sim_descs[3]
-
-    n_fields,n_regions=np.fromfile(fp,'i4',2)
-
-    fdtype=np.dtype( [ ('sub','S10'),
-                       ('proc','S10') ] )
-
-    fields=np.fromfile( fp, fdtype, n_fields)
-
-    regions=np.fromfile(fp,
-                        [('num','i4'),('name','S20')],
-                        n_regions)
-
-    # assume that data is 'f4'
-    # following other Delft output, probably each frame is prepended by
-    # 'i4' time index
-    frame_dtype=np.dtype( [('tsec','i4'),
-                           ('data','f4',(n_regions,n_fields))] )
-    frames=np.fromfile(fp,frame_dtype)
-
-    return sim_descs,time0,regions,fields,frames
+    his=HisFile(fn)
+    return his.sim_descs,his.time0,his.regions,his.fields,his.frames
 
 def bal_his_file_dataframe(fn):
     sim_descs,time0,regions,fields,frames = parse_his_file(fn)
 
     n_regions=len(regions)
     n_fields=len(fields)
-    cols=[]
-    tuples=[]
 
-    for ri,region in enumerate(regions):
-        for fi,field in enumerate(fields):
-            tuples.append( (region['name'].strip(),
-                            field['sub'].strip(),
-                            field['proc'].strip()) )
+    region_names=np.array([s.strip() for s in regions['name']])
+    subs=np.array([s.strip() for s in fields['sub']])
+    procs=np.array([s.strip() for s in fields['proc']])
 
-    col_index=pd.MultiIndex.from_tuples(tuples,names=('region','sub','proc'))
+    col_index=pd.MultiIndex.from_arrays( [np.repeat(region_names,n_fields),
+                                          np.tile(subs,n_regions),
+                                          np.tile(procs,n_regions)],
+                                         names=('region','sub','proc'))
     df=pd.DataFrame(data=frames['data'].reshape( (-1,n_regions*n_fields) ),
                     index=frames['tsec'],
                     columns=col_index)
@@ -79,57 +240,11 @@ def his_file_xarray(fn,region_exclude=None,region_include=None):
     region_exclude: regular expression for region names to omit from the result
     region_include: regular expression for region names to include.  
 
-    Defaults to returning all regions.
+    Defaults to returning all regions.  The balance data is read lazily,
+    see HisFile.dataset()
     """
-    sim_descs,time_meta,regions,fields,frames = parse_his_file(fn)
-
-    def decstrip(s):
-        try:
-            s=s.decode() # in case binary
-        except AttributeError:
-            pass
-        return s.strip()
-
-    ds=xr.Dataset()
-
-    ds['descs']=( ('n_desc',), [decstrip(s) for s in sim_descs])
-
-    time0,time_unit = parse_time0(time_meta)
-    times=time0 + time_unit*frames['tsec']
-    ds['time']=( ('time',), times)
-    ds['tsec']=( ('time',), frames['tsec'])
-
-    region_names=[decstrip(s) for s in regions['name']]
-    subs=[decstrip(s) for s in np.unique(fields['sub'])]
-    procs=[decstrip(s) for s in np.unique(fields['proc'])]
-
-    if region_include:
-        region_mask=np.array( [bool(re.match(region_include,region))
-                               for region in region_names] )
-    else:
-        region_mask=np.ones(len(region_names),np.bool8)
-
-    if region_exclude:
-        skip=[bool(re.match(region_exclude,region))
-              for region in region_names]
-        region_mask &= ~np.array(skip)
-
-    sub_proc=[]
-    for s,p in fields:
-        if decstrip(p):
-            sub_proc.append("%s,%s"%(decstrip(s),decstrip(p)))
-        else:
-            sub_proc.append(decstrip(s))
-
-    region_idxs=np.nonzero(region_mask)[0]
-    ds['region']=( ('region',), [region_names[i] for i in region_idxs] )
-    ds['sub']  =( ('sub',), subs)
-    ds['proc'] =( ('proc',), procs)
-    ds['field']=( ('field',), sub_proc)
-
-    ds['bal']=( ('time','region','field'),
-                frames['data'][:,region_mask,:] )
-    return ds
+    return HisFile(fn).dataset(region_exclude=region_exclude,
+                               region_include=region_include)
 
 # older name - xarray version doesn't discriminate between balance
 # and monitoring output
@@ -308,6 +308,94 @@ class Hydro(object):
             stop_i+=1
         return self.t_secs[start_i:stop_i]
 
+    # Streaming output of the time series files (.are, .flo, .vol), see write_frames()
+    write_block_size=24 # number of timesteps computed together
+    write_processes=1 # if >1, blocks are computed in that many worker processes
+    write_resume=False # if True, keep the complete frames of an existing output file
+
+    def block_areas(self,t_secs):
+        """ areas for a block of timesteps, [len(t_secs),n_exch]*'f4'
+        Subclasses may override with something faster than one step at a time.
+        """
+        return np.array([self.areas(t) for t in t_secs],'f4').reshape([-1,self.n_exch])
+
+    def block_flows(self,t_secs):
+        """ flows for a block of timesteps, [len(t_secs),n_exch]*'f4' """
+        return np.array([self.flows(t) for t in t_secs],'f4').reshape([-1,self.n_exch])
+
+    def block_volumes(self,t_secs):
+        """ volumes for a block of timesteps, [len(t_secs),n_seg]*'f4' """
+        return np.array([self.volumes(t) for t in t_secs],'f4').reshape([-1,self.n_seg])
+
+    def write_frames(self,filename,block_method,n_values,t_secs=None):
+        """
+        Write a DWAQ binary time series file, an i4 timestamp and n_values f4 values
+        per frame.
+        block_method: name of a method taking an array of t_secs and returning
+          [len(t_secs),n_values], e.g. 'block_areas'
+        t_secs: defaults to self.scen_t_secs
+
+        Blocks of write_block_size steps are computed in order, or with write_processes>1
+        in worker processes, and streamed to the file.  With write_resume, complete
+        frames already in the file which match t_secs are kept, and writing continues
+        from there.
+        """
+        if t_secs is None:
+            t_secs=self.scen_t_secs
+        t_secs=np.asarray(t_secs).astype('i4')
+        frame_dtype=np.dtype([ ('tsecs','i4'),
+                               ('data','f4',(n_values,)) ])
+
+        start=0
+        if self.write_resume and os.path.exists(filename):
+            old=FrameFile(filename,n_values)
+            n=min(len(old),len(t_secs))
+            mismatch=np.nonzero( old.t_secs[:n]!=t_secs[:n] )[0]
+            start=mismatch[0] if len(mismatch) else n
+            del old
+            self.log.info("Resuming %s after %d complete frames"%(filename,start))
+
+        with open(filename,'r+b' if start>0 else 'wb') as fp:
+            # drop any partial or mismatched frames
+            fp.seek(start*frame_dtype.itemsize)
+            fp.truncate()
+            for t_block,data in self.map_time_blocks(block_method,t_secs[start:]):
+                frames=np.zeros(len(t_block),frame_dtype)
+                frames['tsecs']=t_block
+                frames['data']=data
+                fp.write(frames.tobytes())
+                fp.flush()
+
+    def map_time_blocks(self,block_method,t_secs):
+        """ Generator over (t_block,getattr(self,block_method)(t_block)) for blocks
+        of t_secs, in order.  See write_frames.
+        """
+        blocks=[t_secs[i:i+self.write_block_size]
+                for i in range(0,len(t_secs),self.write_block_size)]
+
+        if self.write_processes>1 and len(blocks)>1:
+            from multiprocessing import Pool
+            from collections import deque
+            nproc=min(self.write_processes,len(blocks))
+            pool=Pool(nproc,initializer=_init_hydro_worker,initargs=(self,))
+            try:
+                # keep a bounded number of blocks in flight
+                pending=deque()
+                for block in blocks:
+                    pending.append( (block,pool.apply_async(_hydro_block_worker,
+                                                            ((block_method,block),))) )
+                    if len(pending)>=2*nproc:
+                        block,result=pending.popleft()
+                        yield block,result.get()
+                while pending:
+                    block,result=pending.popleft()
+                    yield block,result.get()
+            finally:
+                pool.terminate()
+        else:
+            for block in blocks:
+                yield block,getattr(self,block_method)(block)
+
     @property 
     def are_filename(self):
         return os.path.join(self.scenario.base_path, self.fn_base+".are")
@@ -316,10 +404,7 @@ class Hydro(object):
         """
         Write are file
         """
-        with open(self.are_filename, 'wb') as fp:
-            for t_sec in self.scen_t_secs.astype('i4'):
-                fp.write(t_sec.tobytes()) # write timestamp
-                fp.write(self.areas(t_sec).astype('f4').tobytes())
+        self.write_frames(self.are_filename,'block_areas',self.n_exch)
 
     @property
     def flo_filename(self):
@@ -329,10 +414,7 @@ class Hydro(object):
         """
         Write flo file
         """
-        with open(self.flo_filename, 'wb') as fp:
-            for t_sec in self.scen_t_secs.astype('i4'):
-                fp.write(t_sec.tobytes()) # write timestamp
-                fp.write(self.flows(t_sec).astype('f4').tobytes())
+        self.write_frames(self.flo_filename,'block_flows',self.n_exch)
 
     def seg_attrs(self, number):
         """ 
@@ -434,10 +516,7 @@ class Hydro(object):
     def write_vol(self):
         """ write vol file
         """
-        with open(self.vol_filename, 'wb') as fp:
-            for t_sec in self.scen_t_secs.astype('i4'):
-                fp.write(t_sec.tobytes()) # write timestamp
-                fp.write(self.volumes(t_sec).astype('f4').tobytes())
+        self.write_frames(self.vol_filename,'block_volumes',self.n_seg)
 
     def vert_diffs(self, t):
         """ returns [n_segs]*'f4' vertical diffusivities in m2/s
@@ -1427,6 +1506,15 @@ class Hydro(object):
                 ngroups+=1
         return groups
 
+# worker process state for Hydro.map_time_blocks
+_worker_hydro=None
+def _init_hydro_worker(hydro):
+    global _worker_hydro
+    _worker_hydro=hydro
+def _hydro_block_worker(job):
+    block_method,t_secs=job
+    return getattr(_worker_hydro,block_method)(t_secs)
+
 def parse_datetime(s):
     """ 
     parse YYYYMMDDHHMMSS style dates.
@@ -1434,6 +1522,60 @@ def parse_datetime(s):
     """
     return datetime.datetime.strptime(s.strip("'"),'%Y%m%d%H%M%S')        
 
+class FrameFile(object):
+    """
+    Memory-mapped access to a DWAQ binary time series file (areas, flows,
+    volumes, segment functions), where each frame is an i4 time stamp 
+    followed by n_values f4 values.  The time stamps are scanned once, so
+    frames can be found by time even when the steps are irregular.
+    Frames are handed out as read-only views on the file.
+    """
+    def __init__(self,filename,n_values):
+        self.filename=filename
+        self.n_values=n_values
+        self.frame_dtype=np.dtype([ ('tsecs','i4'),
+                                    ('data','f4',(n_values,)) ])
+        self.refresh()
+
+    def refresh(self):
+        """ (re)map the file, i.e. if it has grown since it was opened """
+        self.size=os.stat(self.filename).st_size
+        # a trailing partial frame is ignored
+        self.n_frames=self.size // self.frame_dtype.itemsize
+        if self.n_frames>0:
+            self.mapped=np.memmap(self.filename,self.frame_dtype,mode='r',
+                                  shape=(self.n_frames,))
+            self.t_secs=np.array(self.mapped['tsecs'])
+        else:
+            self.mapped=np.zeros(0,self.frame_dtype)
+            self.t_secs=np.zeros(0,'i4')
+
+    def __len__(self):
+        return self.n_frames
+
+    def index(self,t_sec):
+        """ index of the frame with time stamp t_sec, or None """
+        ti=np.searchsorted(self.t_secs,t_sec)
+        if ti<self.n_frames and self.t_secs[ti]==t_sec:
+            return ti
+        hits=np.nonzero(self.t_secs==t_sec)[0] # in case stamps are not sorted
+        if len(hits):
+            return hits[0]
+        return None
+
+    def frame(self,ti):
+        """ data for the frame at index ti, as a view [n_values] """
+        return self.mapped['data'][ti]
+
+    def frames(self,t0=None,t1=None):
+        """ all frames with t0<=time stamp<t1, returning a tuple of 
+        time stamps [n] and data [n,n_values], a view on the file.
+        Assumes time stamps are increasing.
+        """
+        i0=0 if t0 is None else np.searchsorted(self.t_secs,t0)
+        i1=self.n_frames if t1 is None else np.searchsorted(self.t_secs,t1)
+        return self.t_secs[i0:i1],self.mapped['data'][i0:i1]
+
 class HydroFiles(Hydro):
     """ 
     DWAQ hydro data read from existing files, by parsing
@@ -1647,23 +1789,16 @@ class HydroFiles(Hydro):
                         self.are_filename)
 
     def areas(self,t):
-        ti=self.t_sec_to_index(t)
-
-        stride=4+self.n_exch*4
-        area_fn=self.get_path('areas-file')
-        with open(area_fn,'rb') as fp:
-            fp.seek(stride*ti)
-            tstamp_data=fp.read(4)
-            if len(tstamp_data)<4 and ti==len(self.t_secs)-1:
+        ff=self.frame_file('areas-file')
+        ti=ff.index(t)
+        if ti is None:
+            ti=self.t_sec_to_index(t)
+            if ti>=len(ff) and ti==len(self.t_secs)-1:
                 self.log.info("Short read on last frame of area data - use prev")
                 assert ti>0
-                fp.seek(stride*(ti-1))
-                tstamp_data=fp.read(4)
-            else:
-                tstamp=np.fromstring(tstamp_data,'i4')[0]
-                if tstamp!=t:
-                    print("WARNING: time stamp mismatch: %d [file] != %d [requested]"%(tstamp,t))
-            return np.fromstring(fp.read(self.n_exch*4),'f4')
+                return ff.frame(ti-1)
+            print("WARNING: time stamp mismatch: %d [file] != %d [requested]"%(ff.t_secs[ti],t))
+        return ff.frame(ti)
 
     def write_vol(self):
         if not self.enable_write_symlink:
@@ -1675,6 +1810,26 @@ class HydroFiles(Hydro):
     def volumes(self,t):
         return self.seg_func(t,label='volumes-file')
 
+    _frame_files=None
+    def frame_file(self,label=None,fn=None):
+        """
+        FrameFile for a binary time series file, given by its key in the hyd file
+        (e.g. "areas-file") or full path.  Area and flow files have a value per
+        exchange, all others a value per segment.  FrameFiles are cached, so the
+        file is mapped and its time stamps scanned once.
+        """
+        filename=fn or self.get_path(label)
+        if label in ['areas-file','flows-file']:
+            n_values=self.n_exch
+        else:
+            n_values=self.n_seg
+        if self._frame_files is None:
+            self._frame_files={}
+        ff=self._frame_files.get(filename,None)
+        if ff is None or ff.n_values!=n_values:
+            ff=self._frame_files[filename]=FrameFile(filename,n_values)
+        return ff
+
     def seg_func(self,t_sec=None,fn=None,label=None):
         """ 
         Get segment function data at a given timestamp (must match a timestamp
@@ -1684,66 +1839,43 @@ class HydroFiles(Hydro):
         label: key in the hydr file (e.g. "volumes-file")
         
         if t_sec is not specified, returns a callable which takes t_sec
+
+        The data is a read-only view on the file.
         """
         def f(t_sec,closest=False):
             if isinstance(t_sec,datetime.datetime):
                 t_sec = int( (t_sec - self.time0).total_seconds() )
-            
-            filename=fn or self.get_path(label)
-            # Optimistically assume that the seg function has the same time steps
-            # as the hydro:
-            ti=self.t_sec_to_index(t_sec) 
 
-            stride=4+self.n_seg*4
-            
-            with open(filename,'rb') as fp:
-                fp.seek(stride*ti)
-                tstamp=np.fromfile(fp,'i4',1)
-                
-                if len(tstamp)==0 or tstamp[0]!=t_sec:
-                    if 0:# old behavior, no scanning:
-                        if len(tstamp)==0:
-                            print("WARNING: no timestamp read for seg function")
-                        else: 
-                            print("WARNING: time stamp mismatch: %s != %d should scan but won't"%(tstamp[0],t_sec))
-                    else: # new behavior to accomodate hydro parameters with variable time steps
-                        # assumes at least two time steps, and that all steps are the same size
-                        fp.seek(0)
-                        tstamp0=np.fromfile(fp,'i4',1)[0]
-                        fp.seek(stride*1)
-                        tstamp1=np.fromfile(fp,'i4',1)[0]
-                        dt=tstamp1 - tstamp0
-                        ti,err=divmod( t_sec-tstamp0, dt )
-                        if err!=0:
-                            print("WARNING: time stamp mismatch after inferring nonstandard time step")
-                        # also check for bounds:
-                        warning=None
-                        if ti<0:
-                            if t_sec>=0:
-                                warning="WARNING: inferred time index %d is negative!"%ti
-                            else:
-                                # kludgey - the problem is that something like the temperature field
-                                # can have a different time line, and to be sure that it has data
-                                # t=0, an extra step at t<0 is included.  But then there isn't any
-                                # volume data to be used, and that comes through here, too.
-                                # so downgrade it to a less dire message
-                                warning="INFO: inferred time index %d is negative, ignoring as t=%d"%(ti,t_sec)
-                            ti=0
-                        max_ti=os.stat(filename).st_size // stride
-                        if ti>=max_ti:
-                            warning="WARNING: inferred time index %d is beyond the end of the file!"%ti
-                            ti=max_ti-1
-                        # try that again:
-                        fp.seek(stride*ti)
-                        tstamp=np.fromfile(fp,'i4',1)
-                        if warning is None and tstamp[0]!=t_sec:
-                            warning="WARNING: Segment function appears to have unequal steps"
-                        if warning:
-                            #import pdb
-                            #pdb.set_trace()
-                            print(warning)
-
-                return np.fromfile(fp,'f4',self.n_seg)
+            ff=self.frame_file(label=label,fn=fn)
+            ti=ff.index(t_sec)
+
+            if ti is None:
+                # the seg function may have a different timeline than the
+                # hydro, e.g. hydro parameters with variable time steps.
+                # fall back to the frame at or before t_sec.
+                warning=None
+                if len(ff)==0:
+                    raise Exception("No frames in segment function %s"%ff.filename)
+                if t_sec<ff.t_secs[0]:
+                    if t_sec>=0:
+                        warning="WARNING: time %d is before the first frame at %d!"%(t_sec,ff.t_secs[0])
+                    else:
+                        # kludgey - the problem is that something like the temperature field
+                        # can have a different time line, and to be sure that it has data
+                        # t=0, an extra step at t<0 is included.  But then there isn't any
+                        # volume data to be used, and that comes through here, too.
+                        # so downgrade it to a less dire message
+                        warning="INFO: time %d is before the first frame, ignoring as t<0"%t_sec
+                    ti=0
+                elif t_sec>ff.t_secs[-1]:
+                    warning="WARNING: time %d is beyond the end of the file!"%t_sec
+                    ti=len(ff)-1
+                else:
+                    warning="WARNING: Segment function has no frame at %d, using the preceding frame"%t_sec
+                    ti=np.searchsorted(ff.t_secs,t_sec,side='right')-1
+                print(warning)
+
+            return ff.frame(ti)
         if t_sec is None:
             return f
         else:
@@ -1766,21 +1898,15 @@ class HydroFiles(Hydro):
         since flow is integrated over [t,t+dt].  Checks file size and may return
         zero flow
         """
-        ti=self.t_sec_to_index(t)
-        
-        stride=4+self.n_exch*4
-        flo_fn=self.get_path('flows-file')
-        with open(flo_fn,'rb') as fp:
-            fp.seek(stride*ti)
-            tstamp_data=fp.read(4)
-            if len(tstamp_data)<4 and ti==len(self.t_secs)-1:
+        ff=self.frame_file('flows-file')
+        ti=ff.index(t)
+        if ti is None:
+            ti=self.t_sec_to_index(t)
+            if ti>=len(ff) and ti==len(self.t_secs)-1:
                 self.log.info("Short read on last frame of flow data - fabricate zero flows")
                 return np.zeros(self.n_exch,'f4')
-            else:
-                tstamp=np.fromstring(tstamp_data,'i4')[0]
-                if tstamp!=t:
-                    print("WARNING: time stamp mismatch: %d != %d"%(tstamp,t))
-                return np.fromstring(fp.read(self.n_exch*4),'f4')
+            print("WARNING: time stamp mismatch: %d != %d"%(ff.t_secs[ti],t))
+        return ff.frame(ti)
 
     @property
     def pointers(self):
@@ -3337,15 +3463,79 @@ class DwaqAggregator(Hydro):
         # has constant areas in the vertical (i.e. it's original hydro cells which
         # don't have any partial areas
         if self.exch_z_area_constant:
-            if not self.warned_forcing_constant_area:
-                self.warned_forcing_constant_area=True
-                self.log.warning('Forcing constant area within water column')
-            self.monotonicize_areas(areas)
-            self.monotonicize_areas(areas,top_down=True)
+            self.force_constant_area(areas)
         return areas
 
+    def force_constant_area(self,areas):
+        """ make vertical exchange areas constant within each water column, in place.
+        areas: [n_exch] or [...,n_exch]
+        """
+        if not self.warned_forcing_constant_area:
+            self.warned_forcing_constant_area=True
+            self.log.warning('Forcing constant area within water column')
+        self.monotonicize_areas(areas)
+        self.monotonicize_areas(areas,top_down=True)
+
+    def proc_frames(self,p,method,t_secs):
+        """ unaggregated data from processor p for a block of timesteps,
+        [len(t_secs),n] where method is 'areas', 'flows' or 'volumes'.
+        """
+        hyd=self.open_hyd(p)
+        if isinstance(hyd,HydroFiles):
+            # read straight from the memory-mapped file when all steps are there
+            label={'areas':'areas-file','flows':'flows-file','volumes':'volumes-file'}[method]
+            ff=hyd.frame_file(label)
+            idxs=[ff.index(t) for t in t_secs]
+            if None not in idxs:
+                return ff.mapped['data'][idxs]
+        return np.array([getattr(hyd,method)(t) for t in t_secs])
+
+    def overrides(self,name):
+        """ True if a subclass replaces DwaqAggregator's implementation of the
+        given method, in which case block methods go through the subclass method
+        one step at a time.
+        """
+        return ( six.get_unbound_function(getattr(type(self),name))
+                 is not six.get_unbound_function(getattr(DwaqAggregator,name)) )
+
+    def block_areas(self,t_secs):
+        """ areas for a block of timesteps, as sparse matrix products over the
+        processors, [len(t_secs),n_exch]*'f4'
+        """
+        if self.overrides('areas'):
+            return super(DwaqAggregator,self).block_areas(t_secs)
+        areas=np.zeros( (len(t_secs),self.n_exch),'f4')
+        for p,Earea in iteritems(self.area_matrix):
+            areas += Earea.dot(self.proc_frames(p,'areas',t_secs).T).T
+        if self.exch_z_area_constant:
+            self.force_constant_area(areas)
+        return areas
+
+    def block_flows(self,t_secs):
+        """ flows for a block of timesteps, [len(t_secs),n_exch]*'f4' """
+        if self.overrides('flows'):
+            return super(DwaqAggregator,self).block_flows(t_secs)
+        flows=np.zeros( (len(t_secs),self.n_exch),'f4')
+        for p,Eflow in iteritems(self.flow_matrix):
+            flows += Eflow.dot(self.proc_frames(p,'flows',t_secs).T).T
+        return flows
+
+    def block_volumes(self,t_secs,min_volume=0.00001):
+        """ volumes for a block of timesteps, [len(t_secs),n_seg]*'f4' """
+        if self.overrides('volumes') or self.overrides('segment_aggregator'):
+            return super(DwaqAggregator,self).block_volumes(t_secs)
+        agg_volumes=np.zeros( (len(t_secs),self.n_seg),'f4')
+        for p in range(self.nprocs):
+            if np.all(self.seg_local_to_agg[p,:]<0):
+                continue
+            vols=self.proc_frames(p,'volumes',t_secs)
+            if min_volume>0:
+                vols=vols.clip(min_volume,np.inf)
+            agg_volumes += self.seg_matrix[p].dot(vols.T).T
+        return agg_volumes
+
     def monotonicize_areas(self,areas,top_down=False):
-        """ areas: n_exch * 'f4'
+        """ areas: n_exch * 'f4', or [...,n_exch] for many frames at once.
         Modify areas so that vertical exchange areas are monotonically 
         decreasing.
         by default, this means starting at the bottom of the water column
@@ -3353,8 +3543,80 @@ class DwaqAggregator(Hydro):
         also be called with top_down=True, to do the opposite.  This is mostly
         just useful to make the area constant in the entire water column
         """
-        # self.log.info("Call to monotonicize areas!")
-        # this looks very slow.
+        plan=self.monotonicize_plan(top_down)
+        if plan is None:
+            for frame_areas in areas.reshape([-1,self.n_exch]):
+                self.monotonicize_areas_loop(frame_areas,top_down=top_down)
+            return
+        clip_js,levels=plan
+        areas[...,clip_js]=np.maximum(areas[...,clip_js],0)
+        for js,preds in levels:
+            areas[...,js]=np.maximum(areas[...,js],areas[...,preds])
+
+    _monotonicize_plans=None
+    def monotonicize_plan(self,top_down):
+        """
+        Precompute the order of updates in monotonicize_areas_loop(), from pointers.
+        Returns (clip_js,levels), where exchanges clip_js are clipped to be
+        non-negative, and for each (js,preds) in levels, js takes the max of
+        itself and preds, the exchange beyond it in the column.  Each level depends 
+        only on earlier levels.
+        Returns None if a segment has several vertical exchanges on one side,
+        in which case the loop is used.
+        """
+        pointers=self.pointers
+        if self._monotonicize_plans is None:
+            self._monotonicize_plans={}
+        cached=self._monotonicize_plans.get(top_down,None)
+        if cached is not None and cached[0] is pointers:
+            return cached[1]
+
+        js=np.arange(self.n_exch-self.n_exch_z,self.n_exch)
+        top=pointers[js,0] - 1
+        bot=pointers[js,1] - 1
+        if top_down:
+            # exchanges processed in order, reading the segment above and
+            # updating the segment below
+            src,dst=top,bot
+            pos=np.arange(len(js))
+        else:
+            src,dst=bot,top
+            pos=np.arange(len(js))[::-1]
+
+        plan=None
+        has_dst=dst>=0
+        if len(js)==0:
+            plan=(js,[])
+        elif len(np.unique(dst[has_dst]))==has_dst.sum():
+            # the exchange which updates each segment
+            updater=-np.ones(1+max(src.max(),dst.max(),0),np.int64)
+            updater[dst[has_dst]]=np.nonzero(has_dst)[0]
+            has_src=src>=0
+            pred=-np.ones(len(js),np.int64)
+            pred[has_src]=updater[src[has_src]]
+            # only updates which happened earlier in the loop count
+            late=(pred>=0)
+            late[late]=pos[pred[late]]>pos[late]
+            pred[late]=-1
+
+            # level of each exchange in its chain of updates
+            level=np.where(pred>=0,-1,0)
+            while np.any(level<0):
+                todo=np.nonzero(level<0)[0]
+                ready=level[pred[todo]]>=0
+                level[todo[ready]]=level[pred[todo[ready]]]+1
+            levels=[]
+            for l in range(1,level.max()+1):
+                sel=np.nonzero(level==l)[0]
+                levels.append( (js[sel],js[pred[sel]]) )
+            plan=(js[has_src],levels)
+        self._monotonicize_plans[top_down]=(pointers,plan)
+        return plan
+
+    def monotonicize_areas_loop(self,areas,top_down=False):
+        """ Reference implementation of monotonicize_areas, one exchange at a time.
+        areas: n_exch * 'f4'.  
+        """
         seg_A=np.zeros(self.n_seg)
         pointers=self.pointers
         js=np.arange(self.n_exch-self.n_exch_z,self.n_exch)
@@ -4436,59 +4698,105 @@ class FilterHydroBC(Hydro):
 
     seg_active = forwardTo('orig','seg_active')
     
-    def apply_filter(self):
-        self.filt_volumes=np.array( [self.orig.volumes(t) for t in self.orig.t_secs] )
-        self.filt_flows  =np.array( [self.orig.flows(t)   for t in self.orig.t_secs] )
-        self.filt_areas  =np.array( [self.orig.areas(t)   for t in self.orig.t_secs] )
-        self.orig_volumes=self.filt_volumes.copy()
-        self.orig_flows  =self.filt_flows.copy()
-        
-        dt=np.median(np.diff(self.t_secs))
-        pointers=self.pointers
+    # The filtering works on disk-backed arrays [time,exchange] and [time,segment],
+    # in blocks of timesteps (reading the original hydro) and blocks of exchanges
+    # (filtering along time).
+    work_dir=None # directory for the disk-backed arrays, defaults to the system temp dir
+    filter_block_steps=100 # timesteps per block when reading and scanning
+    filter_block_exchanges=1000 # exchanges filtered together
+    filter_threads=1 # >1 to filter blocks of exchanges in parallel
+
+    def disk_array(self,shape,dtype='f4'):
+        """ zeroed array backed by an anonymous temporary file """
+        import tempfile
+        return np.memmap(tempfile.TemporaryFile(dir=self.work_dir),
+                         dtype=dtype,mode='w+',shape=shape)
+
+    def time_blocks(self):
+        """ slices over timesteps, of filter_block_steps each """
+        n=len(self.t_secs)
+        return [slice(i,min(n,i+self.filter_block_steps))
+                for i in range(0,n,self.filter_block_steps)]
+
+    def map_exchange_blocks(self,func,exchs):
+        """ call func on blocks of exchange indices, possibly in parallel threads """
+        blocks=[exchs[i:i+self.filter_block_exchanges]
+                for i in range(0,len(exchs),self.filter_block_exchanges)]
+        if self.filter_threads>1 and len(blocks)>1:
+            from multiprocessing.pool import ThreadPool
+            pool=ThreadPool(min(self.filter_threads,len(blocks)))
+            try:
+                pool.map(func,blocks)
+            finally:
+                pool.close()
+        else:
+            for block in blocks:
+                func(block)
 
+    def lowpass_columns(self,data):
+        """ lowpass each column of data [time,n], padded with zeros to
+        limit the transients at the ends.
+        """
+        dt=np.median(np.diff(self.t_secs))
         # 4th order butterworth gives better rejection of tidal
         # signal than FIR filter.
-        # but there can be some transients at the beginning, so pad the flows
+        # but there can be some transients at the beginning, so pad 
         # out with 0s:
         npad=int(5*self.lp_secs / dt)
-        pad =np.zeros(npad)
+        padded=np.zeros( (len(data)+2*npad,) + data.shape[1:] )
+        padded[npad:npad+len(data)]=data
+        lp=filters.lowpass(padded,cutoff=self.lp_secs,dt=dt,axis=0,sos=True)
+        return lp[npad:npad+len(data)] # trim the pad
+
+    def apply_filter(self):
+        n_t=len(self.t_secs)
+        self.orig_volumes=self.disk_array( (n_t,self.n_seg) )
+        self.orig_flows  =self.disk_array( (n_t,self.n_exch) )
+        self.filt_areas  =self.disk_array( (n_t,self.n_exch) )
+        for blk in self.time_blocks():
+            t_blk=self.t_secs[blk]
+            self.orig_volumes[blk]=self.orig.block_volumes(t_blk)
+            self.orig_flows[blk]  =self.orig.block_flows(t_blk)
+            self.filt_areas[blk]  =self.orig.block_areas(t_blk)
+        self.filt_volumes=self.disk_array( (n_t,self.n_seg) )
+        self.filt_flows  =self.disk_array( (n_t,self.n_exch) )
+        self.filt_volumes[:]=self.orig_volumes
+        self.filt_flows[:]  =self.orig_flows
         
-        for j in self.exchanges_to_filter():
-            # j: index into self.pointers.  
-            segA,segB=pointers[j,:2]
-
-            flow_padded=np.concatenate( ( pad, 
-                                          self.filt_flows[:,j],
-                                          pad) )
-            lp_flows=filters.lowpass(flow_padded,
-                                     cutoff=self.lp_secs,dt=dt)
-            lp_flows=lp_flows[npad:-npad] # trim the pad
-            
+        pointers=self.pointers
+        step_dt=np.diff(self.t_secs)
+        lock=threading.Lock()
+
+        def filter_block(js):
+            # js: indices into self.pointers.  
+            flows=np.array(self.filt_flows[:,js],np.float64)
+            lp_flows=self.lowpass_columns(flows)
+
             # separate into tidal and subtidal constituents
-            tidal_flows=self.filt_flows[:,j]-lp_flows
-            self.filt_flows[:,j]=lp_flows 
+            tidal_flows=flows-lp_flows
+            tidal_volumes=np.zeros_like(tidal_flows)
+            tidal_volumes[1:]=np.cumsum(tidal_flows[:-1]*step_dt[:,None],axis=0)
 
-            tidal_volumes= np.cumsum(tidal_flows[:-1]*np.diff(self.t_secs))
-            tidal_volumes= np.concatenate ( ( [0],
-                                              tidal_volumes ) )
             # a positive flow is *out* of segA, and *in* to segB
             # positive volumes represent water which is now part of the cell
-            if segA>0:
-                self.filt_volumes[:,segA-1] += tidal_volumes
-                #if np.any( self.filt_volumes[:,segA-1]<0 ):
-                #    self.log.warning("while filtering fluxes had negative volume (may be temporary)")
-            if segB>0:
-                self.filt_volumes[:,segB-1] -= tidal_volumes
-                #if np.any( self.filt_volumes[:,segB-1]<0 ):
-                #    self.log.warning("while filtering fluxes had negative volume (may be temporary)")
+            segA,segB=pointers[js,0],pointers[js,1]
+            selA=segA>0
+            selB=segB>0
+            with lock:
+                self.filt_flows[:,js]=lp_flows
+                np.add.at(self.filt_volumes,(slice(None),segA[selA]-1), tidal_volumes[:,selA])
+                np.add.at(self.filt_volumes,(slice(None),segB[selB]-1),-tidal_volumes[:,selB])
+
+        self.map_exchange_blocks(filter_block,self.exchanges_to_filter())
 
         self.adjust_negative_volumes()
 
         # it's possible to have some transient negative volumes that work themselves out
         # when other fluxes are included.  but in the end, can't have any negatives.
-        assert( np.all(self.filt_volumes>=0) )
+        min_vol=min( [self.filt_volumes[blk].min() for blk in self.time_blocks()] )
+        assert( min_vol>=0 )
 
-        if np.any(self.filt_volumes<self.min_volume):
+        if min_vol<self.min_volume:
             self.log.warning("All volumes non-negative, but some below threshold of %f"%self.min_volume)
 
         self.adjust_plan_areas()
@@ -4499,8 +4807,10 @@ class FilterHydroBC(Hydro):
     # areas can be zero.  Since those are closely linked, it's easiest and doesn't 
     # seem to break anything to enforce a min_area here.
     def adjust_negative_volumes(self):
-        has_negative=np.nonzero( np.any(self.filt_volumes<self.min_volume,axis=0 ) )[0]
-        dt=np.median(np.diff(self.t_secs))
+        has_negative=np.zeros(self.n_seg,np.bool_)
+        for blk in self.time_blocks():
+            has_negative |= np.any(self.filt_volumes[blk]<self.min_volume,axis=0)
+        has_negative=np.nonzero(has_negative)[0]
 
         for seg in has_negative:
             self.log.info("Attempting to undo negative volumes in seg %d"%seg)
@@ -4558,52 +4868,54 @@ class FilterHydroBC(Hydro):
         # group in the sense of SQL group by
         groups=self.orig.seg_to_2d_element
 
-        volumes     =np.array( [self.volumes(t)      for t in self.t_secs] )
-        orig_volumes=np.array( [self.orig.volumes(t) for t in self.t_secs] )
-
-        # sum volume in each water column
+        # sum volume in each water column, as a sparse matrix product.
         # might have dense output of z-levels, for which there segments which don't
-        # belong to a water column - bincount doesn't like those negative values.
-        valid=groups>=0
-        
-        Vratio_filt_to_orig_2d=[ np.bincount(groups[valid],volumes[ti,valid])  / \
-                                 np.bincount(groups[valid],orig_volumes[ti,valid])                                 
-                                 for ti in range(len(self.t_secs)) ]
-        Afactor_per_2d_element=np.array( Vratio_filt_to_orig_2d )
+        # belong to a water column
+        valid=np.nonzero(groups>=0)[0]
+        G=sparse.coo_matrix( (np.ones(len(valid)),(groups[valid],valid)),
+                             (groups.max()+1,self.n_seg) ).tocsr()
 
-        # loop over vertical exchanges, updating areas
+        # the water column of each vertical exchange
         exchs=self.pointers
-        for j in range(self.n_exch_x+self.n_exch_y,self.n_exch):
-            segA,segB=exchs[j,:2] - 1 # seg now 0-based
-            if segA<0: # boundary
-                group=groups[segB]
-            elif segB<0: # boundary
-                group=groups[segA]
-            else:
-                assert(groups[segA]==groups[segB])
-                group=groups[segA]
-            # update this exchanges area, for all time steps
-            self.filt_areas[:,j] *= Afactor_per_2d_element[:,group]
+        jz=np.arange(self.n_exch_x+self.n_exch_y,self.n_exch)
+        segA,segB=exchs[jz,0]-1,exchs[jz,1]-1 # seg now 0-based
+        groupA=groups[segA.clip(0)]
+        groupB=groups[segB.clip(0)]
+        interior=(segA>=0)&(segB>=0)
+        assert np.all( groupA[interior]==groupB[interior] )
+        group_j=np.where(segA<0,groupB,groupA)
+
+        for blk in self.time_blocks():
+            Afactor_per_2d_element=( G.dot(np.asarray(self.filt_volumes[blk],np.float64).T) / 
+                                     G.dot(np.asarray(self.orig_volumes[blk],np.float64).T) ).T
+            # update the vertical exchange areas, for all time steps
+            self.filt_areas[blk,jz] = self.filt_areas[blk][:,jz] * Afactor_per_2d_element[:,group_j]
 
         # clean up a slightly different issue while we're at it.
         # since upper layers can dry out, it's possible that we'll
         # add some lowpass flow, but the area will be zero.
         # there is also the very likely case that unused exchanges
         # have zero flow and zero area, but maybe that's not a big deal.
-        for exch in range(self.n_exch):
-            sel=(self.filt_areas[:,exch]==0) & (self.filt_flows[:,exch]!=0)
-            if np.any(sel):
-                self.log.warning("Cleaning up zero area exchange %d"%exch)
-                if np.all( self.filt_areas[:,exch]==0  ):
-                    raise Exception("An exchange has some flow, but never has any area")
-                self.filt_areas[sel,exch] = np.nan
-                self.filt_areas[:,exch] = utils.fill_invalid(self.filt_areas[:,exch])
+        to_clean=np.zeros(self.n_exch,np.bool_)
+        for blk in self.time_blocks():
+            to_clean |= np.any( (self.filt_areas[blk]==0) & (self.filt_flows[blk]!=0), axis=0)
+        for exch in np.nonzero(to_clean)[0]:
+            areas=np.array(self.filt_areas[:,exch])
+            sel=(areas==0) & (self.filt_flows[:,exch]!=0)
+            self.log.warning("Cleaning up zero area exchange %d"%exch)
+            if np.all( areas==0  ):
+                raise Exception("An exchange has some flow, but never has any area")
+            areas[sel] = np.nan
+            self.filt_areas[:,exch] = utils.fill_invalid(areas)
                 
         # and finally, delwaq2 doesn't like to have any zero-area exchanges, even if
         # they never have any flow.  so they all get unit area.
-        
-        self.filt_areas[ self.filt_areas<self.min_area ] = self.min_area
+        self.clip_areas()
 
+    def clip_areas(self):
+        for blk in self.time_blocks():
+            areas=self.filt_areas[blk]
+            areas[ areas<self.min_area ] = self.min_area
 
     def exchanges_to_filter(self):
         """
@@ -4623,7 +4935,7 @@ class FilterHydroBC(Hydro):
         else:
             selection=np.asarray(selection)
             if selection.dtype==np.bool8:
-                sel=np.nonzero(selection)
+                sel=np.nonzero(selection)[0]
             else:
                 sel=selection
         return sel
@@ -4638,6 +4950,13 @@ class FilterHydroBC(Hydro):
         ti=self.t_sec_to_index(t)
         return self.filt_areas[ti,:]
 
+    def block_volumes(self,t_secs):
+        return self.filt_volumes[self.t_sec_to_index(t_secs)]
+    def block_flows(self,t_secs):
+        return self.filt_flows[self.t_sec_to_index(t_secs)]
+    def block_areas(self,t_secs):
+        return self.filt_areas[self.t_sec_to_index(t_secs)]
+
     def planform_areas(self):
         """ Here have to take into account the time-variability of
         planform area.
@@ -4708,28 +5027,17 @@ class FilterAll(FilterHydroBC):
         But when filtering all exchanges, probably better to just remove 
         tidal variation from horizontal exchanges.  
         """
-        dt=np.median(np.diff(self.t_secs))
-
-        npad=int(5*self.lp_secs / dt)
-        pad =np.zeros(npad)
-        
-        # loop over horizontal exchanges, updating areas
-        poi0=self.pointers-1
-        for j in range(self.n_exch_x+self.n_exch_y):
-            padded=np.concatenate( ( pad, 
-                                     self.filt_areas[:,j],
-                                     pad) )
-            lp_areas=filters.lowpass(padded,cutoff=self.lp_secs,dt=dt)
-            lp_areas=lp_areas[npad:-npad] # trim the pad
-            
-            self.filt_areas[:,j] = lp_areas
+        # lowpass the horizontal exchange areas
+        def filter_block(js):
+            self.filt_areas[:,js]=self.lowpass_columns(np.array(self.filt_areas[:,js],np.float64))
+        self.map_exchange_blocks(filter_block,np.arange(self.n_exch_x+self.n_exch_y))
 
         # FilterHydroBC does some extra work right here, but I'm hoping that's
         # not necessary??
                 
         # and finally, delwaq2 doesn't like to have any zero-area exchanges, even if
         # they never have any flow.  so they all get unit area.
-        self.filt_areas[ self.filt_areas<self.min_area ] = self.min_area
+        self.clip_areas()
 
     def planform_areas(self):
         """ Skip FilterHydroBC's filtering of planform areas, use the original hydro
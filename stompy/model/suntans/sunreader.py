@@ -36,6 +36,23 @@ from numpy import *
 
 from ...spatial.linestring_utils import upsample_linearring
 
+try:
+    import xarray as xr
+except ImportError:
+    xr = None
+
+try:
+    # lazy variables in global_dataset() lean on xarray internals, which
+    # have moved around between releases.  Without them, fall back to dask.
+    from xarray.backends.common import BackendArray
+    from xarray.core import indexing as xr_indexing
+    xr_indexing.LazilyIndexedArray
+    xr_indexing.explicit_indexing_adapter
+    xr_indexing.IndexingSupport.OUTER
+except (ImportError,AttributeError):
+    BackendArray = object
+    xr_indexing = None
+
 try:
     import pytz
     utc = pytz.timezone('utc')
@@ -1342,6 +1359,95 @@ class SunConfig(GenericConfig):
                 'vertspace.dat']
         return self.is_equal(other,limit_to_keys=keys)
 
+def outer_index(a,keys):
+    """ Index a with one key per leading axis, each an integer, slice or
+    integer array, applied independently (orthogonal indexing, as opposed
+    to numpy's broadcasting of multiple index arrays).
+    """
+    axis = 0
+    for k in keys:
+        if isinstance(k,slice):
+            a = a[ (slice(None),)*axis + (k,) ]
+            axis += 1
+        elif ndim(k)==0:
+            a = a[ (slice(None),)*axis + (int(k),) ]
+        else:
+            a = take(a,asarray(k),axis=axis)
+            axis += 1
+    return a
+
+class GlobalCellArray(BackendArray):
+    """ Read-only array over per-processor output, with dimensions
+    [time, global cell, ...].  Nothing is read until indexed, and then
+    only the requested timesteps and cells are pulled from each
+    processor's memmap.  Each global cell is read from its owning
+    processor, so ghost cells are dropped.  Cells with no owner are nan.
+    """
+    def __init__(self,reader,g2l,nsteps):
+        """ reader: function of processor, returning an array
+          [time, local cell, ...], typically a memmap.
+        g2l: the global to local mapping from map_global_cells_to_local_cells()
+        nsteps: number of timesteps to expose, at most the length of each
+          processor's output.
+        """
+        self.reader = reader
+        self.g2l = g2l
+        sample = reader(g2l['proc'].max())
+        self.dtype = sample.dtype
+        self.shape = (nsteps,len(g2l)) + sample.shape[2:]
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self,key):
+        if xr_indexing is not None and isinstance(key,xr_indexing.ExplicitIndexer):
+            return xr_indexing.explicit_indexing_adapter(key,self.shape,
+                                                         xr_indexing.IndexingSupport.OUTER,
+                                                         self._getitem)
+        return self._getitem(key)
+
+    def _getitem(self,key):
+        """ outer indexing, see outer_index() """
+        if not isinstance(key,tuple):
+            key = (key,)
+        key = key + (slice(None),)*(self.ndim-len(key))
+
+        # normalize the time key so that it cannot reach past nsteps
+        tkey = key[0]
+        if isinstance(tkey,slice) and (tkey.step is None or tkey.step>0):
+            # stays a view on the memmaps
+            tkey = slice(*tkey.indices(self.shape[0]))
+        else:
+            tkey = arange(self.shape[0])[tkey]
+        cells = arange(self.shape[1])[key[1]]
+        scalar_cell = (ndim(cells)==0)
+        cells = atleast_1d(cells)
+        cell_axis = 1 if ndim(tkey)>0 or isinstance(tkey,slice) else 0
+
+        # the shape of the result, without reading anything
+        empty = broadcast_to(array(nan,self.dtype),
+                             (self.shape[0],len(cells))+self.shape[2:])
+        result = array( outer_index(empty,(tkey,slice(None))+key[2:]) )
+
+        procs = self.g2l['proc'][cells]
+        locals_ = self.g2l['local'][cells]
+
+        for p in unique(procs):
+            if p < 0:
+                continue # cells without an owner stay nan
+            sel = nonzero(procs==p)[0]
+            block = outer_index(self.reader(p),(tkey,locals_[sel])+key[2:])
+            result[ (slice(None),)*cell_axis + (sel,) ] = block
+        if scalar_cell:
+            result = result[ (slice(None),)*cell_axis + (0,) ]
+        return result
+
+    def __array__(self,dtype=None):
+        return asarray(self[...],dtype=dtype)
+
 class SunReader(object):
     """
     Encapsulates reading of suntans output data
@@ -1450,13 +1556,16 @@ class SunReader(object):
 
     def proc_nonghost_cells(self,proc):
         """ returns an array of cell indices which are *not* ghost cells """
-        ng_cells = []
-        g = self.grid(proc)
-        
-        for i in range(g.Ncells()):
-            if not self.proc_cell_is_ghost(proc,i):
-                ng_cells.append(i)
-        return array(ng_cells)
+        return nonzero( ~self.proc_ghost_cells_mask(proc) )[0]
+    def proc_ghost_cells_mask(self,proc):
+        """ boolean array over the local cells, true for ghost cells,
+        i.e. cells with a marker 6 edge
+        """
+        cdata = self.celldata(proc)
+        edges = self.grid(proc).edges
+
+        marks = edges[cdata[:,5:8].astype(int32),2]
+        return (marks==6).any(axis=1)
     def proc_cell_is_ghost(self,proc,i):
         """ Returns true if the specified cell is a ghost cell.
         """
@@ -2125,12 +2234,15 @@ class SunReader(object):
         gglobal=self.grid()
         glocal=self.grid(proc)
 
-        l2g=np.zeros( glocal.Ncells(), 'i4')
-        for li in range(glocal.Ncells()):
-            l2g[li] = gglobal.find_cell( glocal.cells[li] )
+        l2g = gglobal.find_cells( glocal.cells ).astype('i4')
+        if any(l2g<0):
+            raise trigrid.NoSuchCellError("Local cells of processor %d missing from global grid"%proc)
         return l2g
-        
-    # in-core caching in addition to filesystem caching
+
+    # version of the global_to_local.npz cache format
+    global_to_local_version = 1
+    
+    # in-core caching in addition to filesystem caching, indexed by honor_ghosts
     _global_to_local = None
     def map_global_cells_to_local_cells(self,cells=None,allow_cache=True,check_chain=True,
                                         honor_ghosts=False):
@@ -2138,7 +2250,7 @@ class SunReader(object):
         if cells is None, return a mapping for all global cells
 
         if cells is None, and allow_cache is true, attempt to read/write
-         a cached mapping as global_to_local.bin
+         a cached mapping as global_to_local.npz
         
         if honor_ghosts is True, then make the mapping consistent with the "owner"
         of each cell, rather than just a processor which contains that cell.
@@ -2147,9 +2259,11 @@ class SunReader(object):
         # surface velocity, and averaging over the relevant cells.
 
         if cells is None and allow_cache:
-            if self._global_to_local is not None:
+            if self._global_to_local is None:
+                self._global_to_local = {}
+            if honor_ghosts in self._global_to_local:
                 print("using in-core caching for global to local mapping")
-                return self._global_to_local
+                return self._global_to_local[honor_ghosts]
             
             if check_chain:
                 datadirs = [s.datadir for s in self.chain_restarts()]
@@ -2157,18 +2271,12 @@ class SunReader(object):
                 datadirs = [self.datadir]
 
             for datadir in datadirs[::-1]:
-                cache_fn = os.path.join(datadir,'global_to_local.bin')
-
-                if os.path.exists(cache_fn):
-                    fp = open(cache_fn,'rb')
-                    global_to_local = None
-                    try:
-                        global_to_local = pickle.load(fp)
-                    finally:
-                        fp.close()
-                    if global_to_local is not None:
-                        return global_to_local
-            cache_fn = os.path.join(self.datadir,'global_to_local.bin')
+                cache_fn = os.path.join(datadir,'global_to_local.npz')
+                global_to_local = self.read_global_to_local(cache_fn,honor_ghosts)
+                if global_to_local is not None:
+                    self._global_to_local[honor_ghosts] = global_to_local
+                    return global_to_local
+            cache_fn = os.path.join(self.datadir,'global_to_local.npz')
         else:
             cache_fn = None
             
@@ -2177,9 +2285,10 @@ class SunReader(object):
         if cells is None:
             print("Will map all cells")
             cells = arange(grid.Ncells())
-            all_cells = True
         else:
-            all_cells = False
+            # the original per-cell search did not consider ghosts for
+            # a subset of cells
+            honor_ghosts = False
             
         global_to_local = zeros( len(cells), [('global',int32),
                                               ('proc',int32),
@@ -2187,43 +2296,79 @@ class SunReader(object):
         global_to_local['global'] = cells
         global_to_local['proc'] = -1
 
+        # gather the local cells of all processors, and match them against
+        # the global grid in one go
+        all_procs = []
+        all_locals = []
+        all_nodes = []
         for processor in range(self.num_processors()):
-            print("P%d"%processor, end=' ')
             local_g = self.grid(processor)
-            if all_cells:
-                # faster to loop over the local cells
-                if honor_ghosts:
-                    local_cells=self.proc_nonghost_cells(processor)
-                else:
-                    local_cells=range(local_g.Ncells())
-                for i in local_cells:
-                    gi = grid.find_cell( local_g.cells[i] )
-                    gtl = global_to_local[gi]
-                    if gtl['proc'] >= 0:
-                        continue
-                    gtl['proc'] = processor
-                    gtl['local'] = i
+            if honor_ghosts:
+                local_cells=self.proc_nonghost_cells(processor)
             else:
-                for gtl in global_to_local:
-                    if gtl['proc'] >= 0:
-                        continue
-                    try:
-                        i = local_g.find_cell( grid.cells[gtl['global']] )
-                        gtl['proc'] = processor
-                        gtl['local'] = i
-                    except trigrid.NoSuchCellError:
-                        pass
+                local_cells=arange(local_g.Ncells())
+            all_procs.append( processor*ones(len(local_cells),int32) )
+            all_locals.append( local_cells )
+            all_nodes.append( local_g.cells[local_cells,:3] )
+        all_procs = concatenate(all_procs)
+        all_locals = concatenate(all_locals)
+        all_globals = grid.find_cells( concatenate(all_nodes) )
+
+        # the first processor with a cell claims it
+        valid = nonzero(all_globals>=0)[0]
+        claimed,first = unique(all_globals[valid],return_index=True)
+        first = valid[first]
+        proc_of = -ones(grid.Ncells(),int32)
+        local_of = zeros(grid.Ncells(),int32)
+        proc_of[claimed] = all_procs[first]
+        local_of[claimed] = all_locals[first]
+        
+        global_to_local['proc'] = proc_of[cells]
+        global_to_local['local'] = local_of[cells]
         print("done mapping")
 
         if cache_fn is not None:
-            fp = open(cache_fn,'wb')
-            pickle.dump(global_to_local,
-                        fp)
-            fp.close()
-            self._global_to_local = global_to_local
+            self.write_global_to_local(cache_fn,global_to_local,honor_ghosts)
+            self._global_to_local[honor_ghosts] = global_to_local
             
         return global_to_local
 
+    def read_global_to_local(self,cache_fn,honor_ghosts):
+        """ Read a cached global to local mapping written by write_global_to_local,
+        returning None if it is missing, of another version, or was computed
+        with a different honor_ghosts.
+        """
+        if not os.path.exists(cache_fn):
+            return None
+        try:
+            with load(cache_fn) as data:
+                if ( int(data['version']) != self.global_to_local_version or
+                     bool(data['honor_ghosts']) != honor_ghosts ):
+                    return None
+                global_to_local = zeros( len(data['global']), [('global',int32),
+                                                               ('proc',int32),
+                                                               ('local',int32)])
+                for fld in ['global','proc','local']:
+                    global_to_local[fld] = data[fld]
+                return global_to_local
+        except (IOError,OSError,KeyError,ValueError):
+            return None
+
+    def write_global_to_local(self,cache_fn,global_to_local,honor_ghosts):
+        """ Save the global to local mapping as plain little-endian arrays in
+        an npz, along with a format version.
+        """
+        tmp_fn = cache_fn + '.%d.npz'%os.getpid()
+        try:
+            savez(tmp_fn,
+                  version=int32(self.global_to_local_version),
+                  honor_ghosts=bool_(honor_ghosts),
+                  **dict( [ (fld,global_to_local[fld].astype('<i4'))
+                            for fld in ['global','proc','local'] ] ) )
+            os.rename(tmp_fn,cache_fn)
+        except (IOError,OSError):
+            print("Could not write global to local cache %s"%cache_fn)
+
     def cell_values_local_to_global(self,cell_values=None,func=None):
         """ Given per-processor cell values (for the moment, only supports
         2-D cell-centered scalars) return an array for the global cell-centered
@@ -2254,6 +2399,76 @@ class SunReader(object):
 
         return g_data
 
+    def global_dataset(self,variables=None,chunks=None):
+        """ The whole run as a lazy xarray Dataset with dimensions
+        (time, cell, k), cells numbered as in the global grid.  Values are
+        read from the per-processor output files only when indexed or
+        computed, each cell from its owning processor (ghost cells are
+        dropped).
+
+        variables: list of 'eta','salinity','temperature','nut','velocity',
+          defaults to those for which output files exist.
+        chunks: if given, passed to Dataset.chunk(), making the variables
+          dask arrays so that reductions stream over the files in parallel.
+          e.g. chunks={'time':24}
+        """
+        if xr is None:
+            raise Exception("global_dataset requires xarray")
+
+        readers = {'eta':('FreeSurfaceFile',('time','cell'),
+                          lambda p: self.freesurface(p)),
+                   'salinity':('SalinityFile',('time','cell','k'),
+                               lambda p: self.cell_scalar('SalinityFile',p)[1]),
+                   'temperature':('TemperatureFile',('time','cell','k'),
+                                  lambda p: self.cell_scalar('TemperatureFile',p)[1]),
+                   'nut':('EddyViscosityFile',('time','cell','k'),
+                          lambda p: self.cell_scalar('EddyViscosityFile',p)[1]),
+                   'velocity':('HorizontalVelocityFile',('time','cell','k','component'),
+                               lambda p: self.cell_velocity(p)[1])}
+        if variables is None:
+            variables = [v for v in ['eta','salinity','temperature','nut','velocity']
+                         if self.conf_str(readers[v][0]) is not None and 
+                         os.path.exists(self.file_path(readers[v][0],0))]
+
+        g2l = self.map_global_cells_to_local_cells(honor_ghosts=True)
+        gg = self.grid()
+
+        # open the memmaps up front - this also settles how many steps
+        # are available on every processor
+        times = self.timeline(units='seconds')
+        nsteps = len(times)
+        for v in variables:
+            for p in range(self.num_processors()):
+                nsteps = min(nsteps,len(readers[v][2](p)))
+        
+        ds = xr.Dataset()
+        t0 = self.time_zero().replace(tzinfo=None)
+        ds['time'] = ('time',
+                      datetime64(t0,'us') + (1e6*times[:nsteps]).astype('m8[us]') )
+        ds['time_seconds'] = ('time',times[:nsteps])
+        vc = gg.vcenters()
+        ds['cell_x'] = ('cell',vc[:,0])
+        ds['cell_y'] = ('cell',vc[:,1])
+        ds['cell_proc'] = ('cell',g2l['proc'])
+        ds['cell_local'] = ('cell',g2l['local'])
+        ds['z_bottom'] = ('k',-self.z_levels())
+        ds['dz'] = ('k',self.dz())
+        ds = ds.set_coords(['cell_x','cell_y'])
+
+        for v in variables:
+            arr = GlobalCellArray(readers[v][2],g2l,nsteps)
+            if xr_indexing is not None:
+                data = xr_indexing.LazilyIndexedArray(arr)
+            else:
+                # older xarray: wrap as a dask array, one chunk per step
+                import dask.array as da
+                data = da.from_array(arr,chunks=(1,)+arr.shape[1:])
+            ds[v] = xr.Variable(readers[v][1],data)
+
+        if chunks is not None:
+            ds = ds.chunk(chunks)
+        return ds
+
     def read_section_defs(self):
         fp = open(self.file_path('sectionsinputfile'),'rt')
 
@@ -2275,7 +2490,7 @@ class SunReader(object):
             sections[nsec] = nodes
         return sections
         
-    def full_to_transect(self,xy,absdays,scalar_file,min_dx=10.0):
+    def full_to_transect(self,xy,absdays,scalar_file,min_dx=10.0,interpolate=False):
         """ Construct a Transect from full grid scalar output, where xy is a sequence of points
         giving the transect, absdays a sequence of times, and scalar which field should be
         read.
@@ -2288,7 +2503,8 @@ class SunReader(object):
         also the handling of the freesurface and timesteps are lacking.  The freesurface is used
         only to decide ctop - it is not used to truncate the surface cell.
         
-        And no interpolation in time is done - only the nearest timestep is extracted.
+        By default no interpolation in time is done - only the nearest timestep is extracted.
+        With interpolate=True, the scalar and freesurface are interpolated linearly in time.
         """
         xy = asarray(xy)
         absdays = asarray(absdays)
@@ -2302,85 +2518,61 @@ class SunReader(object):
         utm_deltas = sqrt(sum(diff(utm_points,axis=0)**2,axis=1))
         utm_dists = concatenate( ([0],cumsum(utm_deltas)) )
 
-        ## choose a timestep:
-        timeline = date2num(self.time_zero()) + self.timeline(output='grid',units='days')
-
-        steps = searchsorted(timeline,absdays_expanded) # the output right after the requested date
-
-        # adjust to whichever step closer:
-        for i in range(len(steps)):
-            if steps[i]>0 and timeline[steps[i]] - absdays_expanded[i] > absdays_expanded[i] - timeline[steps[i]-1]:
-                steps[i] -= 1
-
-        g = self.grid()
-
-        global_cells = []
-
-        for xy in utm_points:
-            global_cells.append( g.closest_cell(xy) )
+        located = self.locate_points(utm_points)
+        global_cells = located['global']
 
         # Now remove any duplicates    
-        global_cells = array(global_cells)
         valid = (global_cells[:-1] != global_cells[1:] )
         valid = concatenate( (valid,[True]) )
 
-        global_cells = global_cells[valid]
+        located = located[valid]
         utm_dists = utm_dists[valid]
         utm_points = utm_points[valid]
-        steps = steps[valid]
         absdays_expanded = absdays_expanded[valid]
 
-        nkmax = self.conf_int('nkmax')
+        timeline = self.output_absdays()
+        steps,step_weights = self.output_steps(absdays_expanded,interpolate=interpolate)
+        if interpolate:
+            times = absdays_expanded
+        else:
+            times = timeline[steps[:,0]]
 
-        scalar = zeros( (len(global_cells),nkmax), float64 )
-        local_proc_cells = zeros( (len(global_cells),2), int32 ) - 1
+        nkmax = self.conf_int('nkmax')
+        found = located['proc']>=0
 
         bathy_offset = self.bathymetry_offset()
         interface_elevs = bathy_offset + concatenate( ([0], -self.z_levels()) ) # Nk + 1 entries!
-        elev_fs = zeros( len(global_cells), float64 ) # these will be corrected for bathy_offset
-        elev_bed = zeros( len(global_cells), float64 )
 
-        # elevations of interfaces for each watercolumn
-        elev_per_column = zeros( (len(global_cells),len(interface_elevs)), float64)
+        fs = self.gather_cells(self.freesurface,located,steps,step_weights)
+        scalar = self.gather_cells(lambda p: self.cell_scalar(scalar_file,p)[1],
+                                   located,steps,step_weights)
+        cdata = self.gather_cells(lambda p: self.celldata(p)[None,:,3:5],
+                                  located,zeros((len(located),1),int32))
         
-        for proc in range(self.num_processors()):
-            # print "Reading salinity from processor %d"%proc
-            local_g, full_scal = self.cell_scalar(scalar_file,proc) # [Ntimesteps,cells,z-level]
-            fs = self.freesurface(proc) #  [Ntimesteps,cells]
-            celldata = self.celldata(proc)
-
-            for gc_i in range(len(global_cells)):
-                gc = global_cells[gc_i]
-                step = steps[gc_i]
-
-                if local_proc_cells[gc_i,0] >= 0:
-                    continue # already been read
-                try:
-                    i = local_g.find_cell( g.cells[gc] )
-                    local_proc_cells[gc_i,0] = proc
-                    local_proc_cells[gc_i,1] = i
+        ktop = self.h_to_ctop(fs)
+        kmax = nan_to_num(cdata[:,1]).astype(int32)
+        
+        elev_fs = fs + bathy_offset
+        elev_bed = -cdata[:,0] + bathy_offset
+        k = arange(nkmax)
+        scalar[ (k[None,:]<ktop[:,None]) | (k[None,:]>=kmax[:,None]) ] = nan
+        
+        # elevations of interfaces for each watercolumn
+        elev_per_column = interface_elevs[None,:] * ones( (len(located),1) )
+        rows = arange(len(located))
+        elev_per_column[rows,ktop] = elev_fs
+        elev_per_column[rows,kmax] = elev_bed
 
-                    ktop = self.h_to_ctop(fs[step,i])
-                    kmax = int(celldata[i,4])
-                    
-                    elev_fs[gc_i] = fs[step,i] + bathy_offset
-                    elev_bed[gc_i] = -celldata[i,3] + bathy_offset
-                    scalar[gc_i,:] = full_scal[step,i,:]
-                    scalar[gc_i,:ktop] = nan
-                    scalar[gc_i,kmax:] = nan
-                    
-                    elev_per_column[gc_i,:] = interface_elevs
-                    elev_per_column[gc_i,ktop] = elev_fs[gc_i]
-                    elev_per_column[gc_i,kmax] = elev_bed[gc_i]
-                except trigrid.NoSuchCellError:
-                    continue
+        # cells that are not on any processor
+        scalar[~found,:] = 0.0
+        elev_per_column[~found,:] = 0.0
 
         ## Make that into a transect:
         scalar = ma.masked_invalid(scalar)
 
         # ideally we'd include the time-varying freesurface elevation, too...
         t = transect.Transect(xy=utm_points,
-                              times = timeline[steps],
+                              times = times,
                               elevations=elev_per_column.T,
                               scalar=scalar.T,
                               dists=utm_dists)
@@ -2388,6 +2580,124 @@ class SunReader(object):
         t.trim_to_valid()
         return t
 
+    _cell_locator = None
+    def locate_points(self,xy):
+        """ Vectorized closest_cell() for an array of points [...,2].
+        Returns a structured array [('global',int32),('proc',int32),('local',int32)]
+        like map_global_cells_to_local_cells(), with proc=-1 where no cell was found.
+        The locator and the global to local mapping are built once and reused.
+        """
+        if self._cell_locator is None:
+            self._cell_locator = self.grid().cell_locator()
+        gcells = self._cell_locator(xy)
+        g2l = self.map_global_cells_to_local_cells()
+
+        located = zeros(gcells.shape,g2l.dtype)
+        located['global'] = gcells
+        located['proc'] = -1
+        valid = gcells>=0
+        located[valid] = g2l[gcells[valid]]
+        return located
+
+    def output_absdays(self):
+        """ times of the grid outputs, as absdays """
+        return date2num(self.time_zero()) + self.timeline(output='grid',units='days')
+    
+    def output_steps(self,absdays,interpolate=False):
+        """ Choose grid output steps for an array of times in absdays.
+        Returns steps [...,2] and weights [...,2], such that the value at
+        each time is sum(weights*value[steps]).  With interpolate False,
+        the first step is the nearest output and has weight 1.
+        Times outside the output period are clamped to the first/last step.
+        """
+        absdays = asarray(absdays,float64)
+        timeline = self.output_absdays()
+        last = len(timeline)-1
+
+        if interpolate and last>0:
+            before = (searchsorted(timeline,absdays,side='right')-1).clip(0,last-1)
+            alpha = (absdays - timeline[before]) / (timeline[before+1] - timeline[before])
+            alpha = alpha.clip(0,1)
+            steps = concatenate( (before[...,None],before[...,None]+1), axis=-1)
+            weights = concatenate( ((1-alpha)[...,None],alpha[...,None]), axis=-1)
+        else:
+            after = searchsorted(timeline,absdays).clip(0,last) # the output right after the requested date
+            before = (after-1).clip(0,last)
+            # adjust to whichever step closer:
+            nearest = where( timeline[after]-absdays > absdays-timeline[before], before, after)
+            steps = concatenate( (nearest[...,None],nearest[...,None]), axis=-1)
+            weights = concatenate( (ones(nearest.shape+(1,)),zeros(nearest.shape+(1,))), axis=-1)
+        return steps,weights
+
+    def gather_cells(self,reader,located,steps=None,weights=None):
+        """ Read values for many (proc,local cell) pairs at once.
+        reader: function of processor returning an array [time,local cell,...], like
+          self.freesurface, or lambda p: self.cell_scalar('SalinityFile',p)[1]
+        located: structured array as returned by locate_points()
+        steps: None to read all timesteps, giving [time,point,...], or an integer array
+          [point] or [point,n] of steps, combined with weights [point,n] (see output_steps()),
+          giving [point,...].
+
+        Each processor's file is read in one pass, in order of timestep and cell.
+        Points with no processor get nan.
+        """
+        located = asarray(located)
+        procs = located['proc']
+        locals_ = located['local']
+        if steps is not None:
+            steps = asarray(steps)
+            if steps.ndim==1:
+                steps = steps[:,None]
+            if weights is None:
+                weights = ones(steps.shape)
+            weights = asarray(weights)
+            
+        # trailing dimensions (layers, components) are the same on all processors
+        sample = reader(0)
+        if steps is None:
+            result = nan*ones( (sample.shape[0],len(located)) + sample.shape[2:])
+        else:
+            result = nan*ones( (len(located),) + sample.shape[2:])
+            
+        for p in unique(procs):
+            if p < 0:
+                continue
+            sel = nonzero(procs==p)[0]
+            data = reader(p)
+            if steps is None:
+                result[:,sel,...] = data[:result.shape[0],locals_[sel],...]
+            else:
+                # read each (step,cell) pair once, time-ordered
+                pairs = unique( steps[sel]*data.shape[1] + locals_[sel][:,None],
+                                return_inverse=True )
+                pair_steps,pair_cells = divmod(pairs[0],data.shape[1])
+                values = data[pair_steps,pair_cells,...][pairs[1]]
+                values = values.reshape( steps[sel].shape+data.shape[2:] )
+                w = weights[sel].reshape( weights[sel].shape+(1,)*(data.ndim-2) )
+                result[sel,...] = (w*values).sum(axis=1)
+        return result
+
+    def extract_points(self,xy,scalar_file,absdays=None,interpolate=False):
+        """ Extract cell-centered output at many points.
+        xy: [N,2] points, located as with closest_cell().
+        scalar_file: the suntans.dat setting for the output, e.g. 'SalinityFile',
+          'TemperatureFile' or 'FreeSurfaceFile'
+        absdays: None to extract all output timesteps, returning [time,N,...]
+          otherwise the time for each point, returning [N,...], either at the
+          nearest output step or, with interpolate=True, linearly interpolated.
+        """
+        located = self.locate_points(asarray(xy))
+        if scalar_file=='FreeSurfaceFile':
+            reader = self.freesurface
+        else:
+            reader = lambda p: self.cell_scalar(scalar_file,p)[1]
+
+        if absdays is None:
+            return self.gather_cells(reader,located)
+        absdays = absdays*ones(len(located))
+        steps,weights = self.output_steps(absdays,interpolate=interpolate)
+        return self.gather_cells(reader,located,steps,weights)
+
     _finder = None
     def xy_to_profile_index(self,xy):
         if self._finder is None:
@@ -3576,11 +3886,15 @@ class SunReader(object):
 
     def closest_cell(self,xy,full=0):
         """ Return proc,cell_id for the closest cell to the given point, across
-        all processors.  Slow...
+        all processors.  For many points, use locate_points().
          full==0: each subdomain will only consider cells that contain the closest global
            point.  as long as all points are part of a cell, this should be fine.
          full==1: if the closest point isn't in a cell, consider *all* cells.  
         """
+        if not full:
+            located = self.locate_points(asarray(xy))
+            return int(located['proc']),int(located['local'])
+        
         ids = []
         dists = []
 
@@ -3807,28 +4121,41 @@ class SunReader(object):
         """ Return a 2-D array of dz values all_dz[cell,k]
         dry cells are set to 0, and the bed and freesurface height are
         taken into account.  Useful for depth-integrating.
+        time_step may also be a sequence of steps, giving all_dz[step,cell,k]
         """
         cdata = self.celldata(proc)
         
         Nk = cdata[:,4].astype(int32)
         bed = -cdata[:,3]
 
-        all_dz = (self.dz())[newaxis,:].repeat(len(Nk),axis=0)
-        
-        z = -self.z_levels()
-
-        h = self.freesurface(proc,[time_step])[0]
+        h = self.freesurface(proc,time_step)
         ctops = self.h_to_ctop(h)
+        return self.layer_dz(h,bed*ones_like(h),ctops,Nk*ones_like(ctops))
 
-        for i in range(len(Nk)):
-            all_dz[i,:ctops[i]] = 0.0 # empty cells above fs
-            all_dz[i,Nk[i]:] = 0.0    # empty cells below bed
-            all_dz[i,ctops[i]] = h[i] - z[ctops[i]] # recalc surface cell
-            all_dz[i,Nk[i]-1] -= bed[i] - z[Nk[i]-1] # trim bed layer (which could be same as surface)
+    def layer_dz(self,h,bed,ctops,cbeds):
+        """ Thickness of each layer between elevations h and bed, as array
+        [...,Nk] for h, bed, ctops and cbeds (exclusive index of the bed
+        layer) of any, matching, shape.
+        """
+        one_dz = self.dz()
+        z = -self.z_levels()
+        all_k = arange(len(one_dz))
+
+        all_dz = one_dz * ones(h.shape+(1,))
+        # in the case of a dry cell, ctop==cbed==Nk[i]
+        drymask = (all_k < ctops[...,None]) | (all_k>=cbeds[...,None])
+        all_dz[drymask] = 0.0
+
+        flat_dz = all_dz.reshape([-1,len(one_dz)])
+        ii = arange(len(flat_dz))
+        ctops = ctops.ravel()
+        cbeds = cbeds.ravel()
+        flat_dz[ii,ctops] = h.ravel() - z[ctops] # recalc surface cell
+        flat_dz[ii,cbeds-1] -= bed.ravel() - z[cbeds-1] # trim bed layer (which could be same as surface)
         return all_dz
 
     def averaging_weights(self,proc,time_step,ztop=None,zbottom=None,dz=None):
-        """ Returns weights as array [Nk] to average over a cell-centered quantity
+        """ Returns weights as array [Nc,Nk] to average over a cell-centered quantity
         for the range specified by ztop,zbottom, and dz.
 
         range is specified by 2 of the 3 of ztop, zbottom, dz, all non-negative.
@@ -3838,36 +4165,36 @@ class SunReader(object):
 
         if the result would be an empty region, return nans.
 
-        this thing is slow! - lots of time in adjusting all_dz
+        For many timesteps, use layer_weights() or depth_average().
+        """
+        h = self.freesurface(proc,[time_step])[0]
+        return self.layer_weights(proc,h,ztop=ztop,zbottom=zbottom,dz=dz)
+
+    def layer_weights(self,proc,h,ztop=None,zbottom=None,dz=None):
+        """ Like averaging_weights, but for freesurface h [...,Nc], e.g. a block of
+        timesteps, returning weights [...,Nc,Nk]
         """
         cdata = self.celldata(proc)
         
         Nk = cdata[:,4].astype(int32)
-        bed = -cdata[:,3]
-
-        one_dz = self.dz()
-        all_dz = one_dz[newaxis,:].repeat(len(cdata),axis=0)
-        all_k = arange(len(one_dz))[None,:].repeat(len(cdata),axis=0)
-        
-        z = -self.z_levels()
-
-        h = self.freesurface(proc,[time_step])[0]
+        h = array(h,float64) # don't modify the caller's h
+        bed = -cdata[:,3] * ones_like(h)
 
         # adjust bed and 
         # 3 choices here..
         # try to clip to reasonable values at the same time:
         if ztop is not None:
             if ztop != 0:
-                h = h - ztop # don't modify h
+                h = h - ztop
                 # don't allow h to go below the bed
-                h[ h<bed ] = bed
+                h = maximum(h,bed)
             if dz is not None:
                 # don't allow bed to be below the real bed.
                 bed = maximum( h - dz, bed)
         if zbottom is not None:
             # no clipping checks for zbottom yet.
             if zbottom != 0:
-                bed = bed + zbottom # don't modify bed!
+                bed = bed + zbottom
             if dz is not None:
                 h = bed + dz
 
@@ -3878,29 +4205,79 @@ class SunReader(object):
         # but at the bed, it goes the other way - safest just to say dzmin=0,
         # and also clamp to known Nk
         cbeds = self.h_to_ctop(bed,dzmin=0) + 1 # it's an exclusive index
-        cbeds[ cbeds > Nk ] = Nk[ cbeds > Nk ]
-
-        if 0: # non vectorized - takes 0.8s per processor on the test run
-            for i in range(len(Nk)):
-                all_dz[i,:ctops[i]] = 0.0 # empty cells above fs
-                all_dz[i,cbeds[i]:] = 0.0    # empty cells below bed - might be an error...
-                all_dz[i,ctops[i]] = h[i] - z[ctops[i]] # recalc surface cell
-                all_dz[i,cbeds[i]-1] -= bed[i] - z[cbeds[i]-1] # trim bed layer (which could be same as surface)
-        else: # attempt to vectorize - about 70x speedup
-            # seems that there is a problem with how dry cells are handled -
-            # for the exploratorium display this ending up with a number of cells with
-            # salinity close to 1e6.
-            # in the case of a dry cell, ctop==cbed==Nk[i]
-            # 
-            drymask = (all_k < ctops[:,None]) | (all_k>=cbeds[:,None])
-            all_dz[drymask] = 0.0
-            ii = arange(len(cdata))
-            all_dz[ii,ctops] = h - z[ctops]
-            all_dz[ii,cbeds-1] -= bed - z[cbeds-1]
+        cbeds = minimum(cbeds,Nk)
 
+        all_dz = self.layer_dz(h,bed,ctops,cbeds)
         
         # make those weighted averages
-        # have to add extra axis to get broadcasting correct
-        all_dz = all_dz / sum(all_dz,axis=1)[:,None]
-        return all_dz
+        return all_dz / all_dz.sum(axis=-1)[...,None]
+
+    # bound on the size of the weights for one block of timesteps in depth_average
+    averaging_block_bytes = 2**27
+    
+    def depth_average(self,scalar_file,proc=None,time_steps=None,
+                      ztop=None,zbottom=None,dz=None,threads=1):
+        """ Average a cell-centered 3-D output vertically over many timesteps.
+        scalar_file: suntans.dat setting for the output, e.g. 'SalinityFile', or
+          'HorizontalVelocityFile' for velocity, which gets a trailing
+          component dimension.
+        proc: a single processor, giving [time,local cell(,3)], or None for all
+          processors, giving [time,global cell(,3)], each cell from its owner.
+        time_steps: sequence of steps, defaults to all.
+        ztop,zbottom,dz: the averaging window, see averaging_weights()
+
+        Timesteps are processed in blocks, bounded by averaging_block_bytes.
+        With threads>1, processors are handled in parallel.
+        """
+        if proc is None:
+            g2l = self.map_global_cells_to_local_cells(honor_ghosts=True)
+            procs = list(range(self.num_processors()))
+        else:
+            procs = [proc]
+
+        def one_proc(p):
+            if scalar_file=='HorizontalVelocityFile':
+                data = self.cell_velocity(p)[1] # [time,cell,k,3]
+            else:
+                data = self.cell_scalar(scalar_file,p)[1] # [time,cell,k]
+            fs = self.freesurface(p)
+            steps = arange(len(fs)) if time_steps is None else asarray(time_steps)
+
+            Nc = fs.shape[1]
+            per_step = Nc*len(self.dz())*REALSIZE*int(prod(data.shape[3:]))
+            block = max(1,self.averaging_block_bytes//per_step)
+            
+            result = zeros( (len(steps),Nc) + data.shape[3:] )
+            for start in range(0,len(steps),block):
+                blk = steps[start:start+block]
+                w = self.layer_weights(p,fs[blk],ztop=ztop,zbottom=zbottom,dz=dz)
+                # empty windows come out nan, as in averaging_weights
+                empty = isnan(w).all(axis=2)
+                values = data[blk]
+                if values.ndim>w.ndim:
+                    w = w[...,None]
+                # below bed and above the surface may hold junk
+                result[start:start+block] = where(w>0,w*values,0).sum(axis=2)
+                result[start:start+block][empty] = nan
+            return result
+
+        if threads>1 and len(procs)>1:
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(threads)
+            try:
+                results = pool.map(one_proc,procs)
+            finally:
+                pool.close()
+        else:
+            results = [one_proc(p) for p in procs]
+
+        if proc is not None:
+            return results[0]
+
+        # stitch into global cells
+        out = nan*ones( (results[0].shape[0],len(g2l)) + results[0].shape[2:] )
+        for p,result in zip(procs,results):
+            sel = nonzero(g2l['proc']==p)[0]
+            out[:,sel,...] = result[:,g2l['local'][sel],...]
+        return out
 
@@ -3,7 +3,9 @@ from __future__ import print_function
 
 import numpy as np # to help in transition
 
-import glob,types
+import glob,types,hashlib
+import six
+from collections import OrderedDict
 
 from numpy.random import random
 from numpy import ma
@@ -137,6 +139,12 @@ class Field(object):
     def assign_projection(self,projection):
         self._projection = projection
 
+    def input_files(self):
+        """ Files which this field reads its data from, as far as it 
+        knows.  Used by TileMaker to decide when tiles are stale.
+        """
+        return []
+
     def reproject(self,from_projection=None,to_projection=None):
         """ Reproject to a new coordinate system.
         If the input is structured, this will create a curvilinear
@@ -390,17 +398,7 @@ class XYZField(Field):
         newF = np.zeros( X.shape[0], np.float64 )
 
         if interpolation=='nearest':
-            for i in range(len(X)):
-                if i % 10000 == 1:
-                    print( " %.2f%%"%( (100.0*i)/len(X) ))
-
-                if not self.index:
-                    dsqr = ((self.X - X[i])**2).sum(axis=1)
-                    j = np.argmin( dsqr )
-                else:
-                    j = self.nearest(X[i])
-
-                newF[i] = self.F[j]
+            newF[:] = self.F[ self.nearest_batch(X) ]
         elif interpolation=='naturalneighbor':
             newF = self.nn_interper()(X[:,0],X[:,1])
             # print "why aren't you using linear?!"
@@ -506,7 +504,7 @@ class XYZField(Field):
         else:
             # print "bad - no index"
             dsqr = ((self.X-p)**2).sum(axis=1)
-            return where(dsqr<=r**2)[0]
+            return np.where(dsqr<=r**2)[0]
 
     def inv_dist_interp(self,p,
                         min_radius=None,min_n_closest=None,
@@ -558,6 +556,130 @@ class XYZField(Field):
         val = (vals * weights).sum() / weights.sum()
         return val
 
+    _kdtree = None
+    def kdtree(self):
+        """ scipy cKDTree of the valid points, for batch queries.
+        Returns (tree,idxs), where idxs maps tree indices to indices 
+        into self.X.  Cleared by the editing API below, but not when
+        X is modified directly.
+        """
+        if self._kdtree is None or self._kdtree[2] is not self.X:
+            from scipy.spatial import cKDTree
+            idxs = np.nonzero( np.isfinite(self.X).all(axis=1) )[0]
+            self._kdtree = (cKDTree(self.X[idxs]),idxs,self.X)
+        return self._kdtree[:2]
+
+    def nearest_batch(self,X,count=1):
+        """ Batch version of nearest().
+        X: [...,2] query points
+        count: 1 to return [...] indices of the nearest point, otherwise 
+          [...,count] indices ordered by increasing distance.  When there
+          are too few points, the extra entries are -1.
+        """
+        X = np.asarray(X,np.float64)
+        tree,idxs = self.kdtree()
+        dists,hits = tree.query(X.reshape([-1,2]),k=count)
+        hits = hits.reshape([-1,count])
+        result = -np.ones(hits.shape,np.int64)
+        valid = hits<len(idxs)
+        result[valid] = idxs[hits[valid]]
+        if count==1:
+            return result[:,0].reshape(X.shape[:-1])
+        else:
+            return result.reshape(X.shape[:-1]+(count,))
+
+    def inv_dist_interp_batch(self,X,
+                              min_radius=None,min_n_closest=None,
+                              clip_min=-np.inf,clip_max=np.inf,
+                              default=None,processes=None,chunk_size=200000):
+        """ Batch version of inv_dist_interp, with the same semantics
+        for min_radius and min_n_closest, using a single KD-tree query for
+        all of the points.
+
+        X: [...,2] query points
+        default: value for points with no samples nearby, otherwise nan.
+        processes: if more than 1, chunks of chunk_size points are 
+          farmed out to a pool of this many worker processes.
+        """
+        if min_radius is None and min_n_closest is None:
+            raise Exception("Must specify one of r (radius) or n_closest")
+
+        X = np.asarray(X,np.float64)
+        shape = X.shape[:-1]
+        X = X.reshape([-1,2])
+        kw = dict(min_radius=min_radius,min_n_closest=min_n_closest,
+                  clip_min=clip_min,clip_max=clip_max,default=default)
+
+        if processes is not None and processes>1 and len(X)>chunk_size:
+            from multiprocessing import Pool
+            chunks = [ X[i:i+chunk_size] for i in range(0,len(X),chunk_size) ]
+            # workers get a bare copy of the points, sent once per worker
+            pool = Pool(processes,initializer=_init_worker_field,
+                        initargs=(XYZField(self.X,self.F),))
+            try:
+                results = pool.map(_worker_inv_dist_interp,
+                                   [ (chunk,kw) for chunk in chunks ])
+            finally:
+                pool.close()
+            return np.concatenate(results).reshape(shape)
+
+        tree,idxs = self.kdtree()
+
+        # flattened list of (query point, sample) pairs, as rows/nbrs
+        if min_radius:
+            lists = tree.query_ball_point(X,min_radius) # object array of lists
+            counts = np.fromiter(map(len,lists),np.int64,len(lists))
+            if min_n_closest is not None:
+                # fall back to nearest where the radius isn't enough
+                short = counts<min_n_closest
+                counts[short] = 0
+                lists = lists[~short]
+            else:
+                short = np.zeros(len(X),np.bool_)
+            rows = np.repeat( np.arange(len(X)), counts )
+            # the leading empty int array covers the case of no pairs
+            nbrs = np.concatenate( [np.zeros(0,np.int64)] + list(lists) ).astype(np.int64)
+        else:
+            short = np.ones(len(X),np.bool_)
+            rows = nbrs = np.zeros(0,np.int64)
+
+        if np.any(short):
+            short_idx = np.nonzero(short)[0]
+            k = min(min_n_closest,len(idxs))
+            if k>0:
+                _,hits = tree.query(X[short_idx],k=k)
+                hits = hits.reshape([len(short_idx),k])
+                rows = np.concatenate( [rows,np.repeat(short_idx,k)] )
+                nbrs = np.concatenate( [nbrs,hits.ravel()] )
+
+        nbrs = idxs[nbrs]
+        dists = np.sqrt( ((X[rows]-self.X[nbrs])**2).sum(axis=1) )
+
+        if min_radius is None:
+            # hrrmph.  arbitrary...
+            n = np.bincount(rows,minlength=len(X))
+            radii = np.bincount(rows,weights=dists,minlength=len(X)) / np.maximum(n,1)
+            floor = 0.01*radii[rows]
+        else:
+            floor = 0.01*min_radius
+        dists = np.maximum(dists,floor)
+
+        # dists can only be zero if every sample for that query point
+        # coincides with it.  average those rather than dividing by zero.
+        dists[dists==0] = 1.0
+
+        weights = 1.0/dists
+        vals = np.clip(self.F[nbrs],clip_min,clip_max)
+
+        num = np.bincount(rows,weights=vals*weights,minlength=len(X))
+        den = np.bincount(rows,weights=weights,minlength=len(X))
+        result = np.nan*np.ones(len(X))
+        valid = den>0
+        result[valid] = num[valid]/den[valid]
+        if default is not None:
+            result[~valid] = default
+        return result.reshape(shape)
+
     def nearest(self,p,count=1):
         # print "  Field::nearest(p=%s,count=%d)"%(p,count)
         
@@ -889,6 +1011,7 @@ class XYZField(Field):
     ## Editing API for use with GUI editor
     def move_point(self,i,pnt):
         self.X[i] = pnt
+        self._kdtree = None
         
         if self.index:
             if self.index_type == 'stree':
@@ -913,6 +1036,7 @@ class XYZField(Field):
         self._tri = None
         self._nn_interper = None
         self._lin_interper = None
+        self._kdtree = None
         
         if self.index is not None:
             if self.index_type == 'stree':
@@ -936,6 +1060,7 @@ class XYZField(Field):
             
         self.X[i,0] = np.nan
         self.F[i] = np.nan
+        self._kdtree = None
         self.deleted_point(i)
 
     
@@ -999,6 +1124,15 @@ class XYZField(Field):
             ax.add_patch(cir)
 
 
+# worker process state for XYZField.inv_dist_interp_batch
+_worker_field = None
+def _init_worker_field(f):
+    global _worker_field
+    _worker_field = f
+def _worker_inv_dist_interp(args):
+    X,kw = args
+    return _worker_field.inv_dist_interp_batch(X,**kw)
+
 class PyApolloniusField(XYZField):
     """ 
     Takes a set of vertices and the allowed scale at each, and
@@ -2251,47 +2385,77 @@ class SimpleGrid(QuadrilateralGrid):
         grown, but the averaging process is reapplied.
 
         If iterations is 'adaptive', then iterate until there are no nans.
-        """
-        kern = np.ones( (kernel_size,kernel_size) )
 
+        Only the neighborhoods of the missing data are processed: missing
+        pixels are grouped into clusters which cannot influence each other,
+        and each cluster is filled within its own bounding window, using
+        separable box filters.
+        """
         valid = np.isfinite(self.F) 
-
-        bin_valid = valid.copy()
-        # newF = self.F.copy()
-        newF = self.F # just do it in place
-        newF[~valid] = 0.0
-
-        if iterations=='adaptive':
-            iterations=1
-            adaptive=True
-        else:
-            adaptive=False
-
-        i = 0
-        while i < iterations+smoothing:
-            #for i in range(iterations + smoothing):
-
-            weights = signal.convolve2d(bin_valid,kern,mode='same',boundary='symm')
-            values  = signal.convolve2d(newF,kern,mode='same',boundary='symm')
+        self.F[~valid] = 0.0 # just do it in place
+
+        adaptive = (iterations=='adaptive')
+
+        # clusters of missing pixels, dilated by the kernel reach so that
+        # clusters which share a neighborhood are merged.
+        reach = kernel_size//2
+        near_missing = ndimage.binary_dilation(~valid,
+                                               structure=np.ones((2*reach+1,2*reach+1),np.bool_))
+        labels,nlabels = ndimage.label(near_missing,structure=np.ones((3,3)))
+        windows = ndimage.find_objects(labels)
+
+        win_area = sum([ (w[0].stop-w[0].start)*(w[1].stop-w[1].start) for w in windows])
+        if win_area > self.F.size//4:
+            # not worth the per-window overhead
+            labels = near_missing.astype(np.int32)
+            windows = [ (slice(None),slice(None)) ] if nlabels else []
+
+        states = []
+        for label,win in enumerate(windows):
+            # copies, so that windows can be processed independently.
+            # windows can overlap, so also track which missing pixels
+            # belong to this cluster.
+            mine = (labels[win]==label+1) & (~valid[win])
+            states.append( [win,self.F[win].copy(),valid[win],valid[win].copy(),mine,0] )
+
+        def step(state,grow):
+            win,F,win_valid,bin_valid,mine,count = state
+            # counts - round off the running sum error
+            weights = np.round( self.box_sum(bin_valid,kernel_size) )
+            values  = self.box_sum(F,kernel_size)
 
             # update data_or_zero and bin_valid
             # so anywhere that we now have a nonzero weight, we should get a usable value.
 
             # for smoothing-only iterations, the valid mask isn't expanded
-            if i < iterations:
+            if grow:
                 bin_valid |= (weights>0)
 
-            to_update = (bin_valid & (~valid)).astype(bool)
-            newF[to_update] = values[to_update] / weights[to_update]
+            to_update = bin_valid & (~win_valid)
+            F[to_update] = values[to_update] / weights[to_update]
+            state[5] = count+1
 
-            i+=1
-            if adaptive and (np.sum(~bin_valid)>0):
-                iterations += 1 # keep trying
-            else:
-                adaptive = False # we're done 
+        if adaptive:
+            # each window iterates until it is filled, and then all windows
+            # catch up to the one which needed the most iterations
+            iterations = 1
+            for state in states:
+                while 1:
+                    n_missing = np.sum(~state[3] & state[4])
+                    step(state,grow=True)
+                    remaining = np.sum(~state[3] & state[4])
+                    if remaining==0 or remaining==n_missing:
+                        # filled, or no valid data in reach
+                        break
+                iterations = max(iterations,state[5])
 
-        # and turn the missing values back to nan's
-        newF[~bin_valid] = np.nan
+        for state in states:
+            while state[5] < iterations+smoothing:
+                step(state,grow=state[5]<iterations)
+            win,F,win_valid,bin_valid,mine,count = state
+            # and turn the missing values back to nan's
+            F[~bin_valid] = np.nan
+            self.F[win][mine] = F[mine]
 
     def smooth_by_convolution(self,kernel_size=3,iterations=1):
         """
@@ -2300,16 +2464,14 @@ class SimpleGrid(QuadrilateralGrid):
         the effect is applied everywhere, not just in the newly-filled
         areas.
         """
-        kern = np.ones( (kernel_size,kernel_size) )
-
         valid = np.isfinite(self.F) 
 
         # avoid nan contamination - set these to zero
         self.F[~valid] = 0.0
 
+        weights = np.round( self.box_sum(valid,kernel_size) )
         for i in range(iterations):
-            weights = signal.convolve2d(valid, kern,mode='same',boundary='symm')
-            values  = signal.convolve2d(self.F,kern,mode='same',boundary='symm')
+            values  = self.box_sum(self.F,kernel_size)
 
             # update data_or_zero and bin_valid
             # so anywhere that we now have a nonzero weight, we should get a usable value.
@@ -2318,7 +2480,32 @@ class SimpleGrid(QuadrilateralGrid):
         # and turn the missing values back to nan's
         self.F[~valid] = np.nan
 
-    
+    @staticmethod
+    def box_sum(A,kernel_size):
+        """ Sum over a kernel_size x kernel_size window, equivalent to 
+        signal.convolve2d(A,ones,mode='same',boundary='symm'), but as
+        two running sums.
+        """
+        return ndimage.uniform_filter(A.astype(np.float64),kernel_size,
+                                      mode='reflect') * kernel_size**2
+
+    def fill_by_nearest(self,max_distance=None):
+        """ Fill missing values with the value of the nearest valid pixel,
+        via a Euclidean distance transform.
+        max_distance: if given, only fill pixels within this distance (in
+        the units of the grid) of valid data.
+        """
+        valid = np.isfinite(self.F)
+        if valid.all() or not valid.any():
+            return
+        dists,(rows,cols) = ndimage.distance_transform_edt(~valid,
+                                                          sampling=[self.dy,self.dx],
+                                                          return_indices=True)
+        to_fill = ~valid
+        if max_distance is not None:
+            to_fill &= dists<=max_distance
+        self.F[to_fill] = self.F[rows[to_fill],cols[to_fill]]
+
     def polygon_mask(self,poly):
         """ similar to mask_outside, but:
         much faster due to outsourcing tests to GDAL
@@ -2714,6 +2901,218 @@ class GtxGrid(SimpleGrid):
                             F = heights,
                             projection=projection) 
 
+def apply_nodata(A,nodata,int_nan=-9999):
+    """ Map nodata values in a raster read from GDAL to nan, or to int_nan
+    for signed integer types.
+    """
+    if nodata is not None:
+        if A.dtype in (np.int16,np.int32):
+            A[ A==nodata ] = int_nan
+        elif A.dtype in (np.uint16,np.uint32):
+            A[ A==nodata ] = 0 # not great...
+        else:
+            A[ A==nodata ] = np.nan
+    return A
+
+class RasterBlockCache(object):
+    """ Size-bounded, least-recently-used cache of decoded raster blocks,
+    shared by lazy GdalGrid instances.
+    """
+    def __init__(self,max_bytes=512*2**20):
+        self.max_bytes=max_bytes
+        self.blocks=OrderedDict()
+        self.nbytes=0
+        self.lock=threading.Lock()
+
+    def get(self,key,loader):
+        """ Return the block for key, calling loader() to read it on a miss.
+        """
+        with self.lock:
+            block=self.blocks.pop(key,None)
+            if block is not None:
+                self.blocks[key]=block # now the most recently used
+                return block
+        block=loader()
+        with self.lock:
+            if key not in self.blocks:
+                self.blocks[key]=block
+                self.nbytes+=block.nbytes
+            # always keep at least the block just read
+            while self.nbytes>self.max_bytes and len(self.blocks)>1:
+                k,old=self.blocks.popitem(last=False)
+                self.nbytes-=old.nbytes
+        return block
+
+    def clear(self):
+        with self.lock:
+            self.blocks=OrderedDict()
+            self.nbytes=0
+
+raster_block_cache=RasterBlockCache()
+
+class LazyRaster(object):
+    """ Read-only, array-like view of the first band of a GDAL dataset.
+    Blocks are read on demand and kept in a RasterBlockCache.  With 
+    flip=True rows are ordered by increasing y, as in GdalGrid.F.
+
+    Indexing with integers, slices and integer arrays reads only the 
+    blocks involved.  Anything else (np.asarray, ufuncs, boolean masks)
+    reads the whole window.
+    """
+    ndim=2
+    def __init__(self,gds,window=None,flip=False,int_nan=-9999,cache=None,
+                 block_size=256):
+        """
+        gds: open GDAL dataset
+        window: [xoff,yoff,xsize,ysize] subset of the dataset in pixels, 
+          defaults to the whole raster.
+        block_size: blocks are read in multiples of the native block size,
+          at least this many pixels on a side.
+        """
+        self.gds=gds
+        self.band=gds.GetRasterBand(1)
+        if window is None:
+            window=[0,0,gds.RasterXSize,gds.RasterYSize]
+        self.xoff,self.yoff,xsize,ysize=[int(w) for w in window]
+        self.shape=(ysize,xsize)
+        self.flip=flip
+        self.nodata=self.band.GetNoDataValue()
+        self.int_nan=int_nan
+        self.cache=cache or raster_block_cache
+
+        bx,by=self.band.GetBlockSize()
+        self.block_shape=( by*int(np.ceil(block_size/float(by))),
+                           bx*int(np.ceil(block_size/float(bx))) )
+        # grids on the same file share cached blocks
+        self.key=(gds.GetDescription() or id(self),) + self.block_shape
+        self.lock=threading.Lock()
+
+        bh,bw=self.block_shape
+        self.dtype=self.block(self.yoff//bh,self.xoff//bw).dtype
+
+    def __len__(self):
+        return self.shape[0]
+
+    def block(self,bi,bj):
+        """ decoded block, in file orientation and absolute block indices """
+        def loader():
+            bh,bw=self.block_shape
+            y0=bi*bh ; x0=bj*bw
+            ysize=min(bh,self.gds.RasterYSize-y0)
+            xsize=min(bw,self.gds.RasterXSize-x0)
+            with self.lock: # GDAL datasets are not thread safe
+                A=self.band.ReadAsArray(x0,y0,xsize,ysize)
+            return apply_nodata(A,self.nodata,self.int_nan)
+        return self.cache.get(self.key+(bi,bj),loader)
+
+    def file_rows(self,rows):
+        if self.flip:
+            return self.yoff + self.shape[0]-1-rows
+        else:
+            return self.yoff + rows
+
+    def region(self,r0,r1,c0,c1):
+        """ read rows r0:r1 and columns c0:c1, in F orientation """
+        out=np.zeros( (max(0,r1-r0),max(0,c1-c0)), self.dtype)
+        if out.size==0:
+            return out
+        bh,bw=self.block_shape
+        if self.flip:
+            fr0=self.file_rows(r1-1) ; fr1=self.file_rows(r0)+1
+        else:
+            fr0=self.file_rows(r0) ; fr1=self.file_rows(r1-1)+1
+        fc0=self.xoff+c0 ; fc1=self.xoff+c1
+
+        for bi in range(fr0//bh,(fr1-1)//bh+1):
+            ya=max(fr0,bi*bh) ; yb=min(fr1,(bi+1)*bh)
+            for bj in range(fc0//bw,(fc1-1)//bw+1):
+                xa=max(fc0,bj*bw) ; xb=min(fc1,(bj+1)*bw)
+                blk=self.block(bi,bj)
+                out[ya-fr0:yb-fr0,xa-fc0:xb-fc0]=blk[ya-bi*bh:yb-bi*bh,
+                                                     xa-bj*bw:xb-bj*bw]
+        if self.flip:
+            out=out[::-1,:]
+        return out
+
+    def gather(self,rows,cols):
+        """ pointwise values for broadcastable integer arrays rows, cols """
+        rows,cols=np.broadcast_arrays(rows,cols)
+        out=np.zeros(rows.shape,self.dtype)
+        if out.size==0:
+            return out
+        bh,bw=self.block_shape
+        fr=self.file_rows(rows.ravel())
+        fc=self.xoff+cols.ravel()
+        bi=fr//bh ; bj=fc//bw
+        bkey=bi*(self.gds.RasterXSize//bw+1) + bj
+        order=np.argsort(bkey,kind='mergesort')
+        breaks=np.r_[0,1+np.nonzero(np.diff(bkey[order]))[0],len(order)]
+        flat=out.ravel()
+        for a,b in zip(breaks[:-1],breaks[1:]):
+            sel=order[a:b]
+            i=bi[sel[0]] ; j=bj[sel[0]]
+            flat[sel]=self.block(i,j)[fr[sel]-i*bh,fc[sel]-j*bw]
+        return flat.reshape(rows.shape)
+
+    def __array__(self,dtype=None):
+        A=self.region(0,self.shape[0],0,self.shape[1])
+        if dtype is not None:
+            A=A.astype(dtype)
+        return A
+
+    def copy(self):
+        return np.asarray(self)
+
+    def __setitem__(self,key,value):
+        raise TypeError("LazyRaster is read-only")
+
+    def __getitem__(self,key):
+        if not isinstance(key,tuple):
+            key=(key,)
+        if ( len(key)>2 or any([k is Ellipsis or k is None for k in key]) 
+             or any([getattr(k,'dtype',None)==np.bool_ for k in key]) ):
+            return np.asarray(self)[key]
+        key=key+(slice(None),)*(2-len(key))
+
+        basic=[isinstance(k,slice) or np.ndim(k)==0 for k in key]
+        if all(basic):
+            # read the bounding region, then index into that
+            spans=[self._span(k,n) for k,n in zip(key,self.shape)]
+            (r0,r1,rk),(c0,c1,ck)=spans
+            return self.region(r0,r1,c0,c1)[rk,ck]
+
+        idxs=[]
+        for k,n in zip(key,self.shape):
+            if isinstance(k,slice):
+                k=np.arange(*k.indices(n))
+            k=np.asarray(k)
+            if np.any( (k<-n) | (k>=n) ):
+                raise IndexError("index out of bounds for axis with size %d"%n)
+            idxs.append( np.where(k<0,k+n,k) )
+        rows,cols=idxs
+        # mixing a slice and an array gives the outer product, like numpy
+        if isinstance(key[0],slice) or isinstance(key[1],slice):
+            rows=rows.reshape( rows.shape + (1,)*cols.ndim )
+        return self.gather(rows,cols)
+
+    def _span(self,k,n):
+        """ for an integer or slice on an axis of length n, return
+        start,stop of the region to read and the key relative to it """
+        if isinstance(k,slice):
+            start,stop,step=k.indices(n)
+            if len(range(start,stop,step))==0:
+                return 0,0,slice(None)
+            if step>0:
+                return start,stop,slice(None,None,step)
+            else:
+                return stop+1,start+1,slice(None,None,step)
+        k=int(k)
+        if k<0:
+            k+=n
+        if not (0<=k<n):
+            raise IndexError("index out of bounds for axis with size %d"%n)
+        return k,k+1,0
+
 class GdalGrid(SimpleGrid):
     @staticmethod
     def metadata(filename):
@@ -2735,13 +3134,16 @@ class GdalGrid(SimpleGrid):
         
         return [xmin,xmax,ymin,ymax],[dx,dy]
 
-    def __init__(self,filename,bounds=None,geo_bounds=None):
+    def __init__(self,filename,bounds=None,geo_bounds=None,lazy=False):
         """ Load a raster dataset into memory.
         bounds: [x-index start, x-index end, y-index start, y-index end]
          will load a subset of the raster.
 
         filename: path to a GDAL-recognize file, or an already opened GDAL dataset.
         geo_bounds: xxyy bounds in geographic coordinates 
+        lazy: don't read the raster up front.  Instead F is a LazyRaster 
+         which reads blocks as they are needed through the shared 
+         raster_block_cache.  Only the first band is available.
         """
         if isinstance(filename,gdal.Dataset):
             self.gds=filename
@@ -2778,12 +3180,21 @@ class GdalGrid(SimpleGrid):
         self.subset_bounds = bounds
         
         if bounds:
-            A = self.gds.ReadAsArray(xoff = bounds[0],yoff=bounds[2],
-                                     xsize = bounds[1] - bounds[0],
-                                     ysize = bounds[3] - bounds[2])
+            if lazy:
+                A = LazyRaster(self.gds,
+                               window=[bounds[0],bounds[2],
+                                       bounds[1] - bounds[0],
+                                       bounds[3] - bounds[2]],
+                               flip=(dy<0),int_nan=self.int_nan)
+            else:
+                A = self.gds.ReadAsArray(xoff = bounds[0],yoff=bounds[2],
+                                         xsize = bounds[1] - bounds[0],
+                                         ysize = bounds[3] - bounds[2])
             # and doctor up the metadata to reflect this:
             x0 += bounds[0]*dx
             y0 += bounds[2]*dy
+        elif lazy:
+            A = LazyRaster(self.gds,flip=(dy<0),int_nan=self.int_nan)
         else:
             A = self.gds.ReadAsArray()
 
@@ -2807,19 +3218,13 @@ class GdalGrid(SimpleGrid):
             dy = -dy
             # this used to have the extra indices at the start, 
             # but I think that's wrong, as we put extra channels at the end
-            A = A[::-1,:,...]
+            if not lazy: # LazyRaster handles the flip itself
+                A = A[::-1,:,...]
 
         # and there might be a nodata value, which we want to map to NaN
-        b = self.gds.GetRasterBand(1)
-        nodata = b.GetNoDataValue()
-
-        if nodata is not None:
-            if A.dtype in (np.int16,np.int32):
-                A[ A==nodata ] = self.int_nan
-            elif A.dtype in (np.uint16,np.uint32):
-                A[ A==nodata ] = 0 # not great...
-            else:
-                A[ A==nodata ] = np.nan
+        if not lazy: # LazyRaster does this per block
+            b = self.gds.GetRasterBand(1)
+            A = apply_nodata(A,b.GetNoDataValue(),self.int_nan)
 
         SimpleGrid.__init__(self,
                             extents = [x0+0.5*dx,
@@ -3123,6 +3528,24 @@ class CompositeField(Field):
             self.delegate_list[i] = self.factory( self.sources[i] )
         return self.delegate_list[i]
 
+    def input_files(self):
+        """ the shapefile, and any source attributes which name 
+        existing files """
+        files=[]
+        if self.shp_fn is not None:
+            files.append(self.shp_fn)
+        for rec in self.sources:
+            for v in rec.tolist():
+                if isinstance(v,six.string_types) and os.path.isfile(v):
+                    files.append(v)
+        return files
+
+    def __getstate__(self):
+        # loaded sources may hold unpicklable handles, i.e. GDAL datasets.
+        d=dict(self.__dict__)
+        d['delegate_list']=[None]*len(self.sources)
+        return d
+
     def to_grid(self,nx=None,ny=None,bounds=None,dx=None,dy=None):
         """ render the layers to a SimpleGrid tile.
         """
@@ -3135,6 +3558,7 @@ class CompositeField(Field):
                 xmax,ymax = bounds[1]
             else:
                 xmin,xmax,ymin,ymax = bounds
+        bounds=[xmin,xmax,ymin,ymax]
         if nx is None:
             nx=1+int(np.round((xmax-xmin)/dx))
             ny=1+int(np.round((ymax-ymin)/dy))
@@ -3279,10 +3703,18 @@ class MultiRasterField(Field):
     # all: raise an exception if all patterns come up empty
     # False: silently proceed with no matches. 
     error_on_null_input='any' # 'all', or False
+
+    # value() samples independent sources on up to this many threads.
+    threads = 4
+
+    # open sources as lazy GdalGrids, reading only the blocks which
+    # are queried.
+    lazy = False
     
     def __init__(self,raster_file_patterns,**kwargs):
         self.__dict__.update(kwargs)
         Field.__init__(self)
+        self.lock = threading.Lock()
         raster_files = []
         for patt in raster_file_patterns:
             matches=glob.glob(patt)
@@ -3296,6 +3728,23 @@ class MultiRasterField(Field):
 
         self.prepare()
 
+    def input_files(self):
+        return list(self.raster_files)
+
+    def __getstate__(self):
+        # drop the lock and any loaded sources
+        d = dict(self.__dict__)
+        del d['lock']
+        d['sources'] = self.sources.copy()
+        d['sources']['field'] = None
+        d['sources']['last_used'] = -1
+        d['open_count'] = 0
+        return d
+
+    def __setstate__(self,d):
+        self.__dict__.update(d)
+        self.lock = threading.Lock()
+
     def bounds(self):
         """ Aggregate bounds """
         all_extents = np.array(self.extents)
@@ -3340,7 +3789,7 @@ class MultiRasterField(Field):
         tuples = [(i,extent,None) 
                   for i,extent in enumerate(self.sources['extent'])]
         
-        self.index = Rtree(tuples,interleaved=False)
+        self.index = PointIndex(tuples,interleaved=False)
 
     def report(self):
         """ Short text representation of the layers found and their resolutions
@@ -3354,28 +3803,52 @@ class MultiRasterField(Field):
                                          rec['filename']))
 
     max_count = 20 
+    # if not None, least recently used sources are also closed to keep
+    # the total size of loaded rasters under this many bytes.  The source
+    # just requested is always kept.
+    max_bytes = None
     open_count = 0
     serial = 0
     def source(self,i):
-        """ LRU based cache of the datasets
+        """ LRU based cache of the datasets.  Safe to call from multiple
+        threads.
         """
-        if self.sources['field'][i] is None:
-            if self.open_count >= self.max_count:
-                # Have to choose someone to close.
-                current = np.nonzero(self.sources['last_used']>=0)[0]
-                
-                victim = current[ np.argmin( self.sources['last_used'][current] ) ]
-                # print "Will evict source %d"%victim
-                self.sources['last_used'][victim] = -1
-                self.sources['field'][victim] = None
-                self.open_count -= 1
-            # open the new guy:
-            self.sources['field'][i] = GdalGrid(self.sources['filename'][i])
-            self.open_count += 1
-            
-        self.serial += 1
-        self.sources['last_used'][i] = self.serial
-        return self.sources['field'][i]
+        with self.lock:
+            self.serial += 1
+            self.sources['last_used'][i] = self.serial
+            src = self.sources['field'][i]
+        if src is None:
+            # load outside the lock so other threads can proceed
+            src = GdalGrid(self.sources['filename'][i],lazy=self.lazy)
+            with self.lock:
+                if self.sources['field'][i] is None:
+                    self.sources['field'][i] = src
+                    self.open_count += 1
+                else: # another thread beat us to it
+                    src = self.sources['field'][i]
+                self.evict(keep=i)
+        return src
+
+    def evict(self,keep=None):
+        """ Close least recently used sources until within max_count and 
+        max_bytes.  Caller should hold self.lock.
+        """
+        while 1:
+            current = np.array([j for j,f in enumerate(self.sources['field'])
+                                if f is not None],np.int32)
+            # lazy sources keep their data in the shared block cache
+            nbytes = sum([self.sources['field'][j].F.nbytes for j in current
+                          if isinstance(self.sources['field'][j].F,np.ndarray)])
+            if ( (len(current) <= self.max_count)
+                 and (self.max_bytes is None or nbytes <= self.max_bytes) ):
+                break
+            current = current[ current!=keep ]
+            if len(current) == 0:
+                break
+            victim = current[ np.argmin( self.sources['last_used'][current] ) ]
+            self.sources['last_used'][victim] = -1
+            self.sources['field'][victim] = None
+            self.open_count -= 1
         
     def value_on_point(self,xy):
         hits=self.ordered_hits(xy[xxyy])
@@ -3400,19 +3873,53 @@ class MultiRasterField(Field):
             
     def value(self,X):
         """ X must be shaped (...,2)
+
+        Gives the same result as value_on_point for each point, but points
+        are grouped by source and each group is interpolated in a single 
+        call.  Points which get nan from a source move on to the next
+        overlapping source in priority order.  Within each round, the 
+        groups are sampled on up to self.threads threads.
         """
-        X = np.array(X)
+        X = np.asarray(X,np.float64)
         orig_shape = X.shape
 
         X = X.reshape((-1,2))
 
-        newF = np.zeros( X.shape[0],np.float64 )
-        
-        for i in range(X.shape[0]):
-            if i > 0 and i % 2000 == 0:
-                print("%d/%d"%(i,X.shape[0]))
-            newF[i] = self.value_on_point( X[i] )
-        
+        newF = np.nan*np.ones( X.shape[0],np.float64 )
+
+        ranked = self.by_priority( np.arange(len(self.sources)) )
+        extents = self.sources['extent'][ranked]
+
+        # for each point, the position in ranked of the next source to try
+        next_rank = np.zeros( X.shape[0], np.int32)
+        pending = np.arange( X.shape[0] )
+
+        while len(pending):
+            Xp = X[pending]
+            rank = -np.ones( len(pending), np.int32)
+            for r,ext in enumerate(extents):
+                sel = ( (rank<0) & (next_rank[pending]<=r)
+                        & (Xp[:,0]>=ext[0]) & (Xp[:,0]<=ext[1])
+                        & (Xp[:,1]>=ext[2]) & (Xp[:,1]<=ext[3]) )
+                rank[sel] = r
+            # points which have run out of sources stay nan
+            pending = pending[rank>=0]
+            rank = rank[rank>=0]
+            if len(pending) == 0:
+                break
+
+            groups = [ (r,pending[rank==r]) for r in np.unique(rank) ]
+            def sample(group):
+                r,idxs = group
+                src = self.source(ranked[r])
+                return src.interpolate( X[idxs], interpolation='linear' )
+            for (r,idxs),vals in zip(groups,self.threaded_map(sample,groups)):
+                newF[idxs] = vals
+
+            next_rank[pending] = rank+1
+            pending = pending[ np.isnan(newF[pending]) ]
+
+        newF = np.minimum(newF,self.clip_max) # nan-preserving
         newF = newF.reshape(orig_shape[:-1])
         
         if newF.ndim == 0:
@@ -3420,6 +3927,19 @@ class MultiRasterField(Field):
         else:
             return newF
 
+    def threaded_map(self,func,items):
+        """ map(func,items), using up to self.threads threads.
+        """
+        if self.threads > 1 and len(items) > 1:
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool( min(self.threads,len(items)) )
+            try:
+                return pool.map(func,items)
+            finally:
+                pool.close()
+        else:
+            return [func(item) for item in items]
+
     def value_on_edge(self,e,samples=None):
         """
         Subsample the edge, using an interval based on the highest resolution overlapping
@@ -3470,8 +3990,15 @@ class MultiRasterField(Field):
         if len(hits) == 0:
             return []
         
-        hits = hits[ np.argsort( self.sources[hits], order=('order','resolution')) ]
-        return hits
+        return self.by_priority(hits)
+
+    def by_priority(self,hits):
+        """ sort source indices by order, then resolution, then index.
+        lexsort avoids falling back to comparing the object fields on ties.
+        """
+        hits = np.sort(hits)
+        return hits[ np.lexsort( (self.sources['resolution'][hits],
+                                  self.sources['order'][hits]) ) ]
 
     def extract_tile(self,xxyy=None,res=None):
         """ Create the requested tile from merging the sources.  Resolution defaults to
@@ -3545,7 +4072,16 @@ class MultiRasterField(Field):
 
             C,R = np.meshgrid( dec_x,dec_y )
 
-            newF = ndimage.map_coordinates(src.F, [R,C],order=self.order)
+            # read just the part of the source which is needed, with a
+            # margin for the interpolation stencil
+            margin = self.order+1
+            r0 = max(0,int(np.floor(dec_y.min()))-margin)
+            r1 = min(len(src_y),int(np.ceil(dec_y.max()))+margin+1)
+            c0 = max(0,int(np.floor(dec_x.min()))-margin)
+            c1 = min(len(src_x),int(np.ceil(dec_x.max()))+margin+1)
+            srcF = np.asarray(src.F[r0:r1,c0:c1])
+
+            newF = ndimage.map_coordinates(srcF, [R-r0,C-c0],order=self.order)
 
             # only update missing values
             missing = np.isnan(target.F[ row_slice,col_slice ])
@@ -3558,7 +4094,8 @@ class FunctionField(Field):
     function must take one argument, X, which has
     shape [...,2]
     """
-    def __init__(self,func):
+    def __init__(self,func,projection=None):
+        Field.__init__(self,projection=projection)
         self.func = func
     def value(self,X):
         return self.func(X)
@@ -3567,6 +4104,12 @@ class FunctionField(Field):
 class TileMaker(object):
     """ Given a field, create gridded tiles of the field, including some options for blending, filling,
     cropping, etc.
+
+    Tiles are rendered with a halo of extra pixels which is trimmed before
+    writing, so that filling and smoothing are seamless across tile edges.
+    Tiles can be rendered in parallel with processes>1, in which case each
+    worker gets its own copy of the field (and so its own cache of loaded
+    sources).  The field and any factory it uses must be picklable.
     """
     tx = 1000 # physical size, x, for a tile
     ty = 1000 # physical size, y, for a tile
@@ -3574,11 +4117,29 @@ class TileMaker(object):
     dy = 2    # pixel height
     fill_iterations = 10
     smoothing_iterations = 5
+    kernel_size = 3 # passed on to fill_by_convolution
     
     force = False # overwrite existing output files
     output_dir = "."
 
     filename_fmt = "%(left).0f-%(bottom).0f.tif"
+
+    # halo width in pixels.  None: enough for fill and smoothing iterations to
+    # match rendering the whole region at once.
+    halo = None
+
+    # number of worker processes for rendering tiles.
+    processes = 1
+
+    # A hash of the tile parameters and the input files (path, size and
+    # modification time, see Field.input_files) is recorded next to each tile.
+    # True: an existing tile is skipped only if its recorded hash matches, so
+    # tiles with a missing or unreadable hash are re-rendered.  False: skip any
+    # existing tile.
+    check_hash = True
+
+    # if set, write a VRT mosaic of all tiles to this path, relative to output_dir
+    vrt_filename = None
     
     def __init__(self,f,**kwargs):
         """ f: the field to be gridded
@@ -3589,43 +4150,128 @@ class TileMaker(object):
         if not os.path.exists(self.output_dir):
             os.mkdir(self.output_dir)
 
-    def tile(self,xmin,ymin,xmax,ymax):
+    def halo_pixels(self):
+        if self.halo is not None:
+            return self.halo
+        # each iteration reaches kernel_size//2 pixels further, plus a pixel
+        # for the symmetric boundary
+        return (self.fill_iterations + self.smoothing_iterations)*(self.kernel_size//2) + 1
+
+    def tile_bounds(self,xmin,ymin,xmax,ymax):
+        """ list of [xmin,xmax,ymin,ymax] for each tile """
         nx = int(np.ceil((xmax - xmin)/self.tx))
         ny = int(np.ceil((ymax - ymin)/self.ty))
+        return [ [xmin+xi*self.tx, xmin+(xi+1)*self.tx,
+                  ymin+yi*self.ty, ymin+(yi+1)*self.ty]
+                 for xi in range(nx)
+                 for yi in range(ny) ]
+
+    def tile_filename(self,xxyy):
+        # populate some local variables for giving to the filename format
+        left,right,bottom,top = xxyy
+        dx = self.dx
+        dy = self.dy
+        return os.path.join(self.output_dir,self.filename_fmt%locals())
+
+    def tile_hash(self,xxyy):
+        """ hex digest of everything that determines the content of a tile """
+        h = hashlib.sha1()
+        params = [list(xxyy),self.dx,self.dy,self.fill_iterations,
+                  self.smoothing_iterations,self.kernel_size,self.halo_pixels()]
+        h.update( repr(params).encode() )
+        for fn in self.f.input_files():
+            st = os.stat(fn)
+            h.update( repr( (fn,st.st_size,st.st_mtime) ).encode() )
+        return h.hexdigest()
+
+    def up_to_date(self,output_fn,digest):
+        if self.force or not os.path.exists(output_fn):
+            return False
+        if not self.check_hash:
+            return True
+        try:
+            with open(output_fn+'.sha1') as fp:
+                return fp.read().strip() == digest
+        except IOError:
+            return False # no hash recorded, can't tell
+
+    def render_tile(self,xxyy,output_fn=None,digest=None):
+        """ Render a single tile, [xmin,xmax,ymin,ymax], and write it to
+        output_fn if given.  Returns the SimpleGrid.
+        """
+        halo = self.halo_pixels()
+        if self.fill_iterations + self.smoothing_iterations == 0:
+            halo = 0
+        padded = [xxyy[0]-halo*self.dx, xxyy[1]+halo*self.dx,
+                  xxyy[2]-halo*self.dy, xxyy[3]+halo*self.dy]
+        blend = self.f.to_grid(dx=self.dx,dy=self.dy,bounds=padded)
+        if self.fill_iterations + self.smoothing_iterations > 0:
+            blend.fill_by_convolution(self.fill_iterations,self.smoothing_iterations,
+                                      kernel_size=self.kernel_size)
+        if halo > 0:
+            rows,cols = blend.F.shape
+            blend = blend.crop(indexes=[halo,rows-1-halo,halo,cols-1-halo])
+        if output_fn is not None:
+            blend.write_gdal( output_fn )
+            if digest is not None:
+                with open(output_fn+'.sha1','w') as fp:
+                    fp.write(digest)
+        return blend
 
-        print("Tiles: %d x %d"%(nx,ny))
-
-        for xi in range(nx):
-            for yi in range(ny):
-                ll = [xmin+xi*self.tx,
-                      ymin+yi*self.ty]
-                ur = [ll[0]+self.tx,
-                      ll[1]+self.ty]
-                bounds = np.array( [ll,ur] )
-                print("Tile ",bounds)
-
-                # populate some local variables for giving to the filename format
-                left=ll[0]
-                right=ll[0]+self.tx
-                bottom=ll[1]
-                top = ll[1]+self.ty
-                dx = self.dx
-                dy = self.dy
-                
-                output_fn = os.path.join(self.output_dir,self.filename_fmt%locals())
-
-                print("Looking for output file: %s"%output_fn)
-
-                if self.force or not os.path.exists(output_fn):
-                    blend = self.f.to_grid(dx=self.dx,dy=self.dy,bounds=bounds)
-                    if self.fill_iterations + self.smoothing_iterations > 0:
-                        print("Filling and smoothing")
-                        blend.fill_by_convolution(self.fill_iterations,self.smoothing_iterations)
-                    print("Saving")
-                    blend.write_gdal( output_fn )
-                    print("Done")
-                else:
-                    print("Already exists. Skipping")
+    def tile(self,xmin,ymin,xmax,ymax):
+        """ Render and write all tiles covering the given region, skipping
+        tiles which are up to date.  Returns the list of tile filenames.
+        """
+        all_bounds = self.tile_bounds(xmin,ymin,xmax,ymax)
+        log.info("Tiles: %d"%len(all_bounds))
+
+        output_fns = []
+        jobs = []
+        for xxyy in all_bounds:
+            output_fn = self.tile_filename(xxyy)
+            output_fns.append(output_fn)
+            digest = self.tile_hash(xxyy)
+            if self.up_to_date(output_fn,digest):
+                log.info("%s is up to date. Skipping"%output_fn)
+            else:
+                jobs.append( (xxyy,output_fn,digest) )
+
+        if self.processes > 1 and len(jobs) > 1:
+            from multiprocessing import Pool
+            # each worker gets its own copy of self, including the field
+            pool = Pool(min(self.processes,len(jobs)),
+                        initializer=_init_tile_worker,initargs=(self,))
+            try:
+                for output_fn in pool.imap_unordered(_tile_worker,jobs):
+                    log.info("Wrote %s"%output_fn)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for job in jobs:
+                _tile_worker(job,self)
+                log.info("Wrote %s"%job[1])
+
+        if self.vrt_filename is not None:
+            self.write_vrt(output_fns)
+        return output_fns
+
+    def write_vrt(self,output_fns):
+        """ Write a VRT mosaic of the given tiles to vrt_filename """
+        vrt_fn = os.path.join(self.output_dir,self.vrt_filename)
+        vrt = gdal.BuildVRT(vrt_fn,output_fns)
+        vrt.FlushCache()
+        return vrt_fn
+
+# worker process state for TileMaker.tile
+_tile_maker = None
+def _init_tile_worker(tile_maker):
+    global _tile_maker
+    _tile_maker = tile_maker
+def _tile_worker(job,tile_maker=None):
+    xxyy,output_fn,digest = job
+    (tile_maker or _tile_maker).render_tile(xxyy,output_fn,digest)
+    return output_fn
 
     
 if __name__ == '__main__':
@@ -9,6 +9,8 @@ from __future__ import print_function
 #  There is a bit of dynamic work which happens on import to figure out
 #  a few magic floating point values
 
+import numpy as np
+
 # skipping weird FPU stuff. hope that isn't necessary ....   probably wrong about that.
 
 #    cword = 4722;                 /* set FPU control word for double precision */
@@ -826,7 +828,83 @@ def orientation(a,b,c):
     """ maybe there are faster ways when all we care about is 
     yes no, zero.
     """
-    return cmp( counterclockwise(a,b,c),0 )
+    det=counterclockwise(a,b,c)
+    return int(det>0) - int(det<0)
+
+## Array versions: the floating point filters are evaluated with numpy for
+#  all rows at once, and only the rows which the filter cannot decide go
+#  through the adaptive, exact code above.
+
+def _rows(*pnts):
+    pnts=np.broadcast_arrays( *[np.asarray(p,np.float64) for p in pnts] )
+    shape=pnts[0].shape[:-1]
+    return shape,[p.reshape([-1,2]) for p in pnts]
+
+def orient2d_array(pa,pb,pc):
+    """ counterclockwise() for many triples of points.
+    pa,pb,pc: [...,2] arrays, broadcast against each other.
+    Returns the determinants, [...], which are positive for CCW,
+    with correct sign (and zeros) even for near-degenerate rows.
+    """
+    shape,(pa,pb,pc)=_rows(pa,pb,pc)
+    detleft = (pa[:,0] - pc[:,0]) * (pb[:,1] - pc[:,1])
+    detright = (pa[:,1] - pc[:,1]) * (pb[:,0] - pc[:,0])
+    det = detleft - detright
+
+    # only when detleft and detright share a sign can det be wrong
+    detsum = np.abs(detleft) + np.abs(detright)
+    uncertain = ( ( (detleft>0) & (detright>0) ) | ( (detleft<0) & (detright<0) ) )
+    uncertain &= np.abs(det) < ccwerrboundA * detsum
+    for i in np.nonzero(uncertain)[0]:
+        det[i] = counterclockwiseadapt(pa[i].tolist(), pb[i].tolist(), pc[i].tolist(),
+                                       detsum[i])
+    return det.reshape(shape)
+
+def orientation_array(pa,pb,pc):
+    """ orientation() for many triples of points, see orient2d_array.
+    Returns integer array of -1 (CW), 0 (collinear), 1 (CCW).
+    """
+    return np.sign(orient2d_array(pa,pb,pc)).astype(np.int32)
+
+def incircle_array(pa,pb,pc,pd):
+    """ incircle() for many sets of points.
+    pa,pb,pc,pd: [...,2] arrays, broadcast against each other.
+    Returns [...] values, positive where pd falls inside the circle through
+    CCW pa,pb,pc, with correct sign even for near-degenerate rows.
+    """
+    shape,(pa,pb,pc,pd)=_rows(pa,pb,pc,pd)
+    adx = pa[:,0] - pd[:,0]
+    bdx = pb[:,0] - pd[:,0]
+    cdx = pc[:,0] - pd[:,0]
+    ady = pa[:,1] - pd[:,1]
+    bdy = pb[:,1] - pd[:,1]
+    cdy = pc[:,1] - pd[:,1]
+
+    bdxcdy = bdx * cdy
+    cdxbdy = cdx * bdy
+    alift = adx * adx + ady * ady
+
+    cdxady = cdx * ady
+    adxcdy = adx * cdy
+    blift = bdx * bdx + bdy * bdy
+
+    adxbdy = adx * bdy
+    bdxady = bdx * ady
+    clift = cdx * cdx + cdy * cdy
+
+    det = ( alift * (bdxcdy - cdxbdy)
+            + blift * (cdxady - adxcdy)
+            + clift * (adxbdy - bdxady) )
+
+    permanent = ( (np.abs(bdxcdy) + np.abs(cdxbdy)) * alift
+                  + (np.abs(cdxady) + np.abs(adxcdy)) * blift
+                  + (np.abs(adxbdy) + np.abs(bdxady)) * clift )
+    errbound = iccerrboundA * permanent
+    uncertain = ~( np.abs(det) > errbound )
+    for i in np.nonzero(uncertain)[0]:
+        det[i] = incircleadapt(pa[i].tolist(), pb[i].tolist(), pc[i].tolist(),
+                               pd[i].tolist(), permanent[i])
+    return det.reshape(shape)
 
 
 if __name__ == '__main__':
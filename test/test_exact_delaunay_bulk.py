@@ -0,0 +1,60 @@
+import numpy as np
+
+from stompy.grid import exact_delaunay
+Triangulation=exact_delaunay.Triangulation
+
+def test_bulk_init():
+    pnts=np.random.random((500,2))
+    # add some cocircular and collinear points
+    pnts=np.concatenate( [pnts, np.round(np.random.random((200,2))*10)/10] )
+    pnts=np.unique(pnts,axis=0)
+    # far apart, for a constraint which crosses many edges
+    pnts=np.concatenate( [pnts, [[-1,0.5],[2,0.55]]] )
+
+    dt=Triangulation()
+    dt.bulk_init(pnts)
+
+    assert len(dt.check_orientations())==0
+    assert len(dt.check_local_delaunay())==0
+    assert len(dt.check_global_delaunay())==0
+    assert len(dt.check_convex_hull())==0
+
+    # edges['cells'] and cells['edges'] agree with a full recalculation
+    e2c=dt.edges['cells'].copy()
+    dt.edge_to_cells(recalc=True)
+    assert np.all(e2c==dt.edges['cells'])
+    for c in range(dt.Ncells()):
+        for i in range(3):
+            j=dt.cells['edges'][c,i]
+            assert set(dt.edges['nodes'][j])==set(dt.cells['nodes'][c,[i,(i+1)%3]])
+
+    # batch of constraints: hull edges, which are already edges, and
+    # one which crosses the domain
+    hull=np.nonzero(dt.edges['cells'][:,1]==dt.INF_CELL)[0]
+    pairs=np.concatenate( [ [[len(pnts)-2,len(pnts)-1]], dt.edges['nodes'][hull[::3]] ] )
+    dt.add_constraints(pairs)
+    for a,b in pairs:
+        assert dt.edges['constrained'][dt.nodes_to_edge(a,b)]
+
+    # and it's still good for incremental work
+    for x in np.random.random((20,2)):
+        dt.add_node(x=x)
+    assert len(dt.check_orientations())==0
+    assert len(dt.check_local_delaunay())==0
+
+def test_bulk_init_matches_incremental():
+    # points in general position have a unique Delaunay triangulation,
+    # so the bulk and incremental builds should find the same cells
+    pnts=np.random.RandomState(5).uniform(size=(300,2))
+
+    bulk=Triangulation()
+    bulk.bulk_init(pnts)
+    incr=Triangulation()
+    for x in pnts:
+        incr.add_node(x=x)
+
+    def cell_set(dt):
+        valid=~dt.cells['deleted']
+        return set( tuple(sorted(c)) for c in dt.cells['nodes'][valid,:3] )
+    assert cell_set(bulk)==cell_set(incr)
+    assert len(bulk.check_global_delaunay())==0
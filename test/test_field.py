@@ -36,3 +36,211 @@ def test_lin_interp():
     assert np.allclose(out,F)
 
 
+
+##
+
+def test_multi_raster_batch():
+    import tempfile,shutil
+    tmpdir=tempfile.mkdtemp()
+    try:
+        np.random.seed(3)
+        for i,(x0,res) in enumerate([(0,1.0),(50,2.0),(80,1.0)]):
+            F=np.random.normal(size=(50,int(100/res)))
+            F[np.random.random(F.shape)<0.1]=np.nan
+            g=field.SimpleGrid(extents=[x0,x0+100-res,0,50*res-res],F=F)
+            g.write_gdal(os.path.join(tmpdir,'tile%d.tif'%i))
+
+        mrf=field.MultiRasterField([os.path.join(tmpdir,'*.tif')],
+                                   max_count=2)
+        X=np.c_[ np.random.uniform(-10,200,2000),
+                 np.random.uniform(-10,60,2000) ]
+        batch=mrf.value(X)
+        single=np.array([mrf.value_on_point(x) for x in X])
+        assert np.all( np.isnan(batch)==np.isnan(single) )
+        valid=np.isfinite(batch)
+        assert np.allclose(batch[valid],single[valid])
+    finally:
+        shutil.rmtree(tmpdir)
+
+##
+
+def test_lazy_gdal_grid():
+    import tempfile,shutil
+    tmpdir=tempfile.mkdtemp()
+    try:
+        np.random.seed(4)
+        F=np.random.normal(size=(600,700))
+        F[np.random.random(F.shape)<0.05]=np.nan
+        g=field.SimpleGrid(extents=[0,699,0,599],F=F)
+        fn=os.path.join(tmpdir,'dem.tif')
+        g.write_gdal(fn)
+
+        eager=field.GdalGrid(fn)
+        lazy=field.GdalGrid(fn,lazy=True)
+        assert isinstance(lazy.F,field.LazyRaster)
+        assert np.allclose(eager.extents,lazy.extents)
+
+        X=np.random.uniform(-5,300,(1000,2))
+        for interp in ['nearest','linear']:
+            a=eager.interpolate(X,interpolation=interp)
+            b=lazy.interpolate(X,interpolation=interp)
+            assert np.all( np.isnan(a)==np.isnan(b) )
+            assert np.allclose(a[np.isfinite(a)],b[np.isfinite(b)])
+
+        rect=[100,250,30,120]
+        assert np.allclose(eager.crop(rect).F,lazy.crop(rect).F,equal_nan=True)
+    finally:
+        shutil.rmtree(tmpdir)
+
+##
+
+def test_inv_dist_batch():
+    np.random.seed(5)
+    X=np.random.uniform(0,1000,(5000,2))
+    F=np.random.normal(size=len(X))
+    f=field.XYZField(X=X,F=F)
+    f.build_index()
+
+    P=np.random.uniform(0,1000,(200,2))
+    for kw in [dict(min_radius=40),
+               dict(min_radius=20,min_n_closest=8),
+               dict(min_n_closest=8,clip_min=-0.5,clip_max=0.5)]:
+        batch=f.inv_dist_interp_batch(P,**kw)
+        single=np.array([f.inv_dist_interp(p,**kw) for p in P])
+        assert np.allclose(batch,single)
+
+    near=f.interpolate(P,interpolation='nearest')
+    assert np.allclose(near,F[[f.nearest(p) for p in P]])
+
+##
+
+def _wavy(X):
+    v=np.sin(X[...,0]/50.)+np.cos(X[...,1]/70.)
+    v[ np.sin(X[...,0]/13.)*np.cos(X[...,1]/17.) > 0.6 ] = np.nan
+    return v
+
+def test_tile_maker_seamless():
+    import tempfile,shutil
+    tmpdir=tempfile.mkdtemp()
+    try:
+        f=field.FunctionField(_wavy)
+        tm=field.TileMaker(f,tx=100,ty=80,dx=2,dy=2,
+                           fill_iterations=4,smoothing_iterations=2,
+                           output_dir=tmpdir)
+        fns=tm.tile(0,0,200,160)
+        assert len(fns)==4
+
+        # reference: one big render, with enough margin that the outer
+        # boundary doesn't matter
+        pad=40
+        full=f.to_grid(dx=2,dy=2,bounds=[-pad,200+pad,-pad,160+pad])
+        full.fill_by_convolution(4,2)
+        for fn in fns:
+            tile=field.GdalGrid(fn)
+            sub=full.crop(tile.extents)
+            assert np.allclose(sub.F,tile.F,equal_nan=True)
+
+        # everything is up to date, so the second pass writes nothing
+        mtimes=[os.stat(fn).st_mtime for fn in fns]
+        tm.tile(0,0,200,160)
+        assert mtimes==[os.stat(fn).st_mtime for fn in fns]
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_tile_maker_up_to_date():
+    import tempfile,shutil
+    tmpdir=tempfile.mkdtemp()
+    try:
+        tm=field.TileMaker(field.ConstantField(1.0),output_dir=tmpdir)
+        fn=os.path.join(tmpdir,'tile.tif')
+        assert not tm.up_to_date(fn,'abc')
+        with open(fn,'w') as fp:
+            fp.write('tile')
+        # a tile without a recorded hash is stale
+        assert not tm.up_to_date(fn,'abc')
+        with open(fn+'.sha1','w') as fp:
+            fp.write('abc')
+        assert tm.up_to_date(fn,'abc')
+        assert not tm.up_to_date(fn,'def')
+        tm.force=True
+        assert not tm.up_to_date(fn,'abc')
+
+        # without hash checking, any existing tile is kept
+        tm.force=False
+        tm.check_hash=False
+        os.unlink(fn+'.sha1')
+        assert tm.up_to_date(fn,'def')
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_tile_maker_stale():
+    import tempfile,shutil
+    tmpdir=tempfile.mkdtemp()
+    try:
+        src=os.path.join(tmpdir,'source.dat')
+        with open(src,'w') as fp:
+            fp.write('v1')
+        class SourceField(field.FunctionField):
+            def input_files(self):
+                return [src]
+        tm=field.TileMaker(SourceField(_wavy),tx=100,ty=80,dx=2,dy=2,
+                           output_dir=tmpdir)
+        fn,=tm.tile(0,0,100,80)
+        assert os.path.exists(fn+'.sha1')
+
+        def rendered():
+            # mark the tile as old, tile again, and see if it was rewritten
+            os.utime(fn,(0,0))
+            tm.tile(0,0,100,80)
+            return os.stat(fn).st_mtime!=0
+        assert not rendered()
+
+        # a changed source makes the tile stale
+        with open(src,'w') as fp:
+            fp.write('version 2')
+        assert rendered()
+        assert not rendered()
+
+        # so does a missing hash
+        os.unlink(fn+'.sha1')
+        assert rendered()
+        assert os.path.exists(fn+'.sha1')
+    finally:
+        shutil.rmtree(tmpdir)
+
+##
+
+def test_fill_by_convolution():
+    from scipy import signal
+    np.random.seed(7)
+    F=np.random.normal(size=(80,90)).cumsum(axis=0)
+    F[np.random.random(F.shape)<0.01]=np.nan
+    F[:10,:15]=np.nan
+
+    # straightforward version of the algorithm, on the whole array
+    ref=F.copy()
+    kern=np.ones((3,3))
+    valid=np.isfinite(ref)
+    bin_valid=valid.copy()
+    ref[~valid]=0.0
+    for i in range(5+2):
+        weights=signal.convolve2d(bin_valid,kern,mode='same',boundary='symm')
+        values=signal.convolve2d(ref,kern,mode='same',boundary='symm')
+        if i<5:
+            bin_valid|=(weights>0)
+        to_update=bin_valid&(~valid)
+        ref[to_update]=values[to_update]/weights[to_update]
+    ref[~bin_valid]=np.nan
+
+    g=field.SimpleGrid(extents=[0,89,0,79],F=F.copy())
+    g.fill_by_convolution(iterations=5,smoothing=2)
+    assert np.allclose(g.F,ref,equal_nan=True)
+
+    g=field.SimpleGrid(extents=[0,89,0,79],F=F.copy())
+    g.fill_by_convolution(iterations='adaptive')
+    assert np.all(np.isfinite(g.F))
+
+    g=field.SimpleGrid(extents=[0,89,0,79],F=F.copy())
+    g.fill_by_nearest()
+    assert np.all(np.isfinite(g.F))
+    assert np.allclose(g.F[valid],F[valid])
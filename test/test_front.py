@@ -360,6 +360,21 @@ def test_actions():
 # they are tried, then we populate the child nodes.
 
 
+def test_site_queue():
+    # the incrementally updated site queue should always agree with
+    # a full scan of the front
+    af=test_basic_setup()
+    for step in range(40):
+        site=af.choose_site()
+        sites=af.enumerate_sites()
+        if site is None:
+            assert len(sites)==0
+            break
+        assert len(af.site_queue)==len(sites)
+        best=sites[ np.argmin([s.metric() for s in sites]) ]
+        assert list(site.abc)==list(best.abc)
+        assert af.advance_at_site(site)
+
 def test_dt_one_loop():
     """ fill a squat hex with triangles.
     """
@@ -928,3 +943,69 @@ def test_sine_sine():
 
 # what does that mean for things like merge_edges?
 # 
+
+def test_pave_subdomains():
+    rings=[ np.array([[0,0],[1000,0],[1000,500],[0,500]],np.float64) ]
+    scale=field.ConstantField(100)
+
+    g=front.pave_subdomains(rings,scale,count=2,processes=2)
+    serial=trifront_wrapper(rings,scale).grid
+
+    # stitched without seams along the cut
+    assert len(g.boundary_linestrings())==1
+    assert np.all(g.cells_area()>0)
+    assert abs(g.Ncells() - serial.Ncells()) <= 0.15*serial.Ncells()
+    assert abs(g.cells_area().sum() - serial.cells_area().sum()) <= 0.01*500000
+
+def test_default_cuts():
+    rings=[ np.array([[0,0],[1000,0],[1000,500],[0,500]],np.float64) ]
+    cuts=front.default_cuts(rings,2)
+    assert abs(cuts[0][0,0]-500)<1
+
+    # scale of 10 at x=0 growing to 100 at x=1000.  Equal cell counts
+    # put the cuts toward the fine end.
+    scale=field.FunctionField(lambda X: 10+0.09*X[...,0])
+    cuts=front.default_cuts(rings,3,scale=scale)
+    xs=[cut[0,0] for cut in cuts]
+    assert xs[0]<xs[1]<500
+    # cells per piece ~ integral of 1/scale**2
+    def count(a,b):
+        return (1/(10+0.09*a) - 1/(10+0.09*b))/0.09
+    counts=[count(a,b) for a,b in zip([0]+xs,xs+[1000])]
+    assert np.std(counts) < 0.02*np.mean(counts)
+
+def test_batch_cost():
+    rings=[ np.array([[0,0],[1000,0],[1000,500],[0,500]],np.float64) ]
+    af=trifront_wrapper(rings,field.ConstantField(100))
+    g=af.grid
+
+    nodes=[n for n in range(g.Nnodes()) if len(g.node_to_cells(n))]
+    costs=af.batch_cost(nodes)
+    assert np.allclose(costs, [af.eval_cost(n) for n in nodes])
+
+    # jostle the interior, then check the analytic gradient
+    free=np.nonzero(g.nodes['fixed']==af.FREE)[0]
+    rng=np.random.RandomState(1)
+    for n in free:
+        try:
+            g.modify_node(n,x=g.nodes['x'][n]+rng.uniform(-15,15,2))
+        except af.cdt.IntersectingConstraints:
+            pass
+    x=g.nodes['x'][free]
+    costs,grads=af.batch_cost(free,gradient=True)
+    eps=1e-6
+    for d in range(2):
+        dx=np.zeros_like(x) ; dx[:,d]=eps
+        fd=(af.batch_cost(free,x=x+dx) - af.batch_cost(free,x=x-dx))/(2*eps)
+        assert np.allclose(fd,grads[:,d],rtol=1e-4,atol=1e-4*np.abs(fd).max())
+
+    # colors are independent sets
+    for color in af.color_nodes(free):
+        for n in color:
+            for c in g.node_to_cells(n):
+                assert len(np.intersect1d(g.cell_to_nodes(c),color))==1
+
+    before=np.nanmax(af.batch_cost(nodes))
+    after=af.relax_nodes_jacobi(iterations=5)
+    assert after < before
+    assert np.all(g.cells_area()>0)
@@ -353,6 +353,50 @@ def test_sine_sine():
     p=gen_sine_sine()
     p.pave_all()
 
+def test_relax_jacobi():
+    boundary=np.array([[0,0],[1000,0],[1000,1000],[0,1000]],np.float64)
+    p=paver.Paving(rings=[boundary],density=field.ConstantField(100))
+    p.pave_all()
+
+    costs=p.costs_for_points()
+    for i in range(p.Npoints()):
+        if len(p.pnt2cells(i)):
+            assert np.allclose(costs[i],p.cost_for_point(i))
+        else:
+            assert np.isnan(costs[i])
+
+    # jostle the interior, then relax all of the nodes at once
+    free=np.nonzero(p.node_data[:,p.STAT]==p.FREE)[0]
+    rng=np.random.RandomState(0)
+    p.points[free,:2]+=rng.uniform(-10,10,(len(free),2))
+    before=p.costs_for_points()
+    p.relax_mode='jacobi'
+    for it in range(3):
+        p.relax(threshold=0.0)
+    after=p.costs_for_points()
+    assert np.nanmax(after) < np.nanmax(before)
+    assert np.nanmean(after) < np.nanmean(before)
+
+    # serial relax visits only points with a finite cost, worst first
+    # a node which keeps its edges but loses its cells has a nan cost
+    corner=np.argmin([len(p.pnt2cells(i)) for i in range(p.Npoints())])
+    for c in list(p.pnt2cells(corner)):
+        p.delete_cell(c)
+    assert len(p.pnt2edges(corner))>0
+    costs=p.costs_for_points()
+    assert np.isnan(costs[corner])
+    visited=[]
+    relax_one=p.safe_relax_one
+    def record(i,*a,**kw):
+        visited.append(i)
+        return relax_one(i,*a,**kw)
+    p.safe_relax_one=record
+    p.relax_mode='serial'
+    p.relax(threshold=0.0)
+    assert len(visited)>0
+    assert np.all(np.isfinite(costs[visited]))
+    assert np.all(np.diff(costs[visited])<=0)
+
 
 if 0:
     # debugging the issue with sine_sine()
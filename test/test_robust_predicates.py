@@ -0,0 +1,45 @@
+import numpy as np
+
+from stompy.spatial import robust_predicates
+
+def test_predicate_arrays():
+    # array predicates must agree with the scalar versions, including
+    # degenerate rows which the floating point filter cannot decide
+    A=np.array([[0,0],[0,0],[0,0],[0.1,0.1],[0,0]])
+    B=np.array([[1,0],[1,0],[1,0],[0.3,0.3],[1e-20,0]])
+    C=np.array([[1,1],[1,1],[1,1],[0.7,0.7],[0,1e-20]])
+    D=np.array([[2,0],[0,1],[0.5,0.5],[0.5,0.1],[0,1e-30]])
+
+    ori=robust_predicates.orientation_array(A,B,C)
+    inc=robust_predicates.incircle_array(A,B,C,D)
+    for i in range(len(A)):
+        assert ori[i]==robust_predicates.orientation(A[i],B[i],C[i])
+        assert np.sign(inc[i])==np.sign(robust_predicates.incircle(A[i],B[i],C[i],D[i]))
+    assert ori[3]==0
+    assert inc[1]==0
+
+    # broadcasting against a single point
+    assert list(robust_predicates.orientation_array([0,0],[1,0],[[0,1],[2,0],[0,-1]]))==[1,0,-1]
+
+def test_predicate_arrays_near_degenerate():
+    # points on or within a few ulps of a line and a circle, where the
+    # plain floating point determinants get the sign wrong
+    rng=np.random.RandomState(3)
+    n=500
+    s=rng.uniform(0,1,size=(n,3))
+    A=np.c_[s[:,0],0.5*s[:,0]+0.1]
+    B=np.c_[s[:,1],0.5*s[:,1]+0.1]
+    C=np.c_[s[:,2],0.5*s[:,2]+0.1]
+    C[::2]+=rng.randint(-2,3,size=(len(C[::2]),2))*np.spacing(C[::2])
+
+    det=robust_predicates.orient2d_array(A,B,C)
+    for i in range(n):
+        assert np.sign(det[i])==np.sign(robust_predicates.counterclockwise(A[i],B[i],C[i]))
+    assert np.any(det==0) and np.any(det>0) and np.any(det<0)
+
+    theta=rng.uniform(0,2*np.pi,size=(n,4))
+    A,B,C,D=[np.c_[np.cos(theta[:,k]),np.sin(theta[:,k])] for k in range(4)]
+    D[::2]+=rng.randint(-2,3,size=(len(D[::2]),2))*np.spacing(D[::2])
+    inc=robust_predicates.incircle_array(A,B,C,D)
+    for i in range(n):
+        assert np.sign(inc[i])==np.sign(robust_predicates.incircle(A[i],B[i],C[i],D[i]))
@@ -0,0 +1,313 @@
+import numpy as np
+
+from stompy.model.suntans import sunreader
+
+def test_outer_index():
+    a=np.arange(4*5*3).reshape([4,5,3])
+
+    keys=(slice(1,4),np.array([4,0,2]),1)
+    expected=a[1:4][:,[4,0,2]][:,:,1]
+    assert np.all(sunreader.outer_index(a,keys)==expected)
+
+    # integer first key drops the axis, later keys shift down
+    keys=(2,np.array([1,3]),np.array([0,2]))
+    expected=a[2][np.ix_([1,3],[0,2])]
+    assert np.all(sunreader.outer_index(a,keys)==expected)
+
+    # fewer keys than axes, negative and strided slices
+    assert np.all(sunreader.outer_index(a,(slice(None,None,-2),))==a[::-2])
+    assert np.all(sunreader.outer_index(a,(np.array([-1]),slice(3,None)))==a[[-1],3:])
+
+def two_proc_output():
+    """ synthetic output for 6 global cells on two processors, each with
+    a ghost copy of a cell owned by the other, and a global cell (5) with
+    no owner.  returns reader(proc) and the global to local mapping.
+    """
+    nt,nk=4,3
+    # proc 0 owns global cells 0,1,2, ghost of 3
+    # proc 1 owns global cells 3,4, ghost of 2
+    local_globals=[np.array([0,1,2,3]),np.array([2,4,3])]
+    owned=[np.array([True,True,True,False]),np.array([False,True,True])]
+
+    outputs=[]
+    for p,glob in enumerate(local_globals):
+        t=np.arange(nt)[:,None,None]
+        k=np.arange(nk)[None,None,:]
+        data=(100*t + 10*glob[None,:,None] + k).astype('f8')
+        # ghost values are garbage, and must not show up
+        data[:,~owned[p],:]=-999
+        outputs.append(data)
+
+    g2l=np.zeros(6,[('global',np.int32),('proc',np.int32),('local',np.int32)])
+    g2l['global']=np.arange(6)
+    g2l['proc']=-1
+    for p,glob in enumerate(local_globals):
+        for l in np.nonzero(owned[p])[0]:
+            g2l['proc'][glob[l]]=p
+            g2l['local'][glob[l]]=l
+    return (lambda p: outputs[p]),g2l
+
+def eager_global(reader,g2l,nsteps):
+    """ the straightforward per-processor assembly of a global array """
+    sample=reader(0)
+    result=np.nan*np.ones( (nsteps,len(g2l))+sample.shape[2:] )
+    for p in np.unique(g2l['proc']):
+        if p<0:
+            continue
+        sel=(g2l['proc']==p)
+        result[:,sel]=reader(p)[:nsteps,g2l['local'][sel]]
+    return result
+
+def test_global_cell_array():
+    reader,g2l=two_proc_output()
+    nsteps=3 # fewer than the processors have
+    arr=sunreader.GlobalCellArray(reader,g2l,nsteps)
+    expected=eager_global(reader,g2l,nsteps)
+
+    assert arr.shape==(3,6,3)
+    full=np.asarray(arr)
+    assert np.all( np.isnan(full)==np.isnan(expected) )
+    assert np.all( full[:,:5]==expected[:,:5] )
+    assert np.all( (full>=0) | np.isnan(full) ) # no ghost values
+
+    for key in [ (1,),
+                 (slice(None),4),
+                 (2,np.array([4,2,0]),1),
+                 (slice(-2,None),slice(1,4)),
+                 (np.array([0,2]),np.array([3,1]),np.array([2,0])),
+                 (slice(None,None,-1),np.array([5,3])),
+                 (slice(0,10),) ]:
+        got=arr[key]
+        ref=sunreader.outer_index(expected,key)
+        assert got.shape==ref.shape,key
+        assert np.allclose(got,ref,equal_nan=True),key
+
+def test_global_cell_array_xarray():
+    import xarray as xr
+    if sunreader.xr_indexing is None:
+        return # lazy path needs xarray internals
+    reader,g2l=two_proc_output()
+    arr=sunreader.GlobalCellArray(reader,g2l,4)
+    expected=eager_global(reader,g2l,4)
+
+    var=xr.Variable( ('time','cell','k'),
+                     sunreader.xr_indexing.LazilyIndexedArray(arr) )
+    da=xr.DataArray(var)
+    assert np.allclose(da.isel(time=2,k=1).values,expected[2,:,1],equal_nan=True)
+    assert np.allclose(da.isel(cell=[4,0]).values,expected[:,[4,0]])
+    assert np.allclose(da.isel(cell=slice(0,5)).mean(dim='cell').values,
+                       expected[:,:5].mean(axis=1))
+
+class ColumnReader(sunreader.SunReader):
+    """ a SunReader over synthetic cells and freesurface, no files """
+    def __init__(self,dz,depth,Nk,fs):
+        self._dz=np.asarray(dz,np.float64)
+        self._z_levels=None
+        self.cdata=np.zeros( (len(depth),5) )
+        self.cdata[:,3]=depth
+        self.cdata[:,4]=Nk
+        self.fs=np.asarray(fs,np.float64)
+    def celldata(self,proc):
+        return self.cdata
+    def freesurface(self,proc,time_step=None):
+        if time_step is None:
+            return self.fs
+        return self.fs[time_step]
+    def cell_scalar(self,label,proc):
+        return None,self.scalar
+
+def old_all_dz(sun,h):
+    # per-step, per-cell all_dz as it was before vectorizing over time
+    Nk=sun.cdata[:,4].astype(np.int32)
+    bed=-sun.cdata[:,3]
+    all_dz=sun.dz()[None,:].repeat(len(Nk),axis=0)
+    z=-sun.z_levels()
+    ctops=sun.h_to_ctop(h)
+    for i in range(len(Nk)):
+        all_dz[i,:ctops[i]]=0.0
+        all_dz[i,Nk[i]:]=0.0
+        all_dz[i,ctops[i]]=h[i]-z[ctops[i]]
+        all_dz[i,Nk[i]-1]-=bed[i]-z[Nk[i]-1]
+    return all_dz
+
+def old_averaging_weights(sun,h,ztop=None,zbottom=None,dz=None):
+    # per-step averaging_weights as it was before vectorizing over time
+    Nk=sun.cdata[:,4].astype(np.int32)
+    bed=-sun.cdata[:,3]
+    one_dz=sun.dz()
+    all_dz=one_dz[None,:].repeat(len(Nk),axis=0)
+    all_k=np.arange(len(one_dz))[None,:].repeat(len(Nk),axis=0)
+    z=-sun.z_levels()
+    if ztop is not None:
+        if ztop!=0:
+            h=h-ztop
+            h[h<bed]=bed[h<bed]
+        if dz is not None:
+            bed=np.maximum(h-dz,bed)
+    if zbottom is not None:
+        if zbottom!=0:
+            bed=bed+zbottom
+        if dz is not None:
+            h=bed+dz
+    ctops=sun.h_to_ctop(h)
+    cbeds=sun.h_to_ctop(bed,dzmin=0)+1
+    cbeds[cbeds>Nk]=Nk[cbeds>Nk]
+    drymask=(all_k<ctops[:,None]) | (all_k>=cbeds[:,None])
+    all_dz[drymask]=0.0
+    ii=np.arange(len(Nk))
+    all_dz[ii,ctops]=h-z[ctops]
+    all_dz[ii,cbeds-1]-=bed-z[cbeds-1]
+    return all_dz/np.sum(all_dz,axis=1)[:,None]
+
+def column_reader():
+    dz=[1,1,2,2,4] # layer bottoms at 1,2,4,6,10
+    depth=[9.5,3.0,0.5,6.0]
+    Nk=[5,3,1,4]
+    # wet, drawn down, and dry (surface at the bed) columns over 7 steps
+    fs=np.array([[ 0.3, 0.3, 0.2, 0.0],
+                 [-0.5,-0.9,-0.5,-1.5],
+                 [-1.2,-2.5,-0.5,-3.9],
+                 [ 0.0,-3.0, 0.1,-6.0],
+                 [ 1.5, 1.0, 1.0, 0.7],
+                 [-0.1,-2.99,-0.4,-5.5],
+                 [-0.7,-0.2,-0.5,-2.0]])
+    return ColumnReader(dz,depth,Nk,fs)
+
+def test_layer_dz():
+    sun=column_reader()
+    steps=np.arange(len(sun.fs))
+    # all_dz for a block of steps matches the per-step loop
+    blk=sun.all_dz(0,steps)
+    assert blk.shape==(len(steps),4,5)
+    for t in steps:
+        assert np.allclose(blk[t],old_all_dz(sun,sun.fs[t]))
+        assert np.allclose(sun.all_dz(0,t),old_all_dz(sun,sun.fs[t]))
+    # layers sum to the water column, where there is one
+    depth=sun.fs+sun.cdata[:,3]
+    wet=depth>2*sun.dzmin
+    assert np.allclose(blk.sum(axis=2)[wet],depth[wet])
+
+def test_layer_weights():
+    sun=column_reader()
+    windows=[ {},
+              {'ztop':0},
+              {'ztop':0.5,'dz':2.0},
+              {'ztop':0,'dz':3.0},
+              {'zbottom':0,'dz':1.5},
+              {'zbottom':1.0,'dz':1.0},
+              {'ztop':1.0,'zbottom':1.0},
+              {'ztop':20.0,'dz':1.0} ] # deeper than any column
+    with np.errstate(invalid='ignore',divide='ignore'):
+        for kw in windows:
+            # several blocks of steps, in and out of order
+            for blk in [ np.arange(7), np.array([3,0,6]), np.array([2]) ]:
+                w=sun.layer_weights(0,sun.fs[blk],**kw)
+                assert w.shape==(len(blk),4,5)
+                for i,t in enumerate(blk):
+                    ref=old_averaging_weights(sun,sun.fs[t].copy(),**kw)
+                    assert np.allclose(w[i],ref,equal_nan=True),(kw,t)
+                    assert np.allclose(sun.averaging_weights(0,t,**kw),ref,equal_nan=True)
+            # the caller's freesurface is not modified
+            assert np.all(sun.fs==column_reader().fs)
+
+def test_depth_average():
+    sun=column_reader()
+    rng=np.random.RandomState(2)
+    sun.scalar=rng.uniform(size=sun.fs.shape+(5,))
+    # junk below the bed and above the surface is ignored
+    w_all=sun.layer_weights(0,sun.fs)
+    sun.scalar[w_all==0]=1e6
+    # a block of 3 steps at a time
+    sun.averaging_block_bytes=3*4*5*sunreader.REALSIZE
+
+    with np.errstate(invalid='ignore',divide='ignore'):
+        for kw in [ {}, {'ztop':0.5,'dz':2.0}, {'zbottom':1.0,'dz':1.0} ]:
+            avg=sun.depth_average('SalinityFile',proc=0,**kw)
+            steps=[1,4,5,6]
+            part=sun.depth_average('SalinityFile',proc=0,time_steps=steps,**kw)
+            for t in range(len(sun.fs)):
+                w=old_averaging_weights(sun,sun.fs[t].copy(),**kw)
+                ref=np.nansum(w*sun.scalar[t],axis=1)
+                ref[np.isnan(w).all(axis=1)]=np.nan
+                assert np.allclose(avg[t],ref,equal_nan=True),(kw,t)
+                if t in steps:
+                    assert np.allclose(part[steps.index(t)],ref,equal_nan=True)
+
+class StepReader(sunreader.SunReader):
+    """ a SunReader with synthetic output times and two-processor
+    output, no files """
+    def __init__(self,absdays,reader=None,g2l=None):
+        self.absdays=np.asarray(absdays,np.float64)
+        self.reader=reader
+        self.g2l=g2l
+    def output_absdays(self):
+        return self.absdays
+    def cell_scalar(self,label,proc):
+        return None,self.reader(proc)
+    def locate_points(self,xy):
+        # points are given as global cell numbers in x
+        return self.g2l[np.asarray(xy)[:,0].astype(np.int32)]
+
+def test_output_steps():
+    sun=StepReader([10.0,10.5,11.0,12.0]) # irregular output interval
+
+    # nearest output, clamped at the ends of the run
+    steps,weights=sun.output_steps([9.0,10.0,10.2,10.3,11.4,11.6,12.0,13.0])
+    assert np.all(steps[:,0]==[0,0,0,1,2,3,3,3])
+    assert np.all(weights==[1,0])
+
+    # linear interpolation between the bracketing outputs
+    t=np.array([9.0,10.0,10.25,10.5,11.5,11.75,12.0,13.0])
+    steps,weights=sun.output_steps(t,interpolate=True)
+    assert np.all(steps[:,1]==steps[:,0]+1)
+    assert np.all(steps[:,0]==[0,0,0,1,2,2,2,2])
+    assert np.allclose(weights.sum(axis=1),1)
+    # weights reproduce the times themselves, clamped to the run
+    assert np.allclose( (weights*sun.absdays[steps]).sum(axis=1), t.clip(10,12) )
+
+    # shape of the times is kept
+    steps,weights=sun.output_steps(t.reshape([2,4]),interpolate=True)
+    assert steps.shape==weights.shape==(2,4,2)
+
+    # a single output can only be the nearest
+    sun=StepReader([10.0])
+    steps,weights=sun.output_steps([9.0,11.0],interpolate=True)
+    assert np.all(steps==0)
+    assert np.all(weights[:,0]==1)
+
+def test_gather_cells():
+    reader,g2l=two_proc_output()
+    sun=StepReader([10.0,10.5,11.0,12.0],reader,g2l)
+    full=eager_global(reader,g2l,4) # [time,cell,k]
+
+    # repeated cells, both processors, and the unowned cell 5
+    cells=np.array([3,0,5,2,4,2,1])
+    located=g2l[cells]
+
+    # all steps
+    result=sun.gather_cells(reader,located)
+    assert result.shape==(4,len(cells),3)
+    assert np.allclose(result,full[:,cells],equal_nan=True)
+    # ghost copies are never read
+    assert np.all( (result>=0) | np.isnan(result) )
+
+    # one step per point, including repeated (step,cell) pairs
+    steps=np.array([0,3,1,2,2,2,0])
+    result=sun.gather_cells(reader,located,steps)
+    assert result.shape==(len(cells),3)
+    assert np.allclose(result,full[steps,cells],equal_nan=True)
+
+    # interpolated in time
+    t=np.array([10.25,9.0,11.5,12.0,10.9,10.25,13.0])
+    steps,weights=sun.output_steps(t,interpolate=True)
+    result=sun.gather_cells(reader,located,steps,weights)
+    expected=( weights[:,0,None]*full[steps[:,0],cells] +
+               weights[:,1,None]*full[steps[:,1],cells] )
+    assert np.allclose(result,expected,equal_nan=True)
+    assert np.all(np.isnan(result[2]))
+
+    # extract_points goes through the same path
+    xy=np.c_[cells,np.zeros(len(cells))]
+    assert np.allclose(sun.extract_points(xy,'SalinityFile',absdays=t,interpolate=True),
+                       expected,equal_nan=True)
+    assert np.allclose(sun.extract_points(xy,'SalinityFile'),full[:,cells],equal_nan=True)
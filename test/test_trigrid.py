@@ -7,6 +7,108 @@ def test_read_sun():
 
     g = trigrid.TriGrid(suntans_path=path)
     g.Ncells()
+
+def test_read_sun_cached():
+    import tempfile,shutil
+    import numpy as np
+    path=os.path.join( os.path.dirname(__file__),'data','sfbay')
+    tmpdir=tempfile.mkdtemp()
+    cache_dir=trigrid.binary_cache_dir
+    try:
+        assert trigrid.binary_cache # on by default
+        trigrid.binary_cache_dir=os.path.join(tmpdir,'cache')
+        trigrid.points_dat_cache.clear()
+        g1 = trigrid.TriGrid(suntans_path=path) # parses, writes cache
+        cached=os.listdir(trigrid.binary_cache_dir)
+        assert len([fn for fn in cached if fn.startswith('cells.dat')])>0
+        # nothing is written next to the data
+        assert not os.path.exists(os.path.join(path,'cells.dat.cache'))
+        trigrid.points_dat_cache.clear()
+        g2 = trigrid.TriGrid(suntans_path=path,readonly=True) # from cache
+        for a,b in [ (g1.points,g2.points), (g1.cells,g2.cells),
+                     (g1.edges,g2.edges), (g1._vcenters,g2._vcenters) ]:
+            assert a.dtype==b.dtype
+            assert np.all(a==b)
+    finally:
+        trigrid.binary_cache_dir=cache_dir
+        trigrid.points_dat_cache.clear()
+        shutil.rmtree(tmpdir)
+
+def test_cached_read():
+    import tempfile,shutil
+    import numpy as np
+    tmpdir=tempfile.mkdtemp()
+    cache_dir=trigrid.binary_cache_dir
+    parsed=[]
+    def parser(fn):
+        parsed.append(fn)
+        return trigrid.parse_suntans_points(fn)
+    try:
+        trigrid.binary_cache_dir=os.path.join(tmpdir,'cache')
+        fn=os.path.join(tmpdir,'points.dat')
+        with open(fn,'wt') as fp:
+            fp.write("0 0 0\n1 0 0\n")
+        a=trigrid.cached_read(fn,parser)
+        b=trigrid.cached_read(fn,parser) # from the cache
+        assert len(parsed)==1
+        assert np.all(a['points']==b['points'])
+
+        # a modified file invalidates the cache
+        with open(fn,'at') as fp:
+            fp.write("1 1 0\n")
+        c=trigrid.cached_read(fn,parser)
+        assert len(parsed)==2
+        assert len(c['points'])==3
+        assert len(trigrid.cached_read(fn,parser)['points'])==3
+        assert len(parsed)==2
+
+        # so does a change in mtime alone
+        st=os.stat(fn)
+        os.utime(fn,(st.st_atime,st.st_mtime+10))
+        trigrid.cached_read(fn,parser)
+        assert len(parsed)==3
+
+        # and with the cache off, every read parses
+        trigrid.binary_cache=False
+        trigrid.cached_read(fn,parser)
+        assert len(parsed)==4
+    finally:
+        trigrid.binary_cache=True
+        trigrid.binary_cache_dir=cache_dir
+        shutil.rmtree(tmpdir)
+
+def test_find_cells():
+    import numpy as np
+    path=os.path.join( os.path.dirname(__file__),'data','sfbay')
+    g = trigrid.TriGrid(suntans_path=path)
+
+    sel = np.arange(0,g.Ncells(),7)
+    # rotate the node order, and add a triple which is not a cell
+    query = np.concatenate( [ g.cells[sel][:,[1,2,0]],
+                              [[0,1,g.Npoints()-1]] ] )
+    found = g.find_cells(query)
+    assert np.all( found[:-1]==sel )
+    assert found[-1]==-1
+    for i in sel[:10]:
+        assert g.find_cell(g.cells[i])==i
+
+    # large node indices fall back to comparing bytes
+    big = g.cells[sel] + 2**22
+    assert np.all( trigrid.match_cells(g.cells+2**22,big[:,::-1])==sel )
+    
+def test_cell_locator():
+    import numpy as np
+    path=os.path.join( os.path.dirname(__file__),'data','sfbay')
+    g = trigrid.TriGrid(suntans_path=path)
+
+    rng = np.random.RandomState(1)
+    lo = g.points.min(axis=0)
+    hi = g.points.max(axis=0)
+    pnts = lo + (hi-lo)*rng.uniform(size=(50,2))
+
+    found = g.cell_locator()(pnts)
+    for p,c in zip(pnts,found):
+        assert c==g.closest_cell(p)
     
 
 if __name__ == '__main__':
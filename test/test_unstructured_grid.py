@@ -189,6 +189,197 @@ def test_nearest_cell():
     assert hit1==hit2
 
 ## 
+
+def test_batch_topology_queries():
+    ug=unstructured_grid.SuntansGrid(os.path.join(sample_data,'sfbay') )
+
+    js=np.arange(0,ug.Nedges(),7)
+    pairs=ug.edges['nodes'][js]
+    assert np.all( ug.node_pairs_to_edges(pairs)==js )
+    assert np.all( ug.node_pairs_to_edges(pairs[:,::-1])==js )
+    assert ug.node_pairs_to_edges([[0,0]])[0]==ug.UNDEFINED
+
+    nodes=[0,10,100]
+    cells=ug.nodes_to_incident_cells(nodes)
+    for n,row in zip(nodes,cells):
+        assert list(row[row>=0])==list(ug.node_to_cells(n))
+
+    # incremental edits are reflected in the batch queries
+    n1=ug.add_node(x=[0,0])
+    n2=ug.add_node(x=[1,0])
+    j=ug.add_edge(nodes=[n1,n2])
+    assert ug.node_pairs_to_edges([[n2,n1]])[0]==j
+    ug.delete_edge(j)
+    assert ug.node_pairs_to_edges([[n2,n1]])[0]==ug.UNDEFINED
+
+def test_edge_to_cells_recalc():
+    ug=unstructured_grid.SuntansGrid(os.path.join(sample_data,'sfbay') )
+    e2c=ug.edges['cells'].copy()
+    e2c[e2c<0]=ug.UNMESHED
+    ug.edge_to_cells(recalc=True)
+    assert np.all( ug.edges['cells']==e2c )
+
+def test_make_edges_from_cells():
+    # mixed triangles and quads
+    ug=unstructured_grid.UnstructuredGrid(points=[[0,0],[1,0],[2,0],[0,1],[1,1],[2,1]],
+                                          cells=[[0,1,4,3],[1,2,4,-1],[2,5,4,-1]],
+                                          max_sides=4)
+    ug.make_edges_from_cells()
+    assert ug.Nedges()==8
+
+    for c in ug.valid_cell_iter():
+        nodes=ug.cell_to_nodes(c)
+        for i,j in enumerate(ug.cell_to_edges(c)):
+            a,b=nodes[i],nodes[(i+1)%len(nodes)]
+            assert set(ug.edges['nodes'][j])==set([a,b])
+            if ug.edges['nodes'][j,0]==a:
+                assert ug.edges['cells'][j,0]==c
+            else:
+                assert ug.edges['cells'][j,1]==c
+    assert np.sum(ug.edges['cells']>=0)==10
+
+def test_bulk_edit():
+    ug=unstructured_grid.UnstructuredGrid(max_sides=4)
+    ug.add_node(x=[-1,-1])
+    ug.node_index() # should be rebuilt after the bulk edit
+
+    calls=[]
+    def cb(*a,**k):
+        calls.append(a)
+    ug.subscribe_after('add_node',cb)
+
+    chk=ug.checkpoint()
+    with ug.bulk_edit(listeners=False):
+        ug.add_rectilinear([0,0],[10,10],11,11)
+        # nested bulk edits defer to the outer one
+        ug.add_rectilinear([20,0],[30,10],11,11)
+    assert len(calls)==0
+    assert ug.Ncells()==200
+    assert ug.select_nodes_nearest([20.1,0.1])==122
+    ug.revert(chk)
+    assert ug.Ncells()==0 and ug.Nedges_valid()==0
+
+    chk=ug.checkpoint()
+    with ug.bulk_edit(undo=False):
+        ug.add_rectilinear([0,0],[10,10],11,11)
+    assert len(calls)==121
+    # checkpoints from before a non-undoable bulk edit are invalid
+    with assert_raises(ValueError):
+        ug.revert(chk)
+
+def test_points_to_cells():
+    ug=unstructured_grid.SuntansGrid(os.path.join(sample_data,'sfbay') )
+    xxyy=ug.bounds()
+    np.random.seed(37)
+    xy=np.c_[ np.random.uniform(xxyy[0],xxyy[1],500),
+              np.random.uniform(xxyy[2],xxyy[3],500) ]
+    cells=ug.points_to_cells(xy)
+
+    for p,c in zip(xy,cells):
+        hit=ug.select_cells_nearest(p,inside=True)
+        assert c==(-1 if hit is None else hit)
+
+    # walk from the previous cells
+    xy2=xy+np.random.normal(scale=100,size=xy.shape)
+    assert np.all( ug.points_to_cells(xy2,prev=cells)==ug.points_to_cells(xy2) )
+
+def test_maintained_indexes():
+    ug=unstructured_grid.UnstructuredGrid(max_sides=4)
+    ug.add_rectilinear([0,0],[10,10],11,11)
+    ug.edge_index() ; ug.cell_center_index()
+
+    def check():
+        ec=ug.edges_center()
+        for j in np.nonzero(~ug.edges['deleted'])[0]:
+            assert ug.select_edges_nearest(ec[j])==j
+        cc=ug.cells_centroid()
+        valid=np.nonzero(~ug.cells['deleted'])[0]
+        for c in valid:
+            assert ug.select_cells_nearest(cc[c])==c
+        assert np.all( ug.select_cells_nearest_batch(cc[valid])==valid )
+
+    check()
+    n=ug.select_nodes_nearest([5,5])
+    ug.modify_node(n,x=[5.2,4.9])
+    check()
+    c=ug.select_cells_nearest([0.5,0.5])
+    ug.delete_cell(c)
+    check()
+    ug.delete_edge(ug.nodes_to_edge(ug.select_nodes_nearest([0,0]),
+                                    ug.select_nodes_nearest([1,0])))
+    check()
+    near=ug.select_edges_nearest_batch([[5,5],[100,100]],count=3)
+    assert near.shape==(2,3)
+    assert np.all(near>=0)
+
+def test_add_grid_merge_auto():
+    # two unit squares sharing the edge x=1
+    ugA=unstructured_grid.UnstructuredGrid(points=[[0,0],[1,0],[1,1],[0,1]],
+                                           cells=[[0,1,2,3]],max_sides=4)
+    ugA.make_edges_from_cells()
+    ugB=unstructured_grid.UnstructuredGrid(points=[[2,1],[1,1],[1,0],[2,0]],
+                                           cells=[[2,3,0,1]],max_sides=4)
+    ugB.make_edges_from_cells()
+
+    assert sorted(map(tuple,ugA.match_nodes(ugB)))==[(1,2),(2,1)]
+    ugA.add_grid(ugB,merge_nodes='auto')
+    assert ugA.Nnodes()==6
+    assert ugA.Nedges()==7
+    j=ugA.nodes_to_edge([1,2])
+    assert np.all(ugA.edges['cells'][j]>=0)
+
+def test_add_grid_arrays():
+    # array-level merge gives the same grid as adding one element at a time
+    def patch(x0,nx,ny):
+        xy=np.array([[x0+i,j] for j in range(ny+1) for i in range(nx+1)],np.float64)
+        quads=[[j*(nx+1)+i,j*(nx+1)+i+1,(j+1)*(nx+1)+i+1,(j+1)*(nx+1)+i]
+               for j in range(ny) for i in range(nx)]
+        # split some quads into triangles
+        cells=[]
+        for k,q in enumerate(quads):
+            if k%3==0:
+                cells+=[[q[0],q[1],q[2],-1],[q[0],q[2],q[3],-1]]
+            else:
+                cells.append(q)
+        g=unstructured_grid.UnstructuredGrid(points=xy,cells=cells,max_sides=4)
+        g.make_edges_from_cells()
+        return g
+
+    def merged(elementwise):
+        ugA=patch(0,4,3)
+        ugA.delete_cell(0) # deleted elements in A are left alone
+        ugB=patch(4,3,3)
+        ugB.delete_cell(ugB.Ncells()-1)
+        if elementwise:
+            ugA.checkpoint() # recording undo forces add_node/add_edge/add_cell
+            assert not ugA.can_append_arrays()
+        else:
+            assert ugA.can_append_arrays()
+        maps=ugA.add_grid(ugB,merge_nodes='auto')
+        return ugA,maps
+
+    gA,mapsA=merged(False)
+    gB,mapsB=merged(True)
+
+    for a,b in zip(mapsA,mapsB):
+        assert np.all(a==b)
+    assert np.all(gA.nodes['x']==gB.nodes['x'])
+    assert np.all(gA.edges['nodes']==gB.edges['nodes'])
+    assert np.all(gA.edges['cells']==gB.edges['cells'])
+    assert np.all(gA.cells['nodes']==gB.cells['nodes'])
+    valid=~gA.cells['deleted']
+    assert np.all(gA.cells['edges'][valid]==gB.cells['edges'][valid])
+    # shared seam x=4 has cells on both sides
+    for n1,n2 in gA.edges['nodes'][~gA.edges['deleted']]:
+        if gA.nodes['x'][n1,0]==4 and gA.nodes['x'][n2,0]==4:
+            j=gA.nodes_to_edge(n1,n2)
+            assert np.all(gA.edges['cells'][j]>=0)
+    # topology tables and indices see the new elements
+    n=gA.select_nodes_nearest([6.9,2.1])
+    assert np.allclose(gA.nodes['x'][n],[7,2])
+    assert len(gA.node_to_edges(n))==len(gB.node_to_edges(n))
+
+## 
     
 if __name__=='__main__':
     nose.main()
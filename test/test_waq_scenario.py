@@ -9,3 +9,295 @@ def test_waq_timestep_timedelta():
         ts=waq_scenario.timedelta_to_waq_timestep(td)
         td2=waq_scenario.waq_timestep_to_timedelta(ts)
         assert td == td2
+
+def test_frame_file():
+    import os, tempfile, shutil
+    import numpy as np
+    tmpdir=tempfile.mkdtemp()
+    try:
+        fn=os.path.join(tmpdir,'test.vol')
+        # irregular steps, and a partial trailing frame
+        t_secs=np.array([-3600,0,1800,3600,7200],'i4')
+        data=np.arange(len(t_secs)*3,dtype='f4').reshape([-1,3])
+        with open(fn,'wb') as fp:
+            for t,frame in zip(t_secs,data):
+                fp.write(t.tobytes())
+                fp.write(frame.tobytes())
+            fp.write(np.int32(9000).tobytes())
+
+        ff=waq_scenario.FrameFile(fn,3)
+        assert len(ff)==len(t_secs)
+        assert np.all(ff.t_secs==t_secs)
+        assert ff.index(3600)==3
+        assert ff.index(1000) is None
+        assert np.all(ff.frame(2)==data[2])
+        ts,frames=ff.frames(0,7200)
+        assert np.all(ts==t_secs[1:4])
+        assert np.all(frames==data[1:4])
+        del ff,frames
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_write_frames_resume():
+    import os, tempfile, shutil
+    import numpy as np
+
+    class ConstHydro(waq_scenario.Hydro):
+        n_exch_x=3
+        n_exch_y=0
+        n_exch_z=0
+        t_secs=np.arange(0,10*3600,3600).astype('i4')
+        write_block_size=4
+        def areas(self,t):
+            return t+np.arange(self.n_exch,dtype='f4')
+
+    tmpdir=tempfile.mkdtemp()
+    try:
+        fn=os.path.join(tmpdir,'test.are')
+        hydro=ConstHydro()
+        hydro.write_frames(fn,'block_areas',hydro.n_exch,t_secs=hydro.t_secs)
+        full=open(fn,'rb').read()
+        ff=waq_scenario.FrameFile(fn,hydro.n_exch)
+        assert np.all(ff.t_secs==hydro.t_secs)
+        assert np.all(ff.frame(5)==hydro.areas(hydro.t_secs[5]))
+        del ff
+
+        # interrupted mid-frame
+        with open(fn,'r+b') as fp:
+            fp.truncate(len(full)//2+3)
+        hydro.write_resume=True
+        hydro.write_frames(fn,'block_areas',hydro.n_exch,t_secs=hydro.t_secs)
+        assert open(fn,'rb').read()==full
+    finally:
+        shutil.rmtree(tmpdir)
+
+def two_proc_aggregator(tmpdir):
+    """ DwaqAggregator over two synthetic processors, 2 columns of 2 layers
+    after aggregation.  Processor 0 is read from binary files, with the last
+    flow frame missing, processor 1 is computed one step at a time.
+    """
+    import os
+    import logging
+    import numpy as np
+    from scipy import sparse
+
+    steps=np.arange(0,11*1800,1800).astype('i4')
+    rng=np.random.RandomState(2)
+
+    class FileProc(waq_scenario.HydroFiles):
+        n_exch_x=3
+        n_exch_y=0
+        n_exch_z=1
+        _n_seg=3
+        _t_secs=steps
+        def __init__(self):
+            self.log=logging.getLogger('test')
+            for label,n in [('areas-file',self.n_exch),('flows-file',self.n_exch),
+                            ('volumes-file',self.n_seg)]:
+                t=steps[:-1] if label=='flows-file' else steps
+                frames=np.zeros(len(t),[('tsecs','i4'),('data','f4',(n,))])
+                frames['tsecs']=t
+                frames['data']=rng.uniform(1,100,size=(len(t),n))
+                with open(self.get_path(label),'wb') as fp:
+                    fp.write(frames.tobytes())
+        def get_path(self,k,check=False):
+            return os.path.join(tmpdir,'proc0-'+k)
+
+    class StepProc(waq_scenario.Hydro):
+        n_exch_x=2
+        n_exch_y=0
+        n_exch_z=1
+        n_seg=3
+        def __init__(self):
+            self.data={m:rng.uniform(1,100,size=(len(steps),n)).astype('f4')
+                       for m,n in [('areas',self.n_exch),('flows',self.n_exch),
+                                   ('volumes',self.n_seg)]}
+            self.data['volumes'][3,1]=0.0 # exercise min_volume
+        t_secs=steps
+        def areas(self,t): return self.data['areas'][self.t_sec_to_index(t)]
+        def flows(self,t): return self.data['flows'][self.t_sec_to_index(t)]
+        def volumes(self,t): return self.data['volumes'][self.t_sec_to_index(t)]
+
+    class Agg(waq_scenario.DwaqAggregator):
+        # aggregated segments 1,2 and 3,4 are columns, with horizontal
+        # exchanges 1->3, 2->4 and vertical exchanges 1->2, 3->4
+        n_exch_x=2
+        n_exch_y=0
+        n_exch_z=2
+        n_agg_segments=4
+        pointers=np.array([[1,3,0,0],[2,4,0,0],[1,2,0,0],[3,4,0,0]],'i4')
+        def __init__(self):
+            self.log=logging.getLogger('test')
+            self.nprocs=2
+            self.hyds=[FileProc(),StepProc()]
+            # local segment 2 of processor 0 is a ghost
+            self.seg_local_to_agg=np.array([[0,1,-1],
+                                            [2,3,3]])
+            exch_local_to_agg=[ ([0,2,-1,1],[1,1,0,-1]),
+                                ([1,3,-1],[1,1,0]) ]
+            self.seg_matrix={}
+            self.flow_matrix={}
+            self.area_matrix={}
+            for p,hyd in enumerate(self.hyds):
+                sel=np.nonzero(self.seg_local_to_agg[p]>=0)[0]
+                self.seg_matrix[p]=sparse.coo_matrix( (np.ones(len(sel)),
+                                                       (self.seg_local_to_agg[p,sel],sel)),
+                                                      (self.n_seg,hyd.n_seg),dtype='f4').tocsr()
+                rows,sgns=[np.array(a) for a in exch_local_to_agg[p]]
+                cols=np.nonzero(rows>=0)[0]
+                for E,vals in [(self.flow_matrix,sgns[cols]),
+                               (self.area_matrix,np.abs(sgns[cols]))]:
+                    E[p]=sparse.coo_matrix( (vals,(rows[cols],cols)),
+                                            (self.n_exch,hyd.n_exch),dtype='f4').tocsr()
+        def open_hyd(self,p,force=False):
+            return self.hyds[p]
+    return Agg()
+
+def test_aggregator_blocks():
+    import os, tempfile, shutil
+    import numpy as np
+
+    tmpdir=tempfile.mkdtemp()
+    try:
+        agg=two_proc_aggregator(tmpdir)
+        t_secs=agg.t_secs
+        # the last step has no flows in the file for processor 0, which makes the
+        # block fall back to per-step reads.
+        for block in [t_secs[:4],t_secs[5:6],t_secs]:
+            for meth in ['areas','flows','volumes']:
+                expected=np.array([getattr(agg,meth)(t) for t in block])
+                result=getattr(agg,'block_'+meth)(block)
+                assert result.shape==expected.shape
+                assert np.all(result==expected),meth
+
+        # serial and forked writes give the same file, matching the per-step data
+        agg.write_block_size=3
+        outputs=[]
+        for nproc in [1,2]:
+            agg.write_processes=nproc
+            fn=os.path.join(tmpdir,'agg%d.flo'%nproc)
+            agg.write_frames(fn,'block_flows',agg.n_exch,t_secs=t_secs)
+            outputs.append(open(fn,'rb').read())
+        assert outputs[0]==outputs[1]
+        ff=waq_scenario.FrameFile(fn,agg.n_exch)
+        assert np.all(ff.t_secs==t_secs)
+        assert np.all(ff.mapped['data']==np.array([agg.flows(t) for t in t_secs]))
+        del ff
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_monotonicize_areas():
+    import logging
+    import numpy as np
+
+    # two columns of 3 and 2 segments, plus one horizontal exchange and
+    # a bed exchange, with vertical exchanges out of order
+    class Columns(waq_scenario.DwaqAggregator):
+        def __init__(self):
+            self.log=logging.getLogger('test')
+        n_exch=6
+        n_exch_z=5
+        n_seg=5
+        pointers=np.array([[1,4,0,0],
+                           [2,3,0,0],
+                           [4,5,0,0],
+                           [1,2,0,0],
+                           [3,0,0,0],
+                           [0,4,0,0]],'i4')
+    agg=Columns()
+    rng=np.random.RandomState(1)
+    areas=(10*rng.uniform(size=(5,agg.n_exch))-1).astype('f4')
+    for top_down in [False,True]:
+        expected=areas.copy()
+        for frame in expected:
+            agg.monotonicize_areas_loop(frame,top_down=top_down)
+        result=areas.copy()
+        agg.monotonicize_areas(result,top_down=top_down)
+        assert np.all(result==expected)
+
+def test_filter_hydro_bc():
+    import numpy as np
+
+    # two water columns of two segments, with tidal flows at the boundaries
+    class Tidal(waq_scenario.Hydro):
+        n_exch_x=4
+        n_exch_y=0
+        n_exch_z=2
+        n_seg=4
+        pointers=np.array([[-1,1,0,0],[-2,2,0,0],[1,3,0,0],[2,4,0,0],
+                           [1,2,0,0],[3,4,0,0]],'i4')
+        seg_to_2d_element=np.array([0,0,1,1])
+        t_secs=np.arange(0,20*86400,1800).astype('i4')
+        def __init__(self):
+            super(Tidal,self).__init__()
+            phase=2*np.pi*self.t_secs/(12.42*3600)
+            mean=np.array([50,30,20,10,0,0])
+            amp=np.array([400,300,200,150,5,3])
+            self.Q=mean+amp*np.sin(phase[:,None]+np.arange(self.n_exch)*0.2)
+            # volumes consistent with the flows
+            dV=np.zeros((len(self.t_secs),self.n_seg))
+            for j,(a,b) in enumerate(self.pointers[:,:2]):
+                if a>0: dV[:,a-1]-=self.Q[:,j]
+                if b>0: dV[:,b-1]+=self.Q[:,j]
+            self.V=1e8+np.concatenate( ([np.zeros(self.n_seg)],
+                                        np.cumsum(dV[:-1]*1800,axis=0)) )
+        def flows(self,t): return self.Q[self.t_sec_to_index(t)]
+        def volumes(self,t): return self.V[self.t_sec_to_index(t)]
+        def areas(self,t): return 1e4+np.abs(self.Q[self.t_sec_to_index(t)])
+
+    serial=waq_scenario.FilterHydroBC(Tidal())
+    class Threaded(waq_scenario.FilterHydroBC):
+        filter_block_steps=7
+        filter_block_exchanges=1
+        filter_threads=2
+    threaded=Threaded(Tidal())
+
+    t_mid=serial.t_secs[len(serial.t_secs)//2]
+    # tidal signal removed from the boundary flows
+    lp=serial.block_flows(serial.t_secs)[:,0]
+    assert np.abs(lp-50)[100:-100].max() < 5
+    for meth in ['block_flows','block_volumes','block_areas']:
+        assert np.allclose(getattr(serial,meth)(serial.t_secs),
+                           getattr(threaded,meth)(threaded.t_secs))
+    assert np.all(serial.flows(t_mid)==serial.block_flows([t_mid])[0])
+
+def test_his_file():
+    import os, tempfile, shutil
+    import numpy as np
+    from stompy.model.delft import io as dio
+
+    regions=[b'reg_a',b'reg_b']
+    fields=[(b'NO3',b''),(b'NO3',b'Nitrif'),(b'NH4',b'')]
+    data=np.arange(5*len(regions)*len(fields),dtype='f4').reshape([5,len(regions),len(fields)])
+
+    def write(fn,nt):
+        with open(fn,'wb') as fp:
+            descs=[b'test',b'',b'',b'T0: 2012/08/01-00:00:00  (scu=       1s)']
+            fp.write(np.array(descs,'S40').tobytes())
+            fp.write(np.array([len(fields),len(regions)],'i4').tobytes())
+            fp.write(np.array(fields,[('sub','S10'),('proc','S10')]).tobytes())
+            fp.write(np.array(list(enumerate(regions,1)),[('num','i4'),('name','S20')]).tobytes())
+            for ti in range(nt):
+                fp.write(np.int32(3600*ti).tobytes())
+                fp.write(data[ti].tobytes())
+
+    tmpdir=tempfile.mkdtemp()
+    try:
+        fn=os.path.join(tmpdir,'test.his')
+        write(fn,3)
+        his=dio.HisFile(fn)
+        ds=his.dataset()
+        assert list(ds.field.values)==['NO3','NO3,Nitrif','NH4']
+        assert np.all(ds.bal.values==data[:3])
+        assert np.all(ds.bal.sel(region='reg_b',field='NO3,Nitrif').values==data[:3,1,1])
+        assert np.all(dio.his_file_xarray(fn,region_exclude='reg_a').bal.values==data[:3,1:])
+
+        # frames appended by a running simulation
+        write(fn,5)
+        assert his.refresh()==2
+        new=his.dataset(start=len(ds.time))
+        assert np.all(new.tsec.values==[10800,14400])
+        assert np.all(new.bal.values==data[3:])
+        del his,ds,new
+    finally:
+        shutil.rmtree(tmpdir)